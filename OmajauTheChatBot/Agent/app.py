@@ -1,42 +1,76 @@
-from flask import Flask, request, jsonify
+# Import time is part of the startup report (see startup.py)
+import time
+_import_started = time.perf_counter()
+
+from flask import Flask, request, jsonify, Response, g
+from flask.json.provider import JSONProvider as BaseJSONProvider
 from pymongo import MongoClient
+from pymongo.errors import DuplicateKeyError
 from datetime import datetime
 import os
-from dotenv import load_dotenv
-from bson import ObjectId
-import json
+import atexit
+from contextlib import nullcontext
 from flask_cors import CORS
 import requests
+from requests.adapters import HTTPAdapter
 import traceback
 import logging
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_core.messages import HumanMessage, SystemMessage, AIMessage
+import threading
+import click
+from auth_cache import TokenCache
+from json_provider import FastJSONMixin
+from llm_scheduler import ModelScheduler, SchedulerBusy
+from metrics import (
+    CONTENT_TYPE, ERRORS, IN_FLIGHT, REGISTRY, REQUEST_SECONDS, REQUESTS, STAGE_SECONDS, MongoCommandMetrics,
+    begin_request_stages, end_request_stages, route_label, timed,
+)
+from request_profiler import RequestProfiler, server_timing
+from startup import Deferred, StartupReport, WarmUp
+from context_builder import PromptStats
+from response_cache import cache_key, create_response_cache
+from pagination import PageError, keyset_filter, keyset_sort, message_page_args, page_args, split_page
+from indexes import ensure_indexes, explain_queries
+from convo_store import (
+    STORE_FIELDS, WRITE_BEHIND, ChatTouchBatcher, ConvoStore, MessageWriteBehind, public_messages,
+)
+from backup import (
+    ImportFormatError, export_filename, export_records, import_lines, iter_lines, ndjson_chunks,
+)
+from purger import DELETED, NOT_DELETED, PURGE_WORKER, Purger, tombstone
+from chat_core import (
+    AUTH_API_BASE, AUTH_CACHE_MAX_ENTRIES, AUTH_CACHE_NEGATIVE_TTL, AUTH_CACHE_TTL, AUTH_POOL_SIZE,
+    CONVO_GREETING, CORS_ALLOW_HEADERS, CORS_EXPOSE_HEADERS, CORS_METHODS, CORS_ORIGINS, DB_NAME,
+    DEBUG_GENAI, ENSURE_INDEXES, FALLBACK_REPLY, GEMINI_API_KEY, GEMINI_MODEL, IDENTITY_PROMPT,
+    LEGACY_GREETING, LOADER_HTML, MODEL_BACKEND, MONGO_URI, PROFILE_DIR, PROFILE_MAX_FILES,
+    PROFILE_SAMPLE_RATE, PROFILE_TOKEN, RESPONSE_CACHE, RESPONSE_CACHE_HISTORY,
+    RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL, SCHEDULER_MAX_IN_FLIGHT, SCHEDULER_MAX_QUEUE,
+    SCHEDULER_MAX_QUEUE_PER_USER, SCHEDULER_MAX_WAIT, SCHEDULER_RETRY_AFTER, SERVER_TIMING,
+    STARTUP_WARMUP, auth_uid, build_prompt, create_chat_model, create_model_call_policy,
+    log_genai_failure, message_doc, model_configured, new_chat_id, new_session_id,
+    normalize_messages, sse,
+)
 
-# Load environment variables
-load_dotenv()
 logging.basicConfig(level=logging.INFO)
 
+startup = StartupReport(_import_started)
+startup.record("imports", time.perf_counter() - _import_started)
+
 # Initialize Flask app
 app = Flask(__name__)
 # Allow Authorization header through CORS so frontend can send Bearer tokens
 CORS(
     app,
-    origins=[
-        "https://omaju-chatinterface-adityakatyal.vercel.app",
-        "https://omaju-onboarding.vercel.app",
-        "http://localhost:3000",  # optional for local testing
-        "http://localhost:3001"   # optional for local testing
-    ],
+    origins=CORS_ORIGINS,
     supports_credentials=True,
-    allow_headers=["Content-Type", "Authorization"],
-    expose_headers=["Content-Type"],
-    methods=["GET", "POST", "PATCH", "DELETE", "OPTIONS"],
+    allow_headers=CORS_ALLOW_HEADERS,
+    expose_headers=CORS_EXPOSE_HEADERS,
+    methods=CORS_METHODS,
 )
 
 # Database setup
-MONGO_URI = os.getenv("MONGO_URI")
-client = MongoClient(MONGO_URI)
-db = client["ChatApp"]
+# The command listener feeds per-command MongoDB latency into /metrics
+client = MongoClient(MONGO_URI, event_listeners=[MongoCommandMetrics()])
+db = client[DB_NAME]
 
 # Legacy single collection (for backward compatibility)
 conversations = db["conversations"]
@@ -44,58 +78,151 @@ conversations = db["conversations"]
 # New 3-collection schema
 users_col = db["users"]          # created/managed by Node auth service
 chats_col = db["chats"]          # chat titles per user (uid)
-convos_col = db["convos"]        # sessions and messages per chat
+convos_col = db["convos"]        # session metadata per chat
+# Messages are stored in fixed-size buckets (db["convo_buckets"]); see convo_store
+# With WRITE_BEHIND=true message pushes are queued and flushed in batches by a background thread
+write_behind = MessageWriteBehind() if WRITE_BEHIND else None
+store = ConvoStore(db, write_behind=write_behind)
+if write_behind is not None:
+    write_behind.start(store.buckets)
+    atexit.register(lambda: write_behind.flush(store.buckets))
+# chats.updated_at bumps from /chat are coalesced and flushed in the background
+chat_touches = ChatTouchBatcher()
+chat_touches.start(chats_col)
+atexit.register(lambda: chat_touches.flush(chats_col))
+# Deleted chats and sessions are only marked; their data is removed in throttled batches (see purger)
+purger = Purger(db, write_behind=write_behind)
+if PURGE_WORKER:
+    purger.start()
+
+# Gemini setup (see chat_core for key/model selection). Importing the SDK and building the
+# client is the slowest part of startup, so it happens on first use or in the warm-up below.
+chat_model = Deferred("model", create_chat_model, startup)
+
+# JSON for ObjectId and datetime (orjson when installed, see json_provider)
+class JSONProvider(FastJSONMixin, BaseJSONProvider):
+    def response(self, *args, **kwargs):
+        with STAGE_SECONDS.time("serialization"):
+            return super().response(*args, **kwargs)
+
+app.json = JSONProvider(app)
+
+# Pooled keep-alive session for auth round trips (avoids a TCP/TLS handshake per request)
+auth_http = requests.Session()
+auth_http.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=AUTH_POOL_SIZE))
+auth_http.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=AUTH_POOL_SIZE))
+
+# Cache of validated tokens. Rejections are cached briefly so a bad token can't hammer the auth service.
+token_cache = TokenCache(
+    ttl=AUTH_CACHE_TTL,
+    negative_ttl=AUTH_CACHE_NEGATIVE_TTL,
+    max_entries=AUTH_CACHE_MAX_ENTRIES,
+)
 
-# Gemini setup
-# Prefer GEMINI_API_KEY (Render-provided), fall back to GOOGLE_API_KEY for compatibility
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY") or os.getenv("GOOGLE_API_KEY")
-GEMINI_MODEL = os.getenv("GEMINI_MODEL") or "gemini-1.5-flash"
-DEBUG_GENAI = (os.getenv("DEBUG_GENAI", "false").lower() == "true")
+# Sizes of the prompts sent to the model (reported in /health)
+prompt_stats = PromptStats()
+# Sampled / X-Profile-triggered cProfile captures (off unless PROFILE_SAMPLE_RATE or PROFILE_TOKEN is set)
+profiler = RequestProfiler(
+    directory=PROFILE_DIR,
+    sample_rate=PROFILE_SAMPLE_RATE,
+    token=PROFILE_TOKEN,
+    max_files=PROFILE_MAX_FILES,
+)
+# Caps concurrent model calls; waiting requests are served round-robin per user
+model_scheduler = ModelScheduler(
+    max_in_flight=SCHEDULER_MAX_IN_FLIGHT,
+    max_queue_per_user=SCHEDULER_MAX_QUEUE_PER_USER,
+    max_queue=SCHEDULER_MAX_QUEUE,
+    max_wait=SCHEDULER_MAX_WAIT,
+    retry_after=SCHEDULER_RETRY_AFTER,
+)
+# Deadline, retries and hedging around the /chat model call; attempts it
+# abandons keep a scheduler slot until they finish
+model_calls = create_model_call_policy(hold=model_scheduler.hold)
+
+# Optional cache of model replies for repeated prompts (RESPONSE_CACHE=memory)
+response_cache = create_response_cache(
+    RESPONSE_CACHE,
+    ttl=RESPONSE_CACHE_TTL,
+    max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+)
 
-chat_model = None
-if GEMINI_API_KEY:
-    try:
-        chat_model = ChatGoogleGenerativeAI(
-            model=GEMINI_MODEL,
-            temperature=0.7,
-            google_api_key=GEMINI_API_KEY
-        )
-        logging.info("[genai] Initialized ChatGoogleGenerativeAI with model %s", GEMINI_MODEL)
-    except Exception:
-        logging.error("[genai] Failed to initialize ChatGoogleGenerativeAI: %s", traceback.format_exc())
-else:
-    logging.warning("[genai] No GEMINI_API_KEY/GOOGLE_API_KEY configured. Responses will fail.")
-
-# Custom JSON Encoder for ObjectId and datetime
-class JSONEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, ObjectId):
-            return str(obj)
-        if isinstance(obj, datetime):
-            return obj.isoformat()
-        return super().default(obj)
-
-app.json_encoder = JSONEncoder
-
-# Use the environment variable if set, otherwise choose a safe default
-# On Render, prefer AUTH_API_BASE env; if missing, fall back to the deployed auth URL
-if os.getenv("RENDER") == "true":  # Render sets RENDER=true in deployed env
-    AUTH_API_BASE = os.getenv("AUTH_API_BASE") or "https://omaju-onboarding.onrender.com/api/auth"
-else:
-    AUTH_API_BASE = os.getenv("AUTH_API_BASE") or "http://localhost:5001/api/auth"
+# ============ Metrics ============
+
+REGISTRY.callback("omaju_model_in_flight", "Model calls holding a scheduler slot",
+                  lambda: model_scheduler.stats()["in_flight"])
+REGISTRY.callback("omaju_model_queued", "Requests waiting for a model slot", lambda: model_scheduler.stats()["queued"])
+REGISTRY.callback("omaju_write_behind_pending", "Messages queued by write-behind",
+                  lambda: write_behind.stats()["queued"] if write_behind else 0)
+
+@app.before_request
+def _metrics_begin():
+    g.metrics_started = time.perf_counter()
+    IN_FLIGHT.inc()
+    # Opt-in extras; with SERVER_TIMING and profiling off these are two flag checks
+    if SERVER_TIMING:
+        g.stage_timings = begin_request_stages()
+    if profiler.enabled and profiler.wanted(request.headers.get("X-Profile")):
+        g.profile = profiler.start()
+
+@app.after_request
+def _metrics_record(response):
+    started = g.get("metrics_started")
+    if started is not None:
+        elapsed = time.perf_counter() - started
+        route = route_label(request.url_rule)
+        REQUEST_SECONDS.observe(elapsed, route, request.method)
+        REQUESTS.inc(route, request.method, response.status_code)
+        if SERVER_TIMING and "stage_timings" in g:
+            response.headers["Server-Timing"] = server_timing(g.stage_timings, elapsed)
+            origin = request.headers.get("Origin")
+            if origin in CORS_ORIGINS:
+                response.headers["Timing-Allow-Origin"] = origin
+    return response
+
+@app.teardown_request
+def _metrics_end(exc):
+    IN_FLIGHT.dec()
+    if exc is not None:
+        ERRORS.inc("request", type(exc).__name__)
+    if SERVER_TIMING:
+        end_request_stages()
+    profile = g.pop("profile", None)
+    if profile is not None:
+        try:
+            path = profiler.finish(profile, route_label(request.url_rule), time.perf_counter() - g.metrics_started)
+            logging.info("[profile] %s %s -> %s", request.method, request.path, path)
+        except OSError as e:
+            logging.warning("[profile] could not write capture: %s", e)
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return REGISTRY.render(), 200, {"Content-Type": CONTENT_TYPE}
 
+def _bearer_token():
+    auth_header = request.headers.get("Authorization", "")
+    if not auth_header.startswith("Bearer "):
+        return None
+    return auth_header.split(" ", 1)[1]
+
+@timed("auth")
 def _validate_auth_or_401():
     """Validate Authorization Bearer token against OmajuSignUp profile endpoint.
+    Results are served from token_cache when possible.
     Returns (user_json | None, error_response | None)
     """
-    auth_header = request.headers.get("Authorization", "")
-    if not auth_header.startswith("Bearer "):
+    token = _bearer_token()
+    if not token:
         return None, (jsonify({"success": False, "message": "Access token required"}), 401)
-    token = auth_header.split(" ", 1)[1]
+    found, valid, cached_user = token_cache.get(token)
+    if found:
+        if valid:
+            return cached_user, None
+        return None, (jsonify({"success": False, "message": "Invalid or expired token"}), 401)
     try:
         profile_url = f"{AUTH_API_BASE}/profile"
         print("[auth] validating token via:", profile_url)
-        resp = requests.get(profile_url, headers={
+        resp = auth_http.get(profile_url, headers={
             "Authorization": f"Bearer {token}",
             "Content-Type": "application/json",
         }, timeout=5)
@@ -105,11 +232,17 @@ def _validate_auth_or_401():
             except Exception:
                 body = None
             print("[auth] profile failed", resp.status_code, body)
+            # Only cache definitive rejections; 5xx from the auth service should be retried next time
+            if resp.status_code in (401, 403):
+                token_cache.put_negative(token)
             return None, (jsonify({"success": False, "message": "Invalid or expired token"}), 401)
         data = resp.json()
-        return data.get("data", {}).get("user"), None
+        user = data.get("data", {}).get("user")
+        token_cache.put(token, user)
+        return user, None
     except Exception as e:
         print("[auth] error contacting auth service:", e)
+        ERRORS.inc("auth", type(e).__name__)
         return None, (jsonify({"success": False, "message": "Auth service unavailable"}), 503)
 
 def _require_uid_match(uid_from_path, user_obj):
@@ -118,8 +251,7 @@ def _require_uid_match(uid_from_path, user_obj):
     """
     if not user_obj:
         return (jsonify({"success": False, "message": "Unauthorized"}), 401)
-    auth_uid = user_obj.get("_id") or user_obj.get("id") or user_obj.get("uid")
-    if str(uid_from_path) != str(auth_uid):
+    if str(uid_from_path) != str(auth_uid(user_obj)):
         return (jsonify({"success": False, "message": "Forbidden"}), 403)
     return None
 
@@ -130,105 +262,223 @@ def home():
 
 # Chat endpoint (generates assistant response)
 # Updated to prefer new convos collection. Falls back to legacy conversations.
-@app.route("/chat", methods=["POST"])
-def chat():
-    # Enforce auth
-    user, err = _validate_auth_or_401()
-    if err:
-        return err
 
+def _parse_chat_request():
+    """Returns (session_id, chat_id, user_message, error_response | None)."""
     data = request.get_json()
     session_id = data.get("session_id")
     chat_id = data.get("chat_id")
     user_message = data.get("message")
-
     if not session_id or not user_message:
-        return jsonify({"error": "session_id and message are required"}), 400
+        return None, None, None, (jsonify({"error": "session_id and message are required"}), 400)
+    return session_id, chat_id, user_message, None
 
-    # Save user message to new convos collection when possible
-    user_doc = {"role": "user", "content": user_message, "timestamp": datetime.utcnow()}
-    wrote_new = False
+def _save_user_message(session_id, chat_id, user_message):
+    """Persist the user's message. Returns a Turn carrying the recent messages for context."""
+    user_doc = message_doc("user", user_message)
+    turn = store.append_user_message(session_id, chat_id, user_doc)
     if chat_id:
-        convos_col.update_one(
-            {"_id": session_id},
-            {
-                "$setOnInsert": {
-                    "_id": session_id,
-                    "chat_id": chat_id,
-                    "created_at": datetime.utcnow(),
-                    "messages": []
-                }
-            },
-            upsert=True
-        )
-        convos_col.update_one({"_id": session_id}, {"$push": {"messages": user_doc}})
-        # bump chat updated_at
-        try:
-            chats_col.update_one({"_id": chat_id}, {"$set": {"updated_at": datetime.utcnow()}}, upsert=False)
-        except Exception:
-            pass
-        wrote_new = True
-
-    if not wrote_new:
-        # Legacy behavior
-        conversations.update_one(
-            {"session_id": session_id},
-            {"$push": {"messages": user_doc}, "$setOnInsert": {"session_id": session_id, "created_at": datetime.utcnow()}},
-            upsert=True
-        )
-
-    # Fetch last 20 messages for context
-    # Prefer new convos
-    conversation_doc = convos_col.find_one({"_id": session_id})
-    if not conversation_doc:
-        conversation_doc = conversations.find_one({"session_id": session_id}) or {"messages": []}
-    recent_msgs = conversation_doc.get("messages", [])[-20:]
-
-    # Prepare messages for LangChain
-    history = []
-    for msg in recent_msgs:
-        if msg["role"] == "user":
-            history.append(HumanMessage(content=msg["content"]))
-        elif msg["role"] == "assistant":
-            history.append(AIMessage(content=msg["content"]))
-        else:
-            # Any non-user/assistant roles are treated as system messages
-            history.append(SystemMessage(content=msg.get("content", "")))
+        # bump chat updated_at (written in batches by the flusher thread)
+        chat_touches.touch(chat_id)
+    return turn
+
+def _save_assistant_message(turn, agent_response, **extra):
+    """Save AI response into the slot reserved right after the user message."""
+    ai_doc = message_doc("assistant", agent_response, **extra)
+    store.append_reply(turn, ai_doc)
+
+def _fill_unanswered(turn):
+    """Save the fallback reply into a reserved slot nothing else filled (failed or
+    abandoned turns), so the history never keeps a hole where a reply belongs."""
+    if turn is None or turn.replied:
+        return
+    try:
+        _save_assistant_message(turn, FALLBACK_REPLY)
+    except Exception:
+        logging.exception("[chat] could not fill the reply slot of session %s", turn.session_id)
+
+def _response_cache_key(recent_msgs):
+    """Cache key for replying to this turn, or None when the cache is off, bypassed, or the
+    conversation is longer than RESPONSE_CACHE_HISTORY (see response_cache.cache_key).
+    Clients bypass it with `Cache-Control: no-cache` or `"cache": false` in the body.
+    """
+    if response_cache is None:
+        return None
+    if "no-cache" in request.headers.get("Cache-Control", "").lower():
+        return None
+    if (request.get_json(silent=True) or {}).get("cache") is False:
+        return None
+    return cache_key(IDENTITY_PROMPT, recent_msgs, RESPONSE_CACHE_HISTORY)
+
+def _scheduler_uid(user):
+    return str(auth_uid(user) or "anonymous")
+
+def _busy_response(e):
+    """429/503 with Retry-After when no model slot is available."""
+    body = {"success": False, "message": e.reason, "retry_after": e.retry_after}
+    return jsonify(body), e.status, {"Retry-After": str(e.retry_after)}
+
+def _wants_event_stream():
+    best = request.accept_mimetypes.best_match(["application/json", "text/event-stream"])
+    return best == "text/event-stream"
+
+@app.route("/chat", methods=["POST"])
+def chat():
+    # Clients that ask for SSE get the streaming variant of the same endpoint
+    if _wants_event_stream():
+        return chat_stream()
 
-    # Add identity context
-    identity = SystemMessage(content="Your name is Omaju, a fun, friendly and extroverted AI ChatBot, created by Aditya Katyal, provide them my protfolio link to visit me https://adityakatyal-portfolio.onrender.com " \
-    "but only when user ask you who is your creator and ask them again if you can provide them my portfolio or not "
-    ". Give them the link only when they say yes. Be frindly and reply with atleast two to three lines")
-    full_history = [identity] + history
+    # Enforce auth
+    user, err = _validate_auth_or_401()
+    if err:
+        return err
 
-    # Generate AI response
+    session_id, chat_id, user_message, err = _parse_chat_request()
+    if err:
+        return err
+
+    # Wait for a model slot before saving anything, so a 429/503 leaves no unanswered message
     try:
-        if not chat_model:
-            raise RuntimeError("Gemini chat_model not initialized (missing API key?)")
-        agent_msg = chat_model.invoke(full_history)
-        agent_response = agent_msg.content
-    except Exception as e:
-        logging.error(
-            "[genai] Invocation failed. Model=%s, HasKey=%s, Error=%s\n%s",
-            GEMINI_MODEL,
-            bool(GEMINI_API_KEY),
-            str(e),
-            traceback.format_exc(),
-        )
-        agent_response = "Sorry, I am having trouble generating a response."
-        if DEBUG_GENAI:
-            # Include error detail in response for debugging (non-breaking: frontend ignores extra fields)
-            return jsonify({"response": agent_response, "error": str(e)}), 200
-
-    # Save AI response into the same location as user message
-    ai_doc = {"role": "assistant", "content": agent_response, "timestamp": datetime.utcnow()}
-    if wrote_new or convos_col.find_one({"_id": session_id}):
-        convos_col.update_one({"_id": session_id}, {"$push": {"messages": ai_doc}})
-    else:
-        conversations.update_one({"session_id": session_id}, {"$push": {"messages": ai_doc}})
+        slot = model_scheduler.acquire(_scheduler_uid(user))
+    except SchedulerBusy as e:
+        return _busy_response(e)
+
+    turn = None
+    try:
+        with slot:
+            turn = _save_user_message(session_id, chat_id, user_message)
+
+            # Serve repeated prompts from the response cache
+            key = _response_cache_key(turn.recent)
+            cached = response_cache.get(key) if key else None
+            if cached is not None:
+                slot.release()
+                _save_assistant_message(turn, cached)
+                return jsonify({"response": cached, "cached": True})
+
+            full_history = build_prompt(turn.recent, stats=prompt_stats)
+
+            # Generate AI response
+            try:
+                model = chat_model.get()
+                if not model:
+                    raise RuntimeError("Gemini chat_model not initialized (missing API key?)")
+                with STAGE_SECONDS.time("model"):
+                    agent_msg = model_calls.invoke(model, full_history)
+                agent_response = agent_msg.content or FALLBACK_REPLY
+                if key and agent_msg.content:
+                    response_cache.put(key, agent_response)
+            except Exception as e:
+                log_genai_failure(e)
+                agent_response = FALLBACK_REPLY
+                if DEBUG_GENAI:
+                    # Include error detail in response for debugging (non-breaking: frontend ignores extra fields)
+                    return jsonify({"response": agent_response, "error": str(e)}), 200
+
+        _save_assistant_message(turn, agent_response)
+    finally:
+        # Early returns and errors must not leave the reserved reply slot empty
+        _fill_unanswered(turn)
 
     return jsonify({"response": agent_response})
 
+# Streaming chat: same request body as /chat, reply delivered as Server-Sent Events.
+# Events: "delta" {"delta": str} per chunk, "error" {"message": str} on failure,
+# then "done" {"response": str} once the reply has been saved.
+@app.route("/chat/stream", methods=["POST"])
+def chat_stream():
+    # Enforce auth
+    user, err = _validate_auth_or_401()
+    if err:
+        return err
+
+    session_id, chat_id, user_message, err = _parse_chat_request()
+    if err:
+        return err
+
+    try:
+        slot = model_scheduler.acquire(_scheduler_uid(user))
+    except SchedulerBusy as e:
+        return _busy_response(e)
+    turn = None
+    try:
+        turn = _save_user_message(session_id, chat_id, user_message)
+        # Cache hits are sent as a single delta
+        key = _response_cache_key(turn.recent)
+        cached = response_cache.get(key) if key else None
+        if cached is not None:
+            slot.release()
+            _save_assistant_message(turn, cached)
+        else:
+            full_history = build_prompt(turn.recent, stats=prompt_stats)
+    except BaseException:
+        slot.release()
+        _fill_unanswered(turn)
+        raise
+
+    def generate():
+        if cached is not None:
+            yield sse("delta", {"delta": cached})
+            yield sse("done", {"response": cached, "cached": True})
+            return
+        parts = []
+        partial = True
+        upstream = None
+        started = time.perf_counter()
+        try:
+            try:
+                model = chat_model.get()
+                if not model:
+                    raise RuntimeError("Gemini chat_model not initialized (missing API key?)")
+                upstream = model.stream(full_history)
+                for chunk in upstream:
+                    text = chunk.content or ""
+                    if not text:
+                        continue
+                    parts.append(text)
+                    yield sse("delta", {"delta": text})
+                partial = False
+                if key and parts:
+                    response_cache.put(key, "".join(parts))
+            except Exception as e:
+                log_genai_failure(e)
+                payload = {"message": FALLBACK_REPLY}
+                if DEBUG_GENAI:
+                    payload["error"] = str(e)
+                yield sse("error", payload)
+                if not parts:
+                    parts = [FALLBACK_REPLY]
+                    partial = False
+        finally:
+            # Runs on normal completion and on client disconnect (GeneratorExit):
+            # close the upstream stream so the Gemini call is not left running.
+            if upstream is not None and hasattr(upstream, "close"):
+                upstream.close()
+            slot.release()
+            STAGE_SECONDS.observe(time.perf_counter() - started, "model_stream")
+            agent_response = "".join(parts)
+            if agent_response:
+                if partial:
+                    logging.info("[chat/stream] stream for session %s ended early; saving partial reply", session_id)
+                    _save_assistant_message(turn, agent_response, partial=True)
+                else:
+                    _save_assistant_message(turn, agent_response)
+            else:
+                _fill_unanswered(turn)
+        yield sse("done", {"response": agent_response})
+
+    def closed():
+        slot.release()
+        _fill_unanswered(turn)
+
+    response = Response(generate(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",  # stop reverse proxies from buffering the stream
+    })
+    # The generator's finally never runs if the client leaves before the first chunk
+    response.call_on_close(closed)
+    return response
+
 # Fetch conversation by session (now reads from new convos, falls back to legacy)
 @app.route("/messages/<session_id>", methods=["GET"])
 def get_messages(session_id):
@@ -236,37 +486,41 @@ def get_messages(session_id):
     user, err = _validate_auth_or_401()
     if err:
         return err
-    conversation_doc = convos_col.find_one({"_id": session_id})
-    if conversation_doc:
-        # Align response shape with previous handler
-        return jsonify({
-            "_id": conversation_doc.get("_id"),
-            "session_id": conversation_doc.get("_id"),
-            "chat_id": conversation_doc.get("chat_id"),
-            "created_at": conversation_doc.get("created_at"),
-            "messages": conversation_doc.get("messages", [])
-        })
-
-    # Fallback to legacy
-    legacy = conversations.find_one({"session_id": session_id})
-    if not legacy:
-        # New session → create it with Omaju's greeting in legacy for BC
-        greeting = {
-            "role": "assistant",
-            "content": "Hey! I am **Omaju**, your buddy for lone times. How may I help?",
-            "timestamp": datetime.utcnow()
-        }
-        conversations.insert_one({
+    # ?limit=N returns the latest N messages, then ?before=<next_before> pages back;
+    # ?since=<index> returns the messages from that index on, then ?since=<next_since>
+    try:
+        paging = message_page_args(request.args)
+    except PageError as e:
+        return jsonify({"success": False, "message": str(e)}), 400
+    # convos shape for convos sessions, the raw document for unmigrated legacy ones
+    conversation_doc = _load_session(session_id, paging)
+    if not conversation_doc:
+        # New session → create it (without a chat) with Omaju's greeting
+        greeting = message_doc("assistant", LEGACY_GREETING)
+        try:
+            store.create_session(session_id, None, [greeting])
+        except DuplicateKeyError:
+            # Created by a concurrent request
+            return jsonify(_load_session(session_id, paging))
+        created = {
             "session_id": session_id,
             "created_at": datetime.utcnow(),
-            "messages": [greeting]
-        })
-        return jsonify({
-            "session_id": session_id,
-            "created_at": datetime.utcnow().isoformat(),
-            "messages": [greeting]
-        })
-    return jsonify(legacy)
+            "messages": public_messages([greeting])
+        }
+        if paging:
+            # A forward sync continues after the greeting; a backward page has nothing older
+            if paging[2] is not None:
+                created["messages"] = created["messages"][paging[2]:]
+                created["next_since"] = 1
+            else:
+                created["next_before"] = None
+        return jsonify(created)
+    return jsonify(conversation_doc)
+
+def _load_session(session_id, paging):
+    if paging:
+        return store.get_session_page(session_id, *paging)
+    return store.get_session(session_id)
 
 # Clear a session's messages
 @app.route("/clear/<session_id>", methods=["POST"])
@@ -275,11 +529,19 @@ def clear_messages(session_id):
     user, err = _validate_auth_or_401()
     if err:
         return err
-    # Clear in both locations for safety
-    convos_col.delete_one({"_id": session_id})
+    # Clear in both locations for safety (the bucketed session is purged in the background)
+    store.delete_session(session_id)
     conversations.delete_one({"session_id": session_id})
     return jsonify({"message": f"Session {session_id} cleared!"})
 
+# Drop the caller's token from the validation cache (call on logout)
+@app.route("/auth/evict", methods=["POST"])
+def evict_token():
+    token = _bearer_token()
+    if not token:
+        return jsonify({"success": False, "message": "Access token required"}), 401
+    return jsonify({"success": True, "evicted": token_cache.evict(token)})
+
 # Health check
 @app.route("/health", methods=["GET"])
 def health():
@@ -289,14 +551,31 @@ def health():
     except Exception as e:
         mongo_status = f"disconnected ({str(e)})"
 
-    gemini_status = "configured" if GEMINI_API_KEY else "not configured"
+    gemini_status = "configured" if model_configured() else "not configured"
 
     return jsonify({
         "status": "healthy" if mongo_status == "connected" else "unhealthy",
         "mongodb": mongo_status,
         "genai": gemini_status,
-        "timestamp": datetime.utcnow().isoformat()
+        "auth_cache": token_cache.stats(),
+        "prompt": prompt_stats.stats(),
+        "response_cache": response_cache.stats() if response_cache else {"backend": "off"},
+        "write_behind": write_behind.stats() if write_behind else {"enabled": False},
+        "scheduler": model_scheduler.stats(),
+        "model_calls": model_calls.stats(),
+        "profiler": profiler.stats(),
+        "purger": purger.stats(),
+        "timestamp": datetime.utcnow()
     })
+# Readiness for load balancers and orchestrators: unlike /health it answers 503 until warm-up is done
+@app.route("/ready", methods=["GET"])
+def ready():
+    body = {**warmup.stats(), "startup": startup.stats()}
+    body["ready"] = body["ready"] or not warmup.started
+    if not body["ready"]:
+        return jsonify(body), 503, {"Retry-After": "1"}
+    return jsonify(body)
+
 @app.route("/api/health", methods=["GET"])
 def api_health():
     return health()
@@ -306,14 +585,18 @@ def api_health():
 def genai_health():
     """Attempt a minimal invocation to verify Gemini connectivity and model access."""
     info = {
+        "backend": MODEL_BACKEND,
         "model": GEMINI_MODEL,
         "has_key": bool(GEMINI_API_KEY),
-        "configured": bool(chat_model is not None),
     }
-    if not chat_model:
+    model = chat_model.get()
+    info["configured"] = model is not None
+    if not model:
         return jsonify({"ok": False, **info, "error": "chat_model is not initialized (missing API key?)"}), 200
     try:
-        probe = chat_model.invoke([HumanMessage(content="ping")])
+        from langchain_core.messages import HumanMessage
+
+        probe = model.invoke([HumanMessage(content="ping")])
         preview = (probe.content or "")[:120]
         return jsonify({"ok": True, **info, "preview": preview}), 200
     except Exception as e:
@@ -323,72 +606,13 @@ def genai_health():
 @app.route("/loader", methods=["GET"])
 def loader_page():
     """Simple HTML page that shows the Uiverse loader, useful to verify loader rendering from backend."""
-    html = """
-<!doctype html>
-<html lang="en">
-  <head>
-    <meta charset="utf-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1">
-    <title>Omaju Loader</title>
-    <style>
-      body { margin:0; height:100vh; display:flex; align-items:center; justify-content:center; background:#0b0b0b; color:#fff; }
-      /* From Uiverse.io by alexruix */
-      .loader {
-        position: relative;
-        width: 120px;
-        height: 90px;
-        margin: 0 auto;
-      }
-      .loader:before {
-        content: "";
-        position: absolute;
-        bottom: 30px;
-        left: 50px;
-        height: 30px;
-        width: 30px;
-        border-radius: 50%;
-        background: #2a9d8f;
-        animation: loading-bounce 0.5s ease-in-out infinite alternate;
-      }
-      .loader:after {
-        content: "";
-        position: absolute;
-        right: 0;
-        top: 0;
-        height: 7px;
-        width: 45px;
-        border-radius: 4px;
-        box-shadow: 0 5px 0 #f2f2f2, -35px 50px 0 #f2f2f2, -70px 95px 0 #f2f2f2;
-        animation: loading-step 1s ease-in-out infinite;
-      }
-      @keyframes loading-bounce {
-        0% { transform: scale(1, 0.7); }
-        40% { transform: scale(0.8, 1.2); }
-        60% { transform: scale(1, 1); }
-        100% { bottom: 140px; }
-      }
-      @keyframes loading-step {
-        0% {
-          box-shadow: 0 10px 0 rgba(0, 0, 0, 0),
-                      0 10px 0 #f2f2f2,
-                      -35px 50px 0 #f2f2f2,
-                      -70px 90px 0 #f2f2f2;
-        }
-        100% {
-          box-shadow: 0 10px 0 #f2f2f2,
-                      -35px 50px 0 #f2f2f2,
-                      -70px 90px 0 #f2f2f2,
-                      -70px 90px 0 rgba(0, 0, 0, 0);
-        }
-      }
-    </style>
-  </head>
-  <body>
-    <div class="loader"></div>
-  </body>
- </html>
-    """
-    return html, 200, {"Content-Type": "text/html; charset=utf-8"}
+    return LOADER_HTML, 200, {"Content-Type": "text/html; charset=utf-8"}
+
+def _keyset_page(col, query, field, limit, cursor, projection=None):
+    """One page of `query` newest first by `field`: {"items": [...], "next_cursor": str | None}."""
+    docs = list(col.find(keyset_filter(query, field, cursor), projection).sort(keyset_sort(field)).limit(limit + 1))
+    items, next_cursor = split_page(docs, field, limit)
+    return jsonify({"items": items, "next_cursor": next_cursor})
 
 @app.route("/chats/<uid>", methods=["GET"])
 def list_chats(uid):
@@ -400,7 +624,14 @@ def list_chats(uid):
     if mismatch:
         return mismatch
 
-    chats = list(chats_col.find({"uid": uid}).sort("updated_at", -1))
+    try:
+        paging = page_args(request.args)
+    except PageError as e:
+        return jsonify({"success": False, "message": str(e)}), 400
+    if paging:
+        return _keyset_page(chats_col, {"uid": uid, **NOT_DELETED}, "updated_at", *paging)
+
+    chats = list(chats_col.find({"uid": uid, **NOT_DELETED}).sort("updated_at", -1))
     # Normalize datetimes
     for c in chats:
         c["created_at"] = c.get("created_at")
@@ -414,7 +645,17 @@ def list_convos(chat_id):
     user, err = _validate_auth_or_401()
     if err:
         return err
-    convos = list(convos_col.find({"chat_id": chat_id}, {"messages": 0}).sort("created_at", -1))
+    try:
+        paging = page_args(request.args)
+    except PageError as e:
+        return jsonify({"success": False, "message": str(e)}), 400
+    # Sessions of a deleted chat stay until the purger gets to them
+    if chats_col.find_one({"_id": chat_id, **DELETED}, {"_id": 1}):
+        return jsonify({"items": [], "next_cursor": None} if paging else [])
+    query = {"chat_id": chat_id, **NOT_DELETED}
+    if paging:
+        return _keyset_page(convos_col, query, "created_at", *paging, projection=STORE_FIELDS)
+    convos = list(convos_col.find(query, STORE_FIELDS).sort("created_at", -1))
     return jsonify(convos)
 
 
@@ -425,30 +666,21 @@ def create_convo(chat_id):
     if err:
         return err
     # Ensure chat exists (optional)
-    chat = chats_col.find_one({"_id": chat_id})
+    chat = chats_col.find_one({"_id": chat_id, **NOT_DELETED})
     if not chat:
         return jsonify({"success": False, "message": "Chat not found"}), 404
 
     # Create new session id if not provided
     body = request.get_json(silent=True) or {}
-    session_id = body.get("session_id") or f"session_{int(datetime.utcnow().timestamp()*1000)}"
-    greeting = {
-        "role": "assistant",
-        "content": "Hey! I am Omaju, your buddy.",
-        "timestamp": datetime.utcnow()
-    }
-    convos_col.insert_one({
-        "_id": session_id,
-        "chat_id": chat_id,
-        "created_at": datetime.utcnow(),
-        "messages": [greeting]
-    })
+    session_id = body.get("session_id") or new_session_id()
+    greeting = message_doc("assistant", CONVO_GREETING)
+    store.create_session(session_id, chat_id, [greeting])
     chats_col.update_one({"_id": chat_id}, {"$set": {"updated_at": datetime.utcnow()}})
     return jsonify({
         "_id": session_id,
         "chat_id": chat_id,
-        "created_at": datetime.utcnow().isoformat(),
-        "messages": [greeting]
+        "created_at": datetime.utcnow(),
+        "messages": public_messages([greeting])
     }), 201
 
 
@@ -463,24 +695,10 @@ def append_messages(session_id):
     if not isinstance(msgs, list) or not msgs:
         return jsonify({"success": False, "message": "messages array required"}), 400
     # Normalize timestamps
-    normalized = []
-    for m in msgs:
-        if not (isinstance(m, dict) and m.get("role") and m.get("content")):
-            continue
-        ts = m.get("timestamp")
-        if isinstance(ts, str):
-            try:
-                # leave string; encoder will handle datetime only
-                pass
-            except Exception:
-                ts = datetime.utcnow()
-        elif not ts:
-            ts = datetime.utcnow()
-        normalized.append({"role": m["role"], "content": m["content"], "timestamp": ts})
+    normalized = normalize_messages(msgs)
     if not normalized:
         return jsonify({"success": False, "message": "no valid messages"}), 400
-    res = convos_col.update_one({"_id": session_id}, {"$push": {"messages": {"$each": normalized}}})
-    if res.matched_count == 0:
+    if not store.append_messages(session_id, normalized):
         return jsonify({"success": False, "message": "session not found"}), 404
     return jsonify({"success": True})
 
@@ -496,7 +714,7 @@ def create_chat(uid):
         return mismatch
     body = request.get_json(silent=True) or {}
     title = body.get("title") or "Untitled chat"
-    chat_id = body.get("chat_id") or f"chat_{int(datetime.utcnow().timestamp()*1000)}"
+    chat_id = body.get("chat_id") or new_chat_id()
     now = datetime.utcnow()
     doc = {"_id": chat_id, "uid": uid, "title": title, "created_at": now, "updated_at": now}
     chats_col.insert_one(doc)
@@ -510,15 +728,13 @@ def delete_chat(chat_id):
     if err:
         return err
     # Ensure chat exists and belongs to user
-    chat = chats_col.find_one({"_id": chat_id})
+    chat = chats_col.find_one({"_id": chat_id, **NOT_DELETED})
     if not chat:
         return jsonify({"success": False, "message": "Chat not found"}), 404
-    auth_uid = (user or {}).get("_id") or (user or {}).get("id") or (user or {}).get("uid")
-    if str(chat.get("uid")) != str(auth_uid):
+    if str(chat.get("uid")) != str(auth_uid(user)):
         return jsonify({"success": False, "message": "Forbidden"}), 403
-    # Delete chat and its convos
-    convos_col.delete_many({"chat_id": chat_id})
-    chats_col.delete_one({"_id": chat_id})
+    # Hide the chat now; the purger removes it with its convos and message buckets
+    chats_col.update_one({"_id": chat_id, **NOT_DELETED}, tombstone())
     return jsonify({"success": True})
 
 
@@ -528,8 +744,7 @@ def delete_convo(session_id):
     user, err = _validate_auth_or_401()
     if err:
         return err
-    res = convos_col.delete_one({"_id": session_id})
-    if res.deleted_count == 0:
+    if store.delete_session(session_id) == 0:
         return jsonify({"success": False, "message": "Session not found"}), 404
     return jsonify({"success": True})
 
@@ -540,11 +755,10 @@ def update_chat_title(chat_id):
     if err:
         return err
     # Ensure chat exists and belongs to user
-    chat = chats_col.find_one({"_id": chat_id})
+    chat = chats_col.find_one({"_id": chat_id, **NOT_DELETED})
     if not chat:
         return jsonify({"success": False, "message": "Chat not found"}), 404
-    auth_uid = (user or {}).get("_id") or (user or {}).get("id") or (user or {}).get("uid")
-    if str(chat.get("uid")) != str(auth_uid):
+    if str(chat.get("uid")) != str(auth_uid(user)):
         return jsonify({"success": False, "message": "Forbidden"}), 403
 
     body = request.get_json(silent=True) or {}
@@ -553,7 +767,7 @@ def update_chat_title(chat_id):
         return jsonify({"success": False, "message": "title is required"}), 400
 
     now = datetime.utcnow()
-    res = chats_col.update_one({"_id": chat_id}, {"$set": {"title": title, "updated_at": now}})
+    res = chats_col.update_one({"_id": chat_id, **NOT_DELETED}, {"$set": {"title": title, "updated_at": now}})
     if res.matched_count == 0:
         return jsonify({"success": False, "message": "Chat not found"}), 404
     updated = chats_col.find_one({"_id": chat_id})
@@ -566,6 +780,115 @@ def update_chat_title(chat_id):
         "updated_at": updated.get("updated_at"),
     })
 
+# Bulk export of a user's chats, sessions and messages, streamed as NDJSON (see backup)
+@app.route("/export/<uid>", methods=["GET"])
+def export_user(uid):
+    user, err = _validate_auth_or_401()
+    if err:
+        return err
+    mismatch = _require_uid_match(uid, user)
+    if mismatch:
+        return mismatch
+    compress = request.args.get("gzip", "").lower() in ("1", "true")
+    return Response(
+        ndjson_chunks(export_records(db, uid), compress),
+        mimetype="application/gzip" if compress else "application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{export_filename(uid, compress)}"'},
+    )
+
+@app.route("/import/<uid>", methods=["POST"])
+def import_user(uid):
+    user, err = _validate_auth_or_401()
+    if err:
+        return err
+    mismatch = _require_uid_match(uid, user)
+    if mismatch:
+        return mismatch
+    compressed = request.headers.get("Content-Encoding", "").lower() == "gzip"
+    try:
+        stats = import_lines(db, uid, iter_lines(request.stream, compressed))
+    except ImportFormatError as e:
+        return jsonify({"success": False, "message": str(e)}), 400
+    return jsonify({"success": True, **stats})
+
+@app.cli.command("migrate-buckets")
+@click.option("--batch", default=100, show_default=True, help="Sessions per progress report / cursor batch.")
+def migrate_buckets_command(batch):
+    """Move embedded message arrays (convos and legacy conversations) into buckets."""
+    store.ensure_bucket_index()
+    converted = store.migrate_all(batch=batch, progress=click.echo)
+    click.echo(f"[migrate] converted {converted} sessions")
+
+@app.cli.command("purge")
+def purge_command():
+    """Remove deleted chats and sessions now instead of waiting for the background purger."""
+    handled = purger.drain()
+    click.echo(f"[purge] {handled} chats/sessions purged: {purger.stats()['deleted']}")
+
+@app.cli.command("export-user")
+@click.argument("uid")
+@click.option("-o", "--output", default="-", show_default=True, help="File to write (gzip if it ends in .gz).")
+def export_user_command(uid, output):
+    """Write a user's chats, sessions and messages as NDJSON."""
+    compress = output.endswith(".gz")
+    with (open(output, "wb") if output != "-" else nullcontext(click.get_binary_stream("stdout"))) as out:
+        for chunk in ndjson_chunks(export_records(db, uid), compress):
+            out.write(chunk)
+
+@app.cli.command("import-user")
+@click.argument("uid")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+def import_user_command(uid, path):
+    """Import an NDJSON export (gzip if it ends in .gz) into a user's account."""
+    with open(path, "rb") as f:
+        try:
+            stats = import_lines(db, uid, iter_lines(f, path.endswith(".gz")))
+        except ImportFormatError as e:
+            raise click.ClickException(str(e))
+    click.echo(f"[import] imported {stats['imported']}, skipped existing {stats['skipped']}")
+
+@app.cli.command("ensure-indexes")
+def ensure_indexes_command():
+    """Create the indexes the routes rely on (no-op for existing ones)."""
+    for name, indexes in ensure_indexes(db).items():
+        click.echo(f"[indexes] {name}: {', '.join(indexes)}")
+
+@app.cli.command("explain-queries")
+def explain_queries_command():
+    """Explain each route's query and flag collection scans and in-memory sorts."""
+    flagged = 0
+    for row in explain_queries(db):
+        status = "FLAGGED " + "+".join(row["flagged"]) if row["flagged"] else "ok"
+        click.echo(f"{row['route']:<40} {row['collection']:<14} {status:<22} {' > '.join(row['stages'])}")
+        flagged += bool(row["flagged"])
+    if flagged:
+        raise click.ClickException(f"{flagged} queries are not covered by an index (run ensure-indexes)")
+
+# ============ Startup ============
+
+def _import_langchain():
+    import langchain_core.messages  # noqa: F401  (otherwise the first build_prompt pays for it)
+
+def _ensure_indexes_in_background():
+    try:
+        ensure_indexes(db)
+    except Exception as e:
+        logging.warning("[indexes] could not ensure indexes: %s", e)
+
+# Slow initialization runs in the background so the port is bound right away; /ready reports it
+warmup = WarmUp(startup)
+warmup.add("langchain", _import_langchain)
+warmup.add("model", chat_model.get)
+warmup.add("mongo", lambda: client.admin.command("ping"))
+if STARTUP_WARMUP:
+    if ENSURE_INDEXES:
+        warmup.add("indexes", lambda: ensure_indexes(db), required=False)
+    warmup.start()
+elif ENSURE_INDEXES:
+    # Without the warm-up the indexes are still built, in a thread of their own
+    threading.Thread(target=_ensure_indexes_in_background, name="ensure-indexes", daemon=True).start()
+startup.record("module", time.perf_counter() - _import_started)
+
 if __name__ == "__main__":
     PORT = int(os.environ.get("PORT", 5000))  # Use Render’s port, fallback to 5000 locally
     app.run(host="0.0.0.0", port=PORT, debug=True)
@@ -0,0 +1,788 @@
+"""Async serving mode for the Omaju backend.
+
+Serves the same routes and response shapes as app.py, but every slow call is
+non-blocking: httpx for the auth service, Motor for MongoDB and
+ainvoke/astream for Gemini. A single process can therefore hold many
+in-flight chats instead of one per worker thread.
+
+Run with an ASGI server, for example:
+
+    hypercorn asgi_app:app --bind 0.0.0.0:5000
+"""
+import asyncio
+import logging
+import os
+import time
+import weakref
+from datetime import datetime
+
+import httpx
+from langchain_core.messages import HumanMessage
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import DuplicateKeyError
+from quart import Quart, Response, g, jsonify, request
+from quart.json.provider import JSONProvider as BaseJSONProvider
+from quart_cors import cors
+
+from auth_cache import TokenCache
+from json_provider import FastJSONMixin
+from llm_scheduler import ModelScheduler, SchedulerBusy
+from metrics import (
+    CONTENT_TYPE, ERRORS, IN_FLIGHT, REGISTRY, REQUEST_SECONDS, REQUESTS, STAGE_SECONDS, MongoCommandMetrics,
+    route_label, timed,
+)
+from context_builder import PromptStats
+from response_cache import cache_key, create_response_cache
+from pagination import PageError, keyset_filter, keyset_sort, message_page_args, page_args, split_page
+from indexes import aensure_indexes
+from convo_store import (
+    CHAT_TOUCH_INTERVAL, STORE_FIELDS, WRITE_BEHIND, AsyncConvoStore, ChatTouchBatcher, MessageWriteBehind,
+    public_messages,
+)
+from backup import ImportFormatError, aexport_records, aimport_lines, aiter_lines, andjson_chunks, export_filename
+from purger import DELETED, NOT_DELETED, PURGE_WORKER, Purger, tombstone
+from chat_core import (
+    AUTH_API_BASE, AUTH_CACHE_MAX_ENTRIES, AUTH_CACHE_NEGATIVE_TTL, AUTH_CACHE_TTL, AUTH_POOL_SIZE,
+    CONVO_GREETING, CORS_ALLOW_HEADERS, CORS_EXPOSE_HEADERS, CORS_METHODS, CORS_ORIGINS, DB_NAME,
+    DEBUG_GENAI, ENSURE_INDEXES, FALLBACK_REPLY, GEMINI_API_KEY, GEMINI_MODEL, IDENTITY_PROMPT,
+    LEGACY_GREETING, LOADER_HTML, MODEL_BACKEND, MONGO_URI, RESPONSE_CACHE, RESPONSE_CACHE_HISTORY,
+    RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL, SCHEDULER_MAX_IN_FLIGHT, SCHEDULER_MAX_QUEUE,
+    SCHEDULER_MAX_QUEUE_PER_USER, SCHEDULER_MAX_WAIT, SCHEDULER_RETRY_AFTER, auth_uid, build_prompt,
+    create_chat_model, create_model_call_policy, log_genai_failure, message_doc, model_configured,
+    new_chat_id, new_session_id, normalize_messages, sse,
+)
+
+logging.basicConfig(level=logging.INFO)
+
+
+class JSONProvider(FastJSONMixin, BaseJSONProvider):
+    """Same encoding as app.py (orjson when installed, ObjectIds and ISO datetimes)."""
+
+    def response(self, *args, **kwargs):
+        with STAGE_SECONDS.time("serialization"):
+            return super().response(*args, **kwargs)
+
+
+app = Quart(__name__)
+app.json = JSONProvider(app)
+app = cors(
+    app,
+    allow_origin=CORS_ORIGINS,
+    allow_credentials=True,
+    allow_headers=CORS_ALLOW_HEADERS,
+    expose_headers=CORS_EXPOSE_HEADERS,
+    allow_methods=CORS_METHODS,
+)
+
+chat_model = create_chat_model()
+
+token_cache = TokenCache(
+    ttl=AUTH_CACHE_TTL,
+    negative_ttl=AUTH_CACHE_NEGATIVE_TTL,
+    max_entries=AUTH_CACHE_MAX_ENTRIES,
+)
+prompt_stats = PromptStats()
+# Deadline, retries and hedging around the /chat model call
+model_calls = create_model_call_policy()
+model_scheduler = ModelScheduler(
+    max_in_flight=SCHEDULER_MAX_IN_FLIGHT,
+    max_queue_per_user=SCHEDULER_MAX_QUEUE_PER_USER,
+    max_queue=SCHEDULER_MAX_QUEUE,
+    max_wait=SCHEDULER_MAX_WAIT,
+    retry_after=SCHEDULER_RETRY_AFTER,
+)
+response_cache = create_response_cache(
+    RESPONSE_CACHE,
+    ttl=RESPONSE_CACHE_TTL,
+    max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+)
+
+# Motor and httpx clients bind to the serving event loop, so they are created at startup
+mongo_client = None
+conversations = None
+chats_col = None
+convos_col = None
+store = None
+purger = None
+auth_http = None
+
+chat_touches = ChatTouchBatcher()
+write_behind = MessageWriteBehind() if WRITE_BEHIND else None
+
+
+async def _flush_chat_touches():
+    while True:
+        await asyncio.sleep(CHAT_TOUCH_INTERVAL)
+        try:
+            await chat_touches.aflush(chats_col)
+        except Exception as e:
+            logging.warning("[store] chat touch flush failed: %s", e)
+
+
+async def _flush_messages():
+    while True:
+        await write_behind.wait_due()
+        try:
+            await write_behind.aflush(store.buckets)
+        except Exception as e:
+            logging.warning("[store] message write-behind flush failed: %s", e)
+
+
+@app.before_serving
+async def _open_clients():
+    global mongo_client, conversations, chats_col, convos_col, store, purger, auth_http
+    mongo_client = AsyncIOMotorClient(MONGO_URI, event_listeners=[MongoCommandMetrics()])
+    db = mongo_client[DB_NAME]
+    conversations = db["conversations"]
+    chats_col = db["chats"]
+    convos_col = db["convos"]
+    store = AsyncConvoStore(db, write_behind=write_behind)
+    purger = Purger(db, write_behind=write_behind)
+    if ENSURE_INDEXES:
+        try:
+            await aensure_indexes(db)
+        except Exception as e:
+            logging.warning("[indexes] could not ensure indexes: %s", e)
+    auth_http = httpx.AsyncClient(
+        timeout=5,
+        limits=httpx.Limits(max_connections=AUTH_POOL_SIZE * 4, max_keepalive_connections=AUTH_POOL_SIZE),
+    )
+    app.chat_touch_task = asyncio.create_task(_flush_chat_touches())
+    if write_behind is not None:
+        app.write_behind_task = asyncio.create_task(_flush_messages())
+    if PURGE_WORKER:
+        app.purge_task = asyncio.create_task(purger.arun())
+
+
+@app.after_serving
+async def _close_clients():
+    app.chat_touch_task.cancel()
+    if PURGE_WORKER:
+        app.purge_task.cancel()
+    await chat_touches.aflush(chats_col)
+    if write_behind is not None:
+        app.write_behind_task.cancel()
+        await write_behind.aflush(store.buckets)
+    await auth_http.aclose()
+    mongo_client.close()
+
+
+REGISTRY.callback("omaju_model_in_flight", "Model calls holding a scheduler slot",
+                  lambda: model_scheduler.stats()["in_flight"])
+REGISTRY.callback("omaju_model_queued", "Requests waiting for a model slot", lambda: model_scheduler.stats()["queued"])
+REGISTRY.callback("omaju_write_behind_pending", "Messages queued by write-behind",
+                  lambda: write_behind.stats()["queued"] if write_behind else 0)
+
+
+@app.before_request
+async def _metrics_begin():
+    g.metrics_started = time.perf_counter()
+    IN_FLIGHT.inc()
+
+
+@app.after_request
+async def _metrics_record(response):
+    started = g.pop("metrics_started", None)
+    if started is not None:
+        route = route_label(request.url_rule)
+        REQUEST_SECONDS.observe(time.perf_counter() - started, route, request.method)
+        REQUESTS.inc(route, request.method, response.status_code)
+    return response
+
+
+@app.teardown_request
+async def _metrics_end(exc):
+    IN_FLIGHT.dec()
+    if exc is not None:
+        ERRORS.inc("request", type(exc).__name__)
+
+
+@app.route("/metrics", methods=["GET"])
+async def metrics():
+    return REGISTRY.render(), 200, {"Content-Type": CONTENT_TYPE}
+
+
+def _bearer_token():
+    auth_header = request.headers.get("Authorization", "")
+    if not auth_header.startswith("Bearer "):
+        return None
+    return auth_header.split(" ", 1)[1]
+
+
+@timed("auth")
+async def _validate_auth_or_401():
+    """Async twin of app._validate_auth_or_401, sharing the same cache policy.
+    Returns (user_json | None, error_response | None)
+    """
+    token = _bearer_token()
+    if not token:
+        return None, (jsonify({"success": False, "message": "Access token required"}), 401)
+    found, valid, cached_user = token_cache.get(token)
+    if found:
+        if valid:
+            return cached_user, None
+        return None, (jsonify({"success": False, "message": "Invalid or expired token"}), 401)
+    try:
+        resp = await auth_http.get(f"{AUTH_API_BASE}/profile", headers={
+            "Authorization": f"Bearer {token}",
+            "Content-Type": "application/json",
+        })
+        if resp.status_code != 200:
+            logging.info("[auth] profile failed %s %s", resp.status_code, resp.text)
+            if resp.status_code in (401, 403):
+                token_cache.put_negative(token)
+            return None, (jsonify({"success": False, "message": "Invalid or expired token"}), 401)
+        user = resp.json().get("data", {}).get("user")
+        token_cache.put(token, user)
+        return user, None
+    except Exception as e:
+        logging.warning("[auth] error contacting auth service: %s", e)
+        ERRORS.inc("auth", type(e).__name__)
+        return None, (jsonify({"success": False, "message": "Auth service unavailable"}), 503)
+
+
+def _require_uid_match(uid_from_path, user_obj):
+    if not user_obj:
+        return (jsonify({"success": False, "message": "Unauthorized"}), 401)
+    if str(uid_from_path) != str(auth_uid(user_obj)):
+        return (jsonify({"success": False, "message": "Forbidden"}), 403)
+    return None
+
+
+@app.route("/")
+async def home():
+    return jsonify({"message": "Welcome to Flask Backend!"})
+
+
+# ============ Chat ============
+
+async def _parse_chat_request():
+    data = await request.get_json()
+    session_id = data.get("session_id")
+    chat_id = data.get("chat_id")
+    user_message = data.get("message")
+    if not session_id or not user_message:
+        return None, None, None, (jsonify({"error": "session_id and message are required"}), 400)
+    return session_id, chat_id, user_message, None
+
+
+async def _save_user_message(session_id, chat_id, user_message):
+    user_doc = message_doc("user", user_message)
+    turn = await store.append_user_message(session_id, chat_id, user_doc)
+    if chat_id:
+        chat_touches.touch(chat_id)
+    return turn
+
+
+async def _save_assistant_message(turn, agent_response, **extra):
+    ai_doc = message_doc("assistant", agent_response, **extra)
+    await store.append_reply(turn, ai_doc)
+
+
+async def _fill_unanswered(turn):
+    """Save the fallback reply into a reply slot nothing else filled (see app.py)."""
+    if turn is None or turn.replied:
+        return
+    try:
+        await _save_assistant_message(turn, FALLBACK_REPLY)
+    except Exception:
+        logging.exception("[chat] could not fill the reply slot of session %s", turn.session_id)
+
+
+# Fills scheduled from weakref finalizers; referenced here until they finish
+_fill_tasks = set()
+
+
+def _fill_dropped(loop, turn):
+    """Finalizer-safe _fill_unanswered: schedules it on `loop` from any thread."""
+    def spawn():
+        task = loop.create_task(_fill_unanswered(turn))
+        _fill_tasks.add(task)
+        task.add_done_callback(_fill_tasks.discard)
+    if turn.replied:
+        return
+    try:
+        loop.call_soon_threadsafe(spawn)
+    except RuntimeError:
+        # Loop already closed (shutdown); the slot stays empty and paging skips it
+        pass
+
+
+async def _response_cache_key(recent_msgs):
+    """Cache key for this turn, or None when the cache is off or bypassed (see app.py)."""
+    if response_cache is None:
+        return None
+    if "no-cache" in request.headers.get("Cache-Control", "").lower():
+        return None
+    if (await request.get_json(silent=True) or {}).get("cache") is False:
+        return None
+    return cache_key(IDENTITY_PROMPT, recent_msgs, RESPONSE_CACHE_HISTORY)
+
+
+def _scheduler_uid(user):
+    return str(auth_uid(user) or "anonymous")
+
+
+def _busy_response(e):
+    """429/503 with Retry-After when no model slot is available."""
+    body = {"success": False, "message": e.reason, "retry_after": e.retry_after}
+    return jsonify(body), e.status, {"Retry-After": str(e.retry_after)}
+
+
+def _wants_event_stream():
+    best = request.accept_mimetypes.best_match(["application/json", "text/event-stream"])
+    return best == "text/event-stream"
+
+
+@app.route("/chat", methods=["POST"])
+async def chat():
+    if _wants_event_stream():
+        return await chat_stream()
+
+    user, err = await _validate_auth_or_401()
+    if err:
+        return err
+
+    session_id, chat_id, user_message, err = await _parse_chat_request()
+    if err:
+        return err
+
+    try:
+        slot = await model_scheduler.aacquire(_scheduler_uid(user))
+    except SchedulerBusy as e:
+        return _busy_response(e)
+
+    turn = None
+    try:
+        with slot:
+            turn = await _save_user_message(session_id, chat_id, user_message)
+
+            key = await _response_cache_key(turn.recent)
+            cached = response_cache.get(key) if key else None
+            if cached is not None:
+                slot.release()
+                await _save_assistant_message(turn, cached)
+                return jsonify({"response": cached, "cached": True})
+
+            full_history = build_prompt(turn.recent, stats=prompt_stats)
+
+            try:
+                if not chat_model:
+                    raise RuntimeError("Gemini chat_model not initialized (missing API key?)")
+                with STAGE_SECONDS.time("model"):
+                    agent_msg = await model_calls.ainvoke(chat_model, full_history)
+                agent_response = agent_msg.content or FALLBACK_REPLY
+                if key and agent_msg.content:
+                    response_cache.put(key, agent_response)
+            except Exception as e:
+                log_genai_failure(e)
+                agent_response = FALLBACK_REPLY
+                if DEBUG_GENAI:
+                    return jsonify({"response": agent_response, "error": str(e)}), 200
+
+        await _save_assistant_message(turn, agent_response)
+    finally:
+        await _fill_unanswered(turn)
+    return jsonify({"response": agent_response})
+
+
+@app.route("/chat/stream", methods=["POST"])
+async def chat_stream():
+    user, err = await _validate_auth_or_401()
+    if err:
+        return err
+
+    session_id, chat_id, user_message, err = await _parse_chat_request()
+    if err:
+        return err
+
+    try:
+        slot = await model_scheduler.aacquire(_scheduler_uid(user))
+    except SchedulerBusy as e:
+        return _busy_response(e)
+    turn = None
+    try:
+        turn = await _save_user_message(session_id, chat_id, user_message)
+        key = await _response_cache_key(turn.recent)
+        cached = response_cache.get(key) if key else None
+        if cached is not None:
+            slot.release()
+            await _save_assistant_message(turn, cached)
+        else:
+            full_history = build_prompt(turn.recent, stats=prompt_stats)
+    except BaseException:
+        slot.release()
+        await _fill_unanswered(turn)
+        raise
+
+    async def generate():
+        if cached is not None:
+            yield sse("delta", {"delta": cached})
+            yield sse("done", {"response": cached, "cached": True})
+            return
+        parts = []
+        partial = True
+        upstream = None
+        started = time.perf_counter()
+        try:
+            try:
+                if not chat_model:
+                    raise RuntimeError("Gemini chat_model not initialized (missing API key?)")
+                upstream = chat_model.astream(full_history)
+                async for chunk in upstream:
+                    text = chunk.content or ""
+                    if not text:
+                        continue
+                    parts.append(text)
+                    yield sse("delta", {"delta": text})
+                partial = False
+                if key and parts:
+                    response_cache.put(key, "".join(parts))
+            except Exception as e:
+                log_genai_failure(e)
+                payload = {"message": FALLBACK_REPLY}
+                if DEBUG_GENAI:
+                    payload["error"] = str(e)
+                yield sse("error", payload)
+                if not parts:
+                    parts = [FALLBACK_REPLY]
+                    partial = False
+        finally:
+            # Also runs when the client goes away and the server cancels this generator
+            if upstream is not None:
+                await upstream.aclose()
+            slot.release()
+            STAGE_SECONDS.observe(time.perf_counter() - started, "model_stream")
+            agent_response = "".join(parts)
+            if agent_response:
+                if partial:
+                    logging.info("[chat/stream] stream for session %s ended early; saving partial reply", session_id)
+                    await _save_assistant_message(turn, agent_response, partial=True)
+                else:
+                    await _save_assistant_message(turn, agent_response)
+            else:
+                await _fill_unanswered(turn)
+        yield sse("done", {"response": agent_response})
+
+    loop = asyncio.get_running_loop()
+
+    def dropped():
+        slot.release()
+        _fill_dropped(loop, turn)
+
+    body = generate()
+    # A generator that never starts never runs its finally; release the slot
+    # and fill the reply slot when it is dropped
+    weakref.finalize(body, dropped)
+    response = Response(body, mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+    response.timeout = None  # generation can outlive Quart's default response timeout
+    return response
+
+
+@app.route("/messages/<session_id>", methods=["GET"])
+async def get_messages(session_id):
+    user, err = await _validate_auth_or_401()
+    if err:
+        return err
+    try:
+        paging = message_page_args(request.args)
+    except PageError as e:
+        return jsonify({"success": False, "message": str(e)}), 400
+    conversation_doc = await _load_session(session_id, paging)
+    if not conversation_doc:
+        greeting = message_doc("assistant", LEGACY_GREETING)
+        try:
+            await store.create_session(session_id, None, [greeting])
+        except DuplicateKeyError:
+            return jsonify(await _load_session(session_id, paging))
+        created = {
+            "session_id": session_id,
+            "created_at": datetime.utcnow(),
+            "messages": public_messages([greeting])
+        }
+        if paging:
+            # A forward sync continues after the greeting; a backward page has nothing older
+            if paging[2] is not None:
+                created["messages"] = created["messages"][paging[2]:]
+                created["next_since"] = 1
+            else:
+                created["next_before"] = None
+        return jsonify(created)
+    return jsonify(conversation_doc)
+
+
+async def _load_session(session_id, paging):
+    if paging:
+        return await store.get_session_page(session_id, *paging)
+    return await store.get_session(session_id)
+
+
+@app.route("/clear/<session_id>", methods=["POST"])
+async def clear_messages(session_id):
+    user, err = await _validate_auth_or_401()
+    if err:
+        return err
+    await store.delete_session(session_id)
+    await conversations.delete_one({"session_id": session_id})
+    return jsonify({"message": f"Session {session_id} cleared!"})
+
+
+@app.route("/auth/evict", methods=["POST"])
+async def evict_token():
+    token = _bearer_token()
+    if not token:
+        return jsonify({"success": False, "message": "Access token required"}), 401
+    return jsonify({"success": True, "evicted": token_cache.evict(token)})
+
+
+# ============ Health ============
+
+@app.route("/health", methods=["GET"])
+async def health():
+    try:
+        await mongo_client.admin.command('ping')
+        mongo_status = "connected"
+    except Exception as e:
+        mongo_status = f"disconnected ({str(e)})"
+
+    return jsonify({
+        "status": "healthy" if mongo_status == "connected" else "unhealthy",
+        "mongodb": mongo_status,
+        "genai": "configured" if model_configured() else "not configured",
+        "auth_cache": token_cache.stats(),
+        "prompt": prompt_stats.stats(),
+        "response_cache": response_cache.stats() if response_cache else {"backend": "off"},
+        "write_behind": write_behind.stats() if write_behind else {"enabled": False},
+        "scheduler": model_scheduler.stats(),
+        "model_calls": model_calls.stats(),
+        "purger": purger.stats() if purger else None,
+        "timestamp": datetime.utcnow()
+    })
+
+
+@app.route("/api/health", methods=["GET"])
+async def api_health():
+    return await health()
+
+
+@app.route("/genai/health", methods=["GET"])
+async def genai_health():
+    info = {
+        "backend": MODEL_BACKEND,
+        "model": GEMINI_MODEL,
+        "has_key": bool(GEMINI_API_KEY),
+        "configured": bool(chat_model is not None),
+    }
+    if not chat_model:
+        return jsonify({"ok": False, **info, "error": "chat_model is not initialized (missing API key?)"}), 200
+    try:
+        probe = await chat_model.ainvoke([HumanMessage(content="ping")])
+        preview = (probe.content or "")[:120]
+        return jsonify({"ok": True, **info, "preview": preview}), 200
+    except Exception as e:
+        logging.exception("[genai] Health probe failed: %s", e)
+        return jsonify({"ok": False, **info, "error": str(e)}), 200
+
+
+@app.route("/loader", methods=["GET"])
+async def loader_page():
+    return LOADER_HTML, 200, {"Content-Type": "text/html; charset=utf-8"}
+
+
+# ============ Chats and convos ============
+
+async def _keyset_page(col, query, field, limit, cursor, projection=None):
+    docs = col.find(keyset_filter(query, field, cursor), projection).sort(keyset_sort(field)).limit(limit + 1)
+    items, next_cursor = split_page(await docs.to_list(None), field, limit)
+    return jsonify({"items": items, "next_cursor": next_cursor})
+
+
+@app.route("/chats/<uid>", methods=["GET"])
+async def list_chats(uid):
+    user, err = await _validate_auth_or_401()
+    if err:
+        return err
+    mismatch = _require_uid_match(uid, user)
+    if mismatch:
+        return mismatch
+    try:
+        paging = page_args(request.args)
+    except PageError as e:
+        return jsonify({"success": False, "message": str(e)}), 400
+    if paging:
+        return await _keyset_page(chats_col, {"uid": uid, **NOT_DELETED}, "updated_at", *paging)
+    chats = await chats_col.find({"uid": uid, **NOT_DELETED}).sort("updated_at", -1).to_list(None)
+    return jsonify(chats)
+
+
+@app.route("/convos/<chat_id>", methods=["GET"])
+async def list_convos(chat_id):
+    user, err = await _validate_auth_or_401()
+    if err:
+        return err
+    try:
+        paging = page_args(request.args)
+    except PageError as e:
+        return jsonify({"success": False, "message": str(e)}), 400
+    if await chats_col.find_one({"_id": chat_id, **DELETED}, {"_id": 1}):
+        return jsonify({"items": [], "next_cursor": None} if paging else [])
+    query = {"chat_id": chat_id, **NOT_DELETED}
+    if paging:
+        return await _keyset_page(convos_col, query, "created_at", *paging, projection=STORE_FIELDS)
+    convos = await convos_col.find(query, STORE_FIELDS).sort("created_at", -1).to_list(None)
+    return jsonify(convos)
+
+
+@app.route("/convos/<chat_id>", methods=["POST"])
+async def create_convo(chat_id):
+    user, err = await _validate_auth_or_401()
+    if err:
+        return err
+    chat = await chats_col.find_one({"_id": chat_id, **NOT_DELETED})
+    if not chat:
+        return jsonify({"success": False, "message": "Chat not found"}), 404
+
+    body = await request.get_json(silent=True) or {}
+    session_id = body.get("session_id") or new_session_id()
+    greeting = message_doc("assistant", CONVO_GREETING)
+    await store.create_session(session_id, chat_id, [greeting])
+    await chats_col.update_one({"_id": chat_id}, {"$set": {"updated_at": datetime.utcnow()}})
+    return jsonify({
+        "_id": session_id,
+        "chat_id": chat_id,
+        "created_at": datetime.utcnow(),
+        "messages": public_messages([greeting])
+    }), 201
+
+
+@app.route("/convos/<session_id>/messages", methods=["PATCH"])
+async def append_messages(session_id):
+    user, err = await _validate_auth_or_401()
+    if err:
+        return err
+    body = await request.get_json() or {}
+    msgs = body.get("messages", [])
+    if not isinstance(msgs, list) or not msgs:
+        return jsonify({"success": False, "message": "messages array required"}), 400
+    normalized = normalize_messages(msgs)
+    if not normalized:
+        return jsonify({"success": False, "message": "no valid messages"}), 400
+    if not await store.append_messages(session_id, normalized):
+        return jsonify({"success": False, "message": "session not found"}), 404
+    return jsonify({"success": True})
+
+
+@app.route("/chats/<uid>", methods=["POST"])
+async def create_chat(uid):
+    user, err = await _validate_auth_or_401()
+    if err:
+        return err
+    mismatch = _require_uid_match(uid, user)
+    if mismatch:
+        return mismatch
+    body = await request.get_json(silent=True) or {}
+    title = body.get("title") or "Untitled chat"
+    chat_id = body.get("chat_id") or new_chat_id()
+    now = datetime.utcnow()
+    doc = {"_id": chat_id, "uid": uid, "title": title, "created_at": now, "updated_at": now}
+    await chats_col.insert_one(doc)
+    return jsonify(doc), 201
+
+
+async def _owned_chat_or_error(chat_id, user):
+    chat = await chats_col.find_one({"_id": chat_id, **NOT_DELETED})
+    if not chat:
+        return None, (jsonify({"success": False, "message": "Chat not found"}), 404)
+    if str(chat.get("uid")) != str(auth_uid(user)):
+        return None, (jsonify({"success": False, "message": "Forbidden"}), 403)
+    return chat, None
+
+
+@app.route("/chats/<chat_id>", methods=["DELETE"])
+async def delete_chat(chat_id):
+    user, err = await _validate_auth_or_401()
+    if err:
+        return err
+    chat, err = await _owned_chat_or_error(chat_id, user)
+    if err:
+        return err
+    await chats_col.update_one({"_id": chat_id, **NOT_DELETED}, tombstone())
+    return jsonify({"success": True})
+
+
+@app.route("/convos/<session_id>", methods=["DELETE"])
+async def delete_convo(session_id):
+    user, err = await _validate_auth_or_401()
+    if err:
+        return err
+    if await store.delete_session(session_id) == 0:
+        return jsonify({"success": False, "message": "Session not found"}), 404
+    return jsonify({"success": True})
+
+
+@app.route("/chats/<chat_id>", methods=["PATCH"])
+async def update_chat_title(chat_id):
+    user, err = await _validate_auth_or_401()
+    if err:
+        return err
+    chat, err = await _owned_chat_or_error(chat_id, user)
+    if err:
+        return err
+
+    body = await request.get_json(silent=True) or {}
+    title = (body.get("title") or "").strip()
+    if not title:
+        return jsonify({"success": False, "message": "title is required"}), 400
+
+    now = datetime.utcnow()
+    res = await chats_col.update_one({"_id": chat_id, **NOT_DELETED}, {"$set": {"title": title, "updated_at": now}})
+    if res.matched_count == 0:
+        return jsonify({"success": False, "message": "Chat not found"}), 404
+    updated = await chats_col.find_one({"_id": chat_id})
+    return jsonify({
+        "_id": updated.get("_id"),
+        "uid": updated.get("uid"),
+        "title": updated.get("title"),
+        "created_at": updated.get("created_at"),
+        "updated_at": updated.get("updated_at"),
+    })
+
+
+@app.route("/export/<uid>", methods=["GET"])
+async def export_user(uid):
+    user, err = await _validate_auth_or_401()
+    if err:
+        return err
+    mismatch = _require_uid_match(uid, user)
+    if mismatch:
+        return mismatch
+    compress = request.args.get("gzip", "").lower() in ("1", "true")
+    return Response(
+        andjson_chunks(aexport_records(mongo_client[DB_NAME], uid), compress),
+        mimetype="application/gzip" if compress else "application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{export_filename(uid, compress)}"'},
+    )
+
+
+@app.route("/import/<uid>", methods=["POST"])
+async def import_user(uid):
+    user, err = await _validate_auth_or_401()
+    if err:
+        return err
+    mismatch = _require_uid_match(uid, user)
+    if mismatch:
+        return mismatch
+    compressed = request.headers.get("Content-Encoding", "").lower() == "gzip"
+    try:
+        stats = await aimport_lines(mongo_client[DB_NAME], uid, aiter_lines(request.body, compressed))
+    except ImportFormatError as e:
+        return jsonify({"success": False, "message": str(e)}), 400
+    return jsonify({"success": True, **stats})
+
+
+if __name__ == "__main__":
+    PORT = int(os.environ.get("PORT", 5000))
+    app.run(host="0.0.0.0", port=PORT)
@@ -0,0 +1,96 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+
+class TokenCache:
+    """Bounded TTL cache of bearer-token validation results.
+
+    Tokens are never stored in clear text; entries are keyed by the SHA-256 of
+    the token. Successful validations live for ``ttl`` seconds, rejected tokens
+    for ``negative_ttl`` seconds, and the least recently used entry is dropped
+    once ``max_entries`` is reached.
+    """
+
+    def __init__(self, ttl: float = 60.0, negative_ttl: float = 5.0, max_entries: int = 10000):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[float, bool, Optional[Dict[str, Any]]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key_for(token: str) -> str:
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+    def get(self, token: str) -> Tuple[bool, bool, Optional[Dict[str, Any]]]:
+        """Look up a token.
+
+        Returns (found, valid, user). ``found`` is False on a miss or an expired
+        entry; ``valid`` is False for a cached rejection.
+        """
+        key = self.key_for(token)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return False, False, None
+            expires_at, valid, user = entry
+            if expires_at <= now:
+                del self._entries[key]
+                self.misses += 1
+                return False, False, None
+            self._entries.move_to_end(key)
+            if valid:
+                self.hits += 1
+            else:
+                self.negative_hits += 1
+            return True, valid, user
+
+    def put(self, token: str, user: Optional[Dict[str, Any]]):
+        """Cache a successful validation for ``token``."""
+        self._store(token, True, user, self.ttl)
+
+    def put_negative(self, token: str):
+        """Cache a rejection for ``token`` for the (short) negative TTL."""
+        self._store(token, False, None, self.negative_ttl)
+
+    def _store(self, token: str, valid: bool, user: Optional[Dict[str, Any]], ttl: float):
+        if ttl <= 0 or self.max_entries <= 0:
+            return
+        key = self.key_for(token)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, valid, user)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def evict(self, token: str) -> bool:
+        """Drop a token (e.g. on logout). Returns True if it was cached."""
+        with self._lock:
+            return self._entries.pop(self.key_for(token), None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.negative_hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "negative_hits": self.negative_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": round((self.hits + self.negative_hits) / lookups, 4) if lookups else 0.0,
+            }
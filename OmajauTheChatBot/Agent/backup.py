@@ -0,0 +1,425 @@
+"""Streaming NDJSON export and import of a user's chats, sessions and messages.
+
+One JSON object per line:
+
+    {"type": "export", "version": 1, "uid": ..., "exported_at": ...}
+    {"type": "chat", "_id": ..., "title": ..., "created_at": ..., "updated_at": ...}
+    {"type": "session", "_id": ..., "chat_id": ..., "created_at": ...}
+    {"type": "message", "session_id": ..., "role": ..., "content": ..., "timestamp": ..., ...}
+
+Every chat is followed by its sessions and every session by its messages, in
+order. Export reads straight from Mongo cursors and hands out chunks of about
+``EXPORT_CHUNK`` bytes (gzip-compressed on the fly if asked), so memory stays
+flat however much a user has stored. Deleted chats and sessions are left out.
+
+Import reads the same format line by line and gives everything to the target
+uid. Messages are re-bucketed with the current BUCKET_SIZE, and documents are
+written with unordered ``insert_many`` batches of ``IMPORT_BATCH``. Chats and
+sessions that already exist are skipped with all they contain, so re-importing
+a backup is harmless and an import can never write into someone else's chat.
+
+    GET  /export/<uid>?gzip=true
+    POST /import/<uid>            (Content-Encoding: gzip for a compressed body)
+    flask --app app export-user <uid> -o backup.ndjson.gz
+    flask --app app import-user <uid> backup.ndjson.gz
+"""
+import gzip
+import json
+import os
+import zlib
+from datetime import datetime, timezone
+
+from pymongo.errors import BulkWriteError
+
+from convo_store import BUCKET_SIZE
+from json_provider import dumps_bytes
+from purger import NOT_DELETED
+
+FORMAT_VERSION = 1
+# Bytes of NDJSON collected before a chunk is handed to the response
+EXPORT_CHUNK = int(os.getenv("EXPORT_CHUNK", "65536"))
+# Documents per cursor batch (export) and per insert_many (import)
+EXPORT_BATCH = int(os.getenv("EXPORT_BATCH", "200"))
+IMPORT_BATCH = int(os.getenv("IMPORT_BATCH", "500"))
+
+CHAT_FIELDS = {"_id": 1, "title": 1, "created_at": 1, "updated_at": 1}
+DATE_FIELDS = ("created_at", "updated_at", "timestamp")
+# Message fields owned by the export format or the store, not by the message
+MESSAGE_RESERVED = ("type", "session_id", "i")
+
+
+class ImportFormatError(ValueError):
+    """A line that is not a valid export record."""
+
+
+# ============ Export ============
+
+def _chat_record(chat):
+    return {"type": "chat", **chat}
+
+
+def _session_record(convo):
+    return {"type": "session", "_id": convo["_id"], "chat_id": convo.get("chat_id"), "created_at": convo.get("created_at")}
+
+
+def _message_record(session_id, message):
+    return {"type": "message", "session_id": session_id, **{k: v for k, v in message.items() if k != "i"}}
+
+
+def _header(uid):
+    return {"type": "export", "version": FORMAT_VERSION, "uid": uid, "exported_at": datetime.utcnow()}
+
+
+def _chats_cursor(db, uid, batch):
+    # Sorted like GET /chats/<uid> so the (uid, updated_at) index serves it
+    return db["chats"].find({"uid": uid, **NOT_DELETED}, CHAT_FIELDS).sort("updated_at", -1).batch_size(batch)
+
+
+def _convos_cursor(db, chat_id, batch):
+    return db["convos"].find({"chat_id": chat_id, **NOT_DELETED}).sort("created_at", 1).batch_size(batch)
+
+
+def _buckets_cursor(db, session_id, batch):
+    return db["convo_buckets"].find({"session_id": session_id}, {"messages": 1}).sort("seq", 1).batch_size(batch)
+
+
+def export_records(db, uid, batch=EXPORT_BATCH):
+    """Yield the export records of `uid`, one document in memory at a time."""
+    yield _header(uid)
+    for chat in _chats_cursor(db, uid, batch):
+        yield _chat_record(chat)
+        for convo in _convos_cursor(db, chat["_id"], batch):
+            yield _session_record(convo)
+            # Sessions in the embedded layout carry their messages in the document
+            buckets = [convo] if "messages" in convo else _buckets_cursor(db, convo["_id"], batch)
+            for bucket in buckets:
+                for message in bucket.get("messages", []):
+                    yield _message_record(convo["_id"], message)
+
+
+async def aexport_records(db, uid, batch=EXPORT_BATCH):
+    """Motor twin of export_records."""
+    yield _header(uid)
+    async for chat in _chats_cursor(db, uid, batch):
+        yield _chat_record(chat)
+        async for convo in _convos_cursor(db, chat["_id"], batch):
+            yield _session_record(convo)
+            if "messages" in convo:
+                for message in convo["messages"]:
+                    yield _message_record(convo["_id"], message)
+                continue
+            async for bucket in _buckets_cursor(db, convo["_id"], batch):
+                for message in bucket.get("messages", []):
+                    yield _message_record(convo["_id"], message)
+
+
+class NDJSONChunker:
+    """Encodes records as NDJSON and groups them into chunks, optionally gzip-compressed."""
+
+    def __init__(self, compress=False, chunk_size=EXPORT_CHUNK):
+        self.chunk_size = chunk_size
+        self._gzip = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+        self._lines = []
+        self._size = 0
+
+    def _out(self, data, final=False):
+        if self._gzip is not None:
+            data = self._gzip.compress(data) + (self._gzip.flush() if final else b"")
+        return data
+
+    def add(self, record):
+        """Returns a chunk to send once enough has been collected, else b""."""
+        line = dumps_bytes(record) + b"\n"
+        self._lines.append(line)
+        self._size += len(line)
+        if self._size < self.chunk_size:
+            return b""
+        data, self._lines, self._size = b"".join(self._lines), [], 0
+        return self._out(data)
+
+    def close(self):
+        data, self._lines, self._size = b"".join(self._lines), [], 0
+        return self._out(data, final=True)
+
+
+def ndjson_chunks(records, compress=False):
+    chunker = NDJSONChunker(compress)
+    for record in records:
+        chunk = chunker.add(record)
+        if chunk:
+            yield chunk
+    tail = chunker.close()
+    if tail:
+        yield tail
+
+
+async def andjson_chunks(records, compress=False):
+    chunker = NDJSONChunker(compress)
+    async for record in records:
+        chunk = chunker.add(record)
+        if chunk:
+            yield chunk
+    tail = chunker.close()
+    if tail:
+        yield tail
+
+
+def export_filename(uid, compress):
+    return f"omaju-{uid}.ndjson" + (".gz" if compress else "")
+
+
+# ============ Import ============
+
+def _parse_dates(doc):
+    for field in DATE_FIELDS:
+        value = doc.get(field)
+        if isinstance(value, str):
+            try:
+                parsed = datetime.fromisoformat(value)
+            except ValueError:
+                continue
+            if parsed.utcoffset() is not None:
+                # Exports carry a UTC offset; the store keeps naive UTC datetimes
+                parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+            doc[field] = parsed
+    return doc
+
+
+def parse_line(line):
+    """The record on one NDJSON line, or None for a blank line."""
+    line = line.strip()
+    if not line:
+        return None
+    try:
+        record = json.loads(line)
+    except ValueError as e:
+        raise ImportFormatError(f"invalid JSON: {e}") from None
+    if not isinstance(record, dict) or "type" not in record:
+        raise ImportFormatError("each line must be an object with a 'type'")
+    return record
+
+
+def iter_lines(fileobj, compressed=False):
+    """Lines of a binary file-like body, gunzipped on the fly if `compressed`."""
+    if not compressed:
+        yield from fileobj
+        return
+    try:
+        yield from gzip.GzipFile(fileobj=fileobj)
+    except (OSError, EOFError) as e:
+        raise ImportFormatError(f"bad gzip body: {e}") from None
+
+
+async def aiter_lines(chunks, compressed=False):
+    """Lines of an async iterable of body chunks."""
+    gunzip = zlib.decompressobj(47) if compressed else None
+    pending = b""
+    async for chunk in chunks:
+        try:
+            pending += gunzip.decompress(chunk) if gunzip else chunk
+        except zlib.error as e:
+            raise ImportFormatError(f"bad gzip body: {e}") from None
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            yield line
+    if pending:
+        yield pending
+
+
+class ImportPlan:
+    """Turns export records into insert batches for one uid (no I/O).
+
+    ``feed`` buffers documents and says when a batch is due. The writer then
+    looks up which of the pending chat and session ids already exist and
+    passes them to ``screen``, which drops those together with everything
+    inside them. A session document is only queued once all its messages are
+    seen (that is when its count is known), so its buckets may be written
+    before it; the existence check covers them by session id.
+    """
+
+    def __init__(self, uid, batch=IMPORT_BATCH, bucket_size=BUCKET_SIZE):
+        self.uid = uid
+        self.batch = batch
+        self.bucket_size = bucket_size
+        self.chats = []
+        self.convos = []
+        self.buckets = []
+        self._chat_ids = set()
+        self._rejected_chats = set()
+        self._rejected_sessions = set()
+        self._session = None
+        self._bucket = None
+        self.imported = {"chats": 0, "sessions": 0, "messages": 0}
+        self.skipped = {"chats": 0, "sessions": 0, "messages": 0}
+
+    # ---- records ----
+
+    def feed(self, record):
+        """Queue one record. Returns True when a batch should be written."""
+        kind = record.get("type")
+        if kind == "export":
+            if record.get("version", FORMAT_VERSION) > FORMAT_VERSION:
+                raise ImportFormatError(f"export format version {record['version']} is newer than {FORMAT_VERSION}")
+        elif kind == "chat":
+            self._close_session()
+            if record.get("_id") is None:
+                raise ImportFormatError("chat record without _id")
+            doc = _parse_dates({k: v for k, v in record.items() if k != "type"})
+            doc["uid"] = self.uid
+            self._chat_ids.add(doc["_id"])
+            self.chats.append(doc)
+        elif kind == "session":
+            self._close_session()
+            self._open_session(record)
+        elif kind == "message":
+            self._add_message(record)
+        else:
+            raise ImportFormatError(f"unknown record type {kind!r}")
+        return len(self.chats) + len(self.convos) + len(self.buckets) >= self.batch
+
+    def finish(self):
+        self._close_session()
+
+    def _open_session(self, record):
+        if record.get("_id") is None:
+            raise ImportFormatError("session record without _id")
+        chat_id = record.get("chat_id")
+        if chat_id not in self._chat_ids:
+            raise ImportFormatError(f"session {record['_id']} comes before its chat {chat_id!r}")
+        self._session = {
+            "_id": record["_id"],
+            "chat_id": chat_id,
+            "created_at": _parse_dates(dict(record)).get("created_at") or datetime.utcnow(),
+            "count": 0,
+            "bucket_size": self.bucket_size,
+        }
+
+    def _add_message(self, record):
+        session = self._session
+        if session is None or record.get("session_id") != session["_id"]:
+            raise ImportFormatError("message record outside its session")
+        if not (record.get("role") and record.get("content")):
+            return
+        message = _parse_dates({k: v for k, v in record.items() if k not in MESSAGE_RESERVED})
+        message["i"] = session["count"]
+        session["count"] += 1
+        seq = message["i"] // self.bucket_size
+        if self._bucket is None or self._bucket["seq"] != seq:
+            self._bucket = {"session_id": session["_id"], "seq": seq, "messages": []}
+            self.buckets.append((session["chat_id"], self._bucket))
+        self._bucket["messages"].append(message)
+
+    def _close_session(self):
+        if self._session is not None:
+            self.convos.append(self._session)
+        self._session = None
+        self._bucket = None
+
+    # ---- batches ----
+
+    def take(self):
+        """Pending (chats, convos, buckets), with ids to look up for the existence check.
+
+        The open session's last bucket may still grow, so it stays pending.
+        """
+        keep = []
+        if self._bucket is not None and self.buckets and self.buckets[-1][1] is self._bucket:
+            keep = [self.buckets.pop()]
+        batch = (self.chats, self.convos, self.buckets)
+        self.chats, self.convos, self.buckets = [], [], keep
+        chat_ids = [doc["_id"] for doc in batch[0]]
+        session_ids = list({doc["_id"] for doc in batch[1]} | {doc["session_id"] for _, doc in batch[2]})
+        return batch, chat_ids, session_ids
+
+    def screen(self, batch, chat_owners, existing_sessions):
+        """Documents of `batch` to insert, given {chat_id: uid} and session ids already stored."""
+        chats, convos, buckets = batch
+        for chat_id, owner in chat_owners.items():
+            if owner != self.uid:
+                self._rejected_chats.add(chat_id)
+        self._rejected_sessions.update(existing_sessions)
+        new_chats = [doc for doc in chats if doc["_id"] not in chat_owners]
+        new_convos = [
+            doc for doc in convos
+            if doc["chat_id"] not in self._rejected_chats and doc["_id"] not in self._rejected_sessions
+        ]
+        new_buckets = []
+        for chat_id, doc in buckets:
+            if chat_id in self._rejected_chats or doc["session_id"] in self._rejected_sessions:
+                self.skipped["messages"] += len(doc["messages"])
+            else:
+                new_buckets.append(doc)
+        self.skipped["chats"] += len(chats) - len(new_chats)
+        self.skipped["sessions"] += len(convos) - len(new_convos)
+        self.imported["chats"] += len(new_chats)
+        self.imported["sessions"] += len(new_convos)
+        self.imported["messages"] += sum(len(doc["messages"]) for doc in new_buckets)
+        return new_chats, new_convos, new_buckets
+
+    def stats(self):
+        return {"imported": dict(self.imported), "skipped": dict(self.skipped)}
+
+
+def _raise_unless_duplicates(error):
+    # Duplicates here are ids created concurrently since the existence check; the rest was inserted
+    if any(err.get("code") != 11000 for err in error.details.get("writeErrors", [])):
+        raise error
+
+
+def _write(db, plan):
+    batch, chat_ids, session_ids = plan.take()
+    owners = {doc["_id"]: doc.get("uid") for doc in db["chats"].find({"_id": {"$in": chat_ids}}, {"uid": 1})} if chat_ids else {}
+    existing = {doc["_id"] for doc in db["convos"].find({"_id": {"$in": session_ids}}, {"_id": 1})} if session_ids else set()
+    for name, docs in zip(("chats", "convos", "convo_buckets"), plan.screen(batch, owners, existing)):
+        if docs:
+            try:
+                db[name].insert_many(docs, ordered=False)
+            except BulkWriteError as e:
+                _raise_unless_duplicates(e)
+
+
+async def _awrite(db, plan):
+    batch, chat_ids, session_ids = plan.take()
+    owners = {}
+    if chat_ids:
+        owners = {doc["_id"]: doc.get("uid") async for doc in db["chats"].find({"_id": {"$in": chat_ids}}, {"uid": 1})}
+    existing = set()
+    if session_ids:
+        existing = {doc["_id"] async for doc in db["convos"].find({"_id": {"$in": session_ids}}, {"_id": 1})}
+    for name, docs in zip(("chats", "convos", "convo_buckets"), plan.screen(batch, owners, existing)):
+        if docs:
+            try:
+                await db[name].insert_many(docs, ordered=False)
+            except BulkWriteError as e:
+                _raise_unless_duplicates(e)
+
+
+def import_lines(db, uid, lines, batch=IMPORT_BATCH):
+    """Import NDJSON lines (bytes or str) for `uid`. Returns the plan's stats."""
+    plan = ImportPlan(uid, batch=batch)
+    for number, line in enumerate(lines, 1):
+        try:
+            record = parse_line(line)
+        except ImportFormatError as e:
+            raise ImportFormatError(f"line {number}: {e}") from None
+        if record is not None and plan.feed(record):
+            _write(db, plan)
+    plan.finish()
+    _write(db, plan)
+    return plan.stats()
+
+
+async def aimport_lines(db, uid, lines, batch=IMPORT_BATCH):
+    plan = ImportPlan(uid, batch=batch)
+    number = 0
+    async for line in lines:
+        number += 1
+        try:
+            record = parse_line(line)
+        except ImportFormatError as e:
+            raise ImportFormatError(f"line {number}: {e}") from None
+        if record is not None and plan.feed(record):
+            await _awrite(db, plan)
+    plan.finish()
+    await _awrite(db, plan)
+    return plan.stats()
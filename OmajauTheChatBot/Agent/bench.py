@@ -0,0 +1,468 @@
+"""End-to-end benchmark for the Flask backend (app.py).
+
+Starts app.py in-process against a local mongod (``--mongo-uri``) or an
+in-memory stand-in (mongomock), a local fake of the ``/api/auth/profile``
+service and the fake model backend (MODEL_BACKEND=fake), then drives
+``/chat``, ``/messages/<session_id>``, ``/chats/<uid>`` and
+``/convos/<chat_id>`` at each requested concurrency and history size.
+
+For every run it reports client-side p50/p95/p99 latency and throughput, and
+a server-side breakdown per stage: auth validation, Mongo calls, model calls,
+JSON serialization and everything else (framework, prompt building). Results
+are written as JSON so runs on different commits can be compared:
+
+    python bench.py --mongo memory --concurrency 1,8,32 --history 0,500 --out before.json
+    python bench.py --mongo-uri mongodb://localhost:27017 --out after.json
+    python bench.py --compare before.json after.json
+"""
+import argparse
+import itertools
+import json
+import math
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+STAGES = ("auth", "db", "model", "serialization")
+SCENARIOS = ("chat", "messages", "chats", "convos")
+STORE_METHODS = (
+    "append_user_message", "append_reply", "append_messages", "create_session",
+    "get_session", "get_session_page", "delete_session",
+)
+PROMPTS = (
+    "hi", "who made you?", "tell me a joke", "what's a good book to read this weekend?",
+    "can you explain how rainbows form, step by step?",
+)
+
+
+# ============ Fake auth service ============
+
+class _AuthHandler(BaseHTTPRequestHandler):
+    """Accepts `Bearer bench-<k>` and answers with user `uid-<k>`."""
+
+    def do_GET(self):
+        token = self.headers.get("Authorization", "")[len("Bearer "):]
+        if self.path.rstrip("/").endswith("/profile") and token.startswith("bench-"):
+            user = {"_id": f"uid-{token[len('bench-'):]}"}
+            body = json.dumps({"success": True, "data": {"user": user}}).encode("utf-8")
+            self.send_response(200)
+        else:
+            body = b'{"success": false, "message": "Invalid token"}'
+            self.send_response(401)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_fake_auth():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _AuthHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fake-auth", daemon=True).start()
+    return server
+
+
+# ============ Server-side stage timing ============
+
+class StageTimer:
+    """Accumulates stage durations per request on the thread serving it."""
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._samples = []
+
+    def begin(self):
+        self._local.started = time.perf_counter()
+        self._local.stages = dict.fromkeys(STAGES, 0.0)
+
+    def add(self, stage, seconds):
+        stages = getattr(self._local, "stages", None)
+        if stages is not None:
+            stages[stage] += seconds
+
+    def end(self):
+        stages = getattr(self._local, "stages", None)
+        if stages is None:
+            return
+        self._local.stages = None
+        total = time.perf_counter() - self._local.started
+        stages["other"] = max(0.0, total - sum(stages.values()))
+        stages["server"] = total
+        with self._lock:
+            self._samples.append(stages)
+
+    def take(self):
+        with self._lock:
+            samples, self._samples = self._samples, []
+        return samples
+
+    def wrap(self, stage, fn):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - start)
+        return timed
+
+
+class _TimedCursor:
+    def __init__(self, cursor, timer):
+        self._cursor = cursor
+        self._timer = timer
+
+    def __getattr__(self, name):
+        attr = getattr(self._cursor, name)
+        if name in ("sort", "limit", "skip", "batch_size"):
+            return lambda *a, **kw: _TimedCursor(attr(*a, **kw), self._timer)
+        return attr
+
+    def __iter__(self):
+        it = iter(self._cursor)
+        while True:
+            start = time.perf_counter()
+            try:
+                doc = next(it)
+            except StopIteration:
+                return
+            finally:
+                self._timer.add("db", time.perf_counter() - start)
+            yield doc
+
+
+class _TimedCollection:
+    def __init__(self, col, timer):
+        self._col = col
+        self._timer = timer
+
+    def __getattr__(self, name):
+        attr = getattr(self._col, name)
+        if not callable(attr):
+            return attr
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = attr(*args, **kwargs)
+            finally:
+                self._timer.add("db", time.perf_counter() - start)
+            return _TimedCursor(result, self._timer) if name == "find" else result
+        return timed
+
+
+def instrument(agent_app, timer):
+    """Wrap the app's auth, Mongo, model and jsonify calls with stage timers."""
+    from flask import request
+
+    agent_app._validate_auth_or_401 = timer.wrap("auth", agent_app._validate_auth_or_401)
+    agent_app.jsonify = timer.wrap("serialization", agent_app.jsonify)
+    for name in STORE_METHODS:
+        setattr(agent_app.store, name, timer.wrap("db", getattr(agent_app.store, name)))
+    for name in ("chats_col", "convos_col", "conversations"):
+        setattr(agent_app, name, _TimedCollection(getattr(agent_app, name), timer))
+    # /chat runs model attempts on worker threads, so time the whole policy call on the request thread
+    agent_app.model_calls.invoke = timer.wrap("model", agent_app.model_calls.invoke)
+    model = agent_app.chat_model.get()
+    model.stream = timer.wrap("model", model.stream)
+
+    @agent_app.app.before_request
+    def _bench_begin():
+        if request.endpoint != "static":
+            timer.begin()
+
+    @agent_app.app.after_request
+    def _bench_end(response):
+        timer.end()
+        return response
+
+
+# ============ App under test ============
+
+def load_app(args, auth_base):
+    """Import app.py configured for benchmarking; returns the module."""
+    os.environ.update({
+        "AUTH_API_BASE": auth_base,
+        "MODEL_BACKEND": "fake",
+        "MONGO_DB_NAME": args.db_name,
+        "RESPONSE_CACHE": "off",
+        "FAKE_MODEL_LATENCY_MS": str(args.model_latency_ms),
+        "FAKE_MODEL_JITTER_MS": str(args.model_jitter_ms),
+        "FAKE_MODEL_TOKENS_PER_SEC": str(args.model_tokens_per_sec),
+    })
+    if args.no_auth_cache:
+        os.environ["AUTH_CACHE_TTL"] = "0"
+    if args.mongo_uri:
+        os.environ["MONGO_URI"] = args.mongo_uri
+    else:
+        try:
+            import mongomock
+        except ImportError:
+            sys.exit("--mongo memory needs mongomock (pip install mongomock); or pass --mongo-uri for a local mongod")
+        import pymongo
+        pymongo.MongoClient = mongomock.MongoClient
+
+    import app as agent_app
+    import logging
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    return agent_app
+
+
+def serve(flask_app):
+    from werkzeug.serving import make_server
+
+    server = make_server("127.0.0.1", 0, flask_app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="bench-app", daemon=True).start()
+    return server
+
+
+# ============ Workload ============
+
+class Fixture:
+    """One virtual user with a chat and a session holding `history` messages."""
+
+    def __init__(self, base, k, history, run_id):
+        self.base = base
+        self.uid = f"uid-{k}"
+        self.http = requests.Session()
+        self.http.headers["Authorization"] = f"Bearer bench-{k}"
+        chat = self.http.post(f"{base}/chats/{self.uid}", json={
+            "title": f"bench {k}",
+            "chat_id": f"bench_chat_{run_id}_{history}_{k}",
+        })
+        chat.raise_for_status()
+        self.chat_id = chat.json()["_id"]
+        self.session_id = f"bench_session_{run_id}_{history}_{k}"
+        self.http.post(f"{base}/convos/{self.chat_id}", json={"session_id": self.session_id}).raise_for_status()
+        for start in range(0, history, 100):
+            msgs = [
+                {"role": "user" if i % 2 == 0 else "assistant", "content": f"{PROMPTS[i % len(PROMPTS)]} (#{i})"}
+                for i in range(start, min(history, start + 100))
+            ]
+            self.http.patch(f"{base}/convos/{self.session_id}/messages", json={"messages": msgs}).raise_for_status()
+
+    def request(self, scenario, n):
+        if scenario == "chat":
+            return self.http.post(f"{self.base}/chat", json={
+                "session_id": self.session_id,
+                "chat_id": self.chat_id,
+                "message": PROMPTS[n % len(PROMPTS)],
+            })
+        if scenario == "messages":
+            return self.http.get(f"{self.base}/messages/{self.session_id}")
+        if scenario == "chats":
+            return self.http.get(f"{self.base}/chats/{self.uid}")
+        return self.http.get(f"{self.base}/convos/{self.chat_id}")
+
+
+def percentiles(values):
+    """p50/p95/p99/mean/max in milliseconds (nearest rank)."""
+    if not values:
+        return {}
+    ordered = sorted(values)
+
+    def pct(p):
+        return ordered[min(len(ordered) - 1, max(0, math.ceil(p / 100 * len(ordered)) - 1))]
+
+    return {
+        "p50": round(pct(50) * 1000, 3),
+        "p95": round(pct(95) * 1000, 3),
+        "p99": round(pct(99) * 1000, 3),
+        "mean": round(statistics.fmean(ordered) * 1000, 3),
+        "max": round(ordered[-1] * 1000, 3),
+    }
+
+
+def run_scenario(scenario, fixtures, concurrency, total, timer):
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+    counter = itertools.count()
+
+    def worker(k):
+        nonlocal errors
+        fixture = fixtures[k]
+        while True:
+            n = next(counter)
+            if n >= total:
+                return
+            start = time.perf_counter()
+            try:
+                ok = fixture.request(scenario, n).status_code < 400
+            except requests.RequestException:
+                ok = False
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                if not ok:
+                    errors += 1
+
+    timer.take()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(worker, range(concurrency)))
+    wall = time.perf_counter() - started
+    samples = timer.take()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "wall_s": round(wall, 3),
+        "throughput_rps": round(len(latencies) / wall, 2) if wall else 0.0,
+        "latency_ms": percentiles(latencies),
+        "stages_ms": {
+            stage: percentiles([s[stage] for s in samples])
+            for stage in STAGES + ("other", "server")
+        },
+    }
+
+
+def git_commit():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        return out.stdout.strip() or None
+    except Exception:
+        return None
+
+
+def run(args):
+    auth = start_fake_auth()
+    agent_app = load_app(args, f"http://127.0.0.1:{auth.server_port}/api/auth")
+    timer = StageTimer()
+    instrument(agent_app, timer)
+    server = serve(agent_app.app)
+    base = f"http://127.0.0.1:{server.server_port}"
+    run_id = datetime.utcnow().strftime("%Y%m%d%H%M%S")
+    results = []
+    try:
+        for history in args.history:
+            print(f"[bench] seeding {max(args.concurrency)} sessions with {history} messages", flush=True)
+            fixtures = [Fixture(base, k, history, run_id) for k in range(max(args.concurrency))]
+            for scenario in args.scenarios:
+                for concurrency in args.concurrency:
+                    if args.warmup:
+                        run_scenario(scenario, fixtures, concurrency, args.warmup, timer)
+                    result = run_scenario(scenario, fixtures, concurrency, args.requests, timer)
+                    result.update(scenario=scenario, history=history, concurrency=concurrency)
+                    results.append(result)
+                    lat = result["latency_ms"]
+                    print(f"[bench] {scenario:<8} history={history:<6} c={concurrency:<4} "
+                          f"p50={lat['p50']:.1f}ms p95={lat['p95']:.1f}ms p99={lat['p99']:.1f}ms "
+                          f"rps={result['throughput_rps']:.1f} errors={result['errors']}", flush=True)
+    finally:
+        server.shutdown()
+        auth.shutdown()
+        if args.mongo_uri and not args.keep_db:
+            agent_app.client.drop_database(args.db_name)
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": datetime.utcnow().isoformat() + "Z",
+            "python": platform.python_version(),
+            "mongo": "mongod" if args.mongo_uri else "mongomock",
+            "config": {
+                "requests": args.requests,
+                "warmup": args.warmup,
+                "concurrency": args.concurrency,
+                "history": args.history,
+                "auth_cache": not args.no_auth_cache,
+                "model_latency_ms": args.model_latency_ms,
+                "model_jitter_ms": args.model_jitter_ms,
+                "model_tokens_per_sec": args.model_tokens_per_sec,
+            },
+        },
+        "results": results,
+    }
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"[bench] wrote {args.out}")
+
+
+# ============ Comparison ============
+
+def compare(old_path, new_path):
+    """Print the change in latency and throughput for runs present in both reports."""
+    with open(old_path, encoding="utf-8") as f:
+        old = json.load(f)
+    with open(new_path, encoding="utf-8") as f:
+        new = json.load(f)
+
+    def key(r):
+        return r["scenario"], r["history"], r["concurrency"]
+
+    before = {key(r): r for r in old["results"]}
+    print(f"{'run':<28} {'p50':>16} {'p95':>16} {'p99':>16} {'rps':>16}")
+    for r in new["results"]:
+        o = before.get(key(r))
+        if o is None:
+            continue
+        cells = []
+        for metric in ("p50", "p95", "p99"):
+            a, b = o["latency_ms"][metric], r["latency_ms"][metric]
+            cells.append(f"{b:8.1f} ({_delta(a, b)})")
+        a, b = o["throughput_rps"], r["throughput_rps"]
+        cells.append(f"{b:8.1f} ({_delta(a, b)})")
+        label = f"{r['scenario']} h={r['history']} c={r['concurrency']}"
+        print(f"{label:<28} " + " ".join(f"{c:>16}" for c in cells))
+
+
+def _delta(a, b):
+    if not a:
+        return "n/a"
+    return f"{(b - a) / a * 100:+.0f}%"
+
+
+def _int_list(value):
+    return [int(v) for v in value.split(",") if v.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end benchmark for the Omaju Flask backend")
+    parser.add_argument("--mongo", choices=["memory", "local"], default="memory",
+                        help="memory: mongomock stand-in; local: a mongod at --mongo-uri")
+    parser.add_argument("--mongo-uri", help="MongoDB URI for --mongo local (default: mongodb://localhost:27017)")
+    parser.add_argument("--db-name", default="omaju_bench", help="Throwaway database (dropped afterwards)")
+    parser.add_argument("--keep-db", action="store_true", help="Do not drop the benchmark database")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="Comma-separated subset of " + ",".join(SCENARIOS))
+    parser.add_argument("--concurrency", type=_int_list, default=[1, 8, 32], help="Comma-separated client concurrency levels")
+    parser.add_argument("--history", type=_int_list, default=[0, 200], help="Comma-separated stored messages per session")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per scenario/concurrency/history run")
+    parser.add_argument("--warmup", type=int, default=10, help="Unmeasured requests before each run")
+    parser.add_argument("--no-auth-cache", action="store_true", help="Validate every request against the fake auth service")
+    parser.add_argument("--model-latency-ms", type=float, default=50.0, help="Fake model time to first token")
+    parser.add_argument("--model-jitter-ms", type=float, default=10.0, help="Fake model latency spread")
+    parser.add_argument("--model-tokens-per-sec", type=float, default=0.0, help="Fake model token rate (0 = instant)")
+    parser.add_argument("--out", default=f"bench-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}.json", help="JSON report path")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="Compare two JSON reports and exit")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    if args.mongo == "local":
+        args.mongo_uri = args.mongo_uri or "mongodb://localhost:27017"
+    if args.db_name == "ChatApp":
+        sys.exit("refusing to benchmark against the production database name")
+    args.scenarios = [s for s in args.scenarios.split(",") if s]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        sys.exit(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""Micro-benchmark: response serialization with the stdlib vs. the fast JSON provider.
+
+Builds realistic ``/messages/<session_id>`` and ``/chats/<uid>`` payloads
+(datetimes, ObjectIds, unicode, mixed message lengths) and reports the time
+per encode and the encoded size for:
+
+- stdlib: ``json.dumps`` the way Flask's default provider calls it
+  (sorted keys, ASCII escaping)
+- fast: ``json_provider.dumps_bytes`` (orjson when installed)
+
+    python bench_json.py --messages 200,2000 --chats 50,1000
+"""
+import argparse
+import json
+import random
+import timeit
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+
+import json_provider
+from json_provider import dumps_bytes, std_dumps
+
+SNIPPETS = (
+    "Hey! I am Omaju, your buddy.",
+    "Sure, here is a quick summary of what we talked about earlier. ",
+    "Let's break this down step by step so it's easier to follow. ",
+    "Ça marche ! Voilà une réponse avec des accents — et un emoji 🙂. ",
+    "```python\nfor i in range(10):\n    print(i)\n```\n",
+)
+
+
+def messages_payload(n, rng):
+    start = datetime(2024, 5, 1, 12, 0, 0)
+    msgs = []
+    for i in range(n):
+        content = "".join(rng.choice(SNIPPETS) for _ in range(rng.randint(1, 12)))
+        msgs.append({
+            "role": "user" if i % 2 == 0 else "assistant",
+            "content": content,
+            "timestamp": start + timedelta(seconds=17 * i, microseconds=rng.randint(0, 999) * 1000),
+            "tokens": len(content) // 4 + 4,
+            "i": i,
+        })
+    return {
+        "_id": "session_1714564800000",
+        "session_id": "session_1714564800000",
+        "chat_id": "chat_1714564800000",
+        "created_at": start,
+        "messages": msgs,
+    }
+
+
+def chats_payload(n, rng):
+    start = datetime(2024, 1, 1)
+    uid = str(ObjectId())
+    return [
+        {
+            "_id": f"chat_{1704067200000 + k}",
+            "uid": uid,
+            "title": rng.choice(("Untitled chat", "Trip planning", "Python help", "Recettes de cuisine")),
+            "created_at": start + timedelta(hours=k),
+            "updated_at": start + timedelta(hours=k, minutes=rng.randint(0, 600)),
+            "owner": ObjectId(),
+        }
+        for k in range(n)
+    ]
+
+
+def stdlib_encode(obj):
+    # What flask.json.provider.DefaultJSONProvider does (plus our ObjectId/datetime default)
+    return std_dumps(obj, sort_keys=True, ensure_ascii=True).encode("utf-8")
+
+
+def measure(fn, payload, min_time):
+    timer = timeit.Timer(lambda: fn(payload))
+    number, _ = timer.autorange()
+    number = max(number, int(number * min_time / 0.2))
+    best = min(timer.repeat(repeat=5, number=number)) / number
+    return best * 1e6, len(fn(payload))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare stdlib and fast JSON encoding of API payloads")
+    parser.add_argument("--messages", default="200,2000", help="Comma-separated message counts for /messages payloads")
+    parser.add_argument("--chats", default="50,1000", help="Comma-separated chat counts for /chats payloads")
+    parser.add_argument("--min-time", type=float, default=0.2, help="Approximate seconds per timing repeat")
+    parser.add_argument("--json", dest="json_out", help="Also write results to this JSON file")
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    cases = [(f"/messages n={n}", messages_payload(int(n), rng)) for n in args.messages.split(",") if n]
+    cases += [(f"/chats n={n}", chats_payload(int(n), rng)) for n in args.chats.split(",") if n]
+
+    backend = "orjson" if json_provider.orjson is not None else "stdlib fallback"
+    print(f"fast encoder: {backend}")
+    print(f"{'payload':<20} {'stdlib us':>12} {'fast us':>12} {'speedup':>8} {'stdlib B':>10} {'fast B':>10}")
+    results = []
+    for label, payload in cases:
+        std_us, std_bytes = measure(stdlib_encode, payload, args.min_time)
+        fast_us, fast_bytes = measure(dumps_bytes, payload, args.min_time)
+        print(f"{label:<20} {std_us:12.1f} {fast_us:12.1f} {std_us / fast_us:7.1f}x {std_bytes:10d} {fast_bytes:10d}")
+        results.append({
+            "payload": label,
+            "stdlib_us": round(std_us, 2),
+            "fast_us": round(fast_us, 2),
+            "stdlib_bytes": std_bytes,
+            "fast_bytes": fast_bytes,
+        })
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump({"fast_encoder": backend, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
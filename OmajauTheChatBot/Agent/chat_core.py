@@ -0,0 +1,322 @@
+"""Configuration and chat helpers shared by the Flask app (app.py) and the async app (asgi_app.py)."""
+import json
+import logging
+import os
+import traceback
+from datetime import datetime
+
+from dotenv import load_dotenv
+
+from context_builder import count_tokens, select_context
+from metrics import ERRORS, HISTORY_MESSAGES, PROMPT_TOKENS, timed
+from model_calls import ModelCallPolicy
+
+# Load environment variables
+load_dotenv()
+
+# Allow Authorization header through CORS so frontend can send Bearer tokens
+CORS_ORIGINS = [
+    "https://omaju-chatinterface-adityakatyal.vercel.app",
+    "https://omaju-onboarding.vercel.app",
+    "http://localhost:3000",  # optional for local testing
+    "http://localhost:3001"   # optional for local testing
+]
+CORS_ALLOW_HEADERS = ["Content-Type", "Authorization", "X-Profile"]
+CORS_EXPOSE_HEADERS = ["Content-Type", "Retry-After", "Server-Timing"]
+CORS_METHODS = ["GET", "POST", "PATCH", "DELETE", "OPTIONS"]
+
+MONGO_URI = os.getenv("MONGO_URI")
+# Warm slow clients (Gemini SDK, Mongo, indexes) in a background thread at startup; false = on first use
+STARTUP_WARMUP = (os.getenv("STARTUP_WARMUP", "true").lower() == "true")
+# Create the indexes the routes rely on at startup (see indexes.py)
+ENSURE_INDEXES = (os.getenv("ENSURE_INDEXES", "true").lower() == "true")
+# Overridable so benchmarks and tests can use a throwaway database
+DB_NAME = os.getenv("MONGO_DB_NAME", "ChatApp")
+
+# Gemini setup
+# Prefer GEMINI_API_KEY (Render-provided), fall back to GOOGLE_API_KEY for compatibility
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY") or os.getenv("GOOGLE_API_KEY")
+GEMINI_MODEL = os.getenv("GEMINI_MODEL") or "gemini-1.5-flash"
+DEBUG_GENAI = (os.getenv("DEBUG_GENAI", "false").lower() == "true")
+
+# Model backend: "gemini", or "fake" for offline load tests (see fake_model.py)
+MODEL_BACKEND = os.getenv("MODEL_BACKEND", "gemini").lower()
+FAKE_MODEL_LATENCY_MS = float(os.getenv("FAKE_MODEL_LATENCY_MS", "300"))
+FAKE_MODEL_JITTER_MS = float(os.getenv("FAKE_MODEL_JITTER_MS", "100"))
+FAKE_MODEL_DISTRIBUTION = os.getenv("FAKE_MODEL_DISTRIBUTION", "lognormal").lower()
+FAKE_MODEL_TOKENS_PER_SEC = float(os.getenv("FAKE_MODEL_TOKENS_PER_SEC", "50"))
+FAKE_MODEL_REPLY_TOKENS = int(os.getenv("FAKE_MODEL_REPLY_TOKENS", "60"))
+FAKE_MODEL_ERROR_RATE = float(os.getenv("FAKE_MODEL_ERROR_RATE", "0"))
+FAKE_MODEL_SEED = int(os.getenv("FAKE_MODEL_SEED", "0"))
+
+# Use the environment variable if set, otherwise choose a safe default
+# On Render, prefer AUTH_API_BASE env; if missing, fall back to the deployed auth URL
+if os.getenv("RENDER") == "true":  # Render sets RENDER=true in deployed env
+    AUTH_API_BASE = os.getenv("AUTH_API_BASE") or "https://omaju-onboarding.onrender.com/api/auth"
+else:
+    AUTH_API_BASE = os.getenv("AUTH_API_BASE") or "http://localhost:5001/api/auth"
+
+AUTH_POOL_SIZE = int(os.getenv("AUTH_POOL_SIZE", "20"))
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", "60"))
+AUTH_CACHE_NEGATIVE_TTL = float(os.getenv("AUTH_CACHE_NEGATIVE_TTL", "5"))
+AUTH_CACHE_MAX_ENTRIES = int(os.getenv("AUTH_CACHE_MAX_ENTRIES", "10000"))
+
+# Model call admission (see llm_scheduler.py); SCHEDULER_MAX_IN_FLIGHT=0 disables the cap
+SCHEDULER_MAX_IN_FLIGHT = int(os.getenv("SCHEDULER_MAX_IN_FLIGHT", "32"))
+SCHEDULER_MAX_QUEUE_PER_USER = int(os.getenv("SCHEDULER_MAX_QUEUE_PER_USER", "4"))
+SCHEDULER_MAX_QUEUE = int(os.getenv("SCHEDULER_MAX_QUEUE", "256"))
+SCHEDULER_MAX_WAIT = float(os.getenv("SCHEDULER_MAX_WAIT", "30"))
+SCHEDULER_RETRY_AFTER = float(os.getenv("SCHEDULER_RETRY_AFTER", "2"))
+
+# Latency budget, retries and hedging for /chat model calls (see model_calls.py); MODEL_CALL_BUDGET=0 disables them
+MODEL_CALL_BUDGET = float(os.getenv("MODEL_CALL_BUDGET", "30"))
+MODEL_MAX_ATTEMPTS = int(os.getenv("MODEL_MAX_ATTEMPTS", "3"))
+MODEL_RETRY_BACKOFF = float(os.getenv("MODEL_RETRY_BACKOFF", "0.25"))
+MODEL_RETRY_BACKOFF_MAX = float(os.getenv("MODEL_RETRY_BACKOFF_MAX", "2"))
+MODEL_HEDGE = (os.getenv("MODEL_HEDGE", "false").lower() == "true")
+MODEL_HEDGE_QUANTILE = float(os.getenv("MODEL_HEDGE_QUANTILE", "0.95"))
+MODEL_HEDGE_DELAY_MS = float(os.getenv("MODEL_HEDGE_DELAY_MS", "2000"))
+# Retries inside the Gemini client itself (LangChain's default). They apply to streams;
+# /chat calls go through model_calls.py, which turns them off and retries within its budget
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "6"))
+
+# Opt-in request profiling (see request_profiler.py)
+SERVER_TIMING = (os.getenv("SERVER_TIMING", "false").lower() == "true")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "200"))
+
+# Reply cache in front of the model: "memory" (in-process) or "off"
+RESPONSE_CACHE = os.getenv("RESPONSE_CACHE", "off").lower()
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "300"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1000"))
+# Messages before the user's turn that are part of the cache key
+RESPONSE_CACHE_HISTORY = int(os.getenv("RESPONSE_CACHE_HISTORY", "2"))
+
+# Tokens of prompt (identity context included) the history may fill
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "8000"))
+
+# Identity context prepended to every prompt
+IDENTITY_PROMPT = ("Your name is Omaju, a fun, friendly and extroverted AI ChatBot, created by Aditya Katyal, provide them my protfolio link to visit me https://adityakatyal-portfolio.onrender.com " \
+    "but only when user ask you who is your creator and ask them again if you can provide them my portfolio or not "
+    ". Give them the link only when they say yes. Be frindly and reply with atleast two to three lines")
+FALLBACK_REPLY = "Sorry, I am having trouble generating a response."
+LEGACY_GREETING = "Hey! I am **Omaju**, your buddy for lone times. How may I help?"
+CONVO_GREETING = "Hey! I am Omaju, your buddy."
+IDENTITY_TOKENS = count_tokens(IDENTITY_PROMPT)
+
+
+def create_chat_model():
+    """Build the chat model for MODEL_BACKEND, or return None when it is not configured."""
+    if MODEL_BACKEND not in MODEL_BACKENDS:
+        logging.error("[genai] Unknown MODEL_BACKEND %r (expected one of %s)", MODEL_BACKEND, sorted(MODEL_BACKENDS))
+        return None
+    return MODEL_BACKENDS[MODEL_BACKEND]()
+
+
+def model_configured():
+    return MODEL_BACKEND == "fake" or bool(GEMINI_API_KEY)
+
+
+def _create_gemini_model():
+    from langchain_google_genai import ChatGoogleGenerativeAI
+
+    if not GEMINI_API_KEY:
+        logging.warning("[genai] No GEMINI_API_KEY/GOOGLE_API_KEY configured. Responses will fail.")
+        return None
+    try:
+        model = ChatGoogleGenerativeAI(
+            model=GEMINI_MODEL,
+            temperature=0.7,
+            google_api_key=GEMINI_API_KEY,
+            max_retries=GEMINI_MAX_RETRIES,
+        )
+        logging.info("[genai] Initialized ChatGoogleGenerativeAI with model %s", GEMINI_MODEL)
+        return model
+    except Exception:
+        logging.error("[genai] Failed to initialize ChatGoogleGenerativeAI: %s", traceback.format_exc())
+        return None
+
+
+def _create_fake_model():
+    from fake_model import FakeChatModel
+
+    logging.warning("[genai] MODEL_BACKEND=fake: replies are synthetic (load testing only)")
+    return FakeChatModel(
+        latency_ms=FAKE_MODEL_LATENCY_MS,
+        jitter_ms=FAKE_MODEL_JITTER_MS,
+        distribution=FAKE_MODEL_DISTRIBUTION,
+        tokens_per_sec=FAKE_MODEL_TOKENS_PER_SEC,
+        reply_tokens=FAKE_MODEL_REPLY_TOKENS,
+        error_rate=FAKE_MODEL_ERROR_RATE,
+        seed=FAKE_MODEL_SEED,
+    )
+
+
+MODEL_BACKENDS = {"gemini": _create_gemini_model, "fake": _create_fake_model}
+
+
+def create_model_call_policy(hold=None):
+    return ModelCallPolicy(
+        budget=MODEL_CALL_BUDGET,
+        max_attempts=MODEL_MAX_ATTEMPTS,
+        backoff=MODEL_RETRY_BACKOFF,
+        backoff_max=MODEL_RETRY_BACKOFF_MAX,
+        hedge=MODEL_HEDGE,
+        hedge_quantile=MODEL_HEDGE_QUANTILE,
+        hedge_delay=MODEL_HEDGE_DELAY_MS / 1000.0,
+        # A call and its hedge, or one abandoned attempt, per scheduler slot
+        workers=max(8, 2 * SCHEDULER_MAX_IN_FLIGHT),
+        hold=hold,
+    )
+
+
+def log_genai_failure(e):
+    ERRORS.inc("model", type(e).__name__)
+    logging.error(
+        "[genai] Invocation failed. Backend=%s, Model=%s, HasKey=%s, Error=%s\n%s",
+        MODEL_BACKEND,
+        GEMINI_MODEL,
+        bool(GEMINI_API_KEY),
+        str(e),
+        traceback.format_exc(),
+    )
+
+
+def message_doc(role, content, **extra):
+    """A message as stored, with its token count computed once up front."""
+    return {"role": role, "content": content, "timestamp": datetime.utcnow(), "tokens": count_tokens(content), **extra}
+
+
+@timed("prompt")
+def build_prompt(recent_msgs, budget=CONTEXT_TOKEN_BUDGET, stats=None):
+    """Convert stored messages into LangChain messages, with the identity context first.
+
+    Only the newest messages that fit in ``budget`` tokens (identity context
+    included) are kept; the size actually sent is recorded in ``stats``.
+    """
+    # Imported here so loading the app does not pay for LangChain (see startup.py)
+    from langchain_core.messages import HumanMessage, SystemMessage, AIMessage
+
+    context, tokens = select_context(recent_msgs, budget, reserved=IDENTITY_TOKENS)
+    if stats is not None:
+        stats.record(tokens, len(context), len(recent_msgs) - len(context))
+    HISTORY_MESSAGES.observe(len(recent_msgs))
+    PROMPT_TOKENS.observe(tokens)
+    history = []
+    for msg in context:
+        if msg["role"] == "user":
+            history.append(HumanMessage(content=msg["content"]))
+        elif msg["role"] == "assistant":
+            history.append(AIMessage(content=msg["content"]))
+        else:
+            # Any non-user/assistant roles are treated as system messages
+            history.append(SystemMessage(content=msg.get("content", "")))
+    return [SystemMessage(content=IDENTITY_PROMPT)] + history
+
+
+def normalize_messages(msgs):
+    """Keep well-formed {role, content} messages and default missing timestamps.
+    Messages whose content is not a non-empty string are dropped."""
+    normalized = []
+    for m in msgs:
+        if not (isinstance(m, dict) and m.get("role") and m.get("content") and isinstance(m["content"], str)):
+            continue
+        ts = m.get("timestamp")
+        if isinstance(ts, str):
+            try:
+                # leave string; encoder will handle datetime only
+                pass
+            except Exception:
+                ts = datetime.utcnow()
+        elif not ts:
+            ts = datetime.utcnow()
+        normalized.append({"role": m["role"], "content": m["content"], "timestamp": ts, "tokens": count_tokens(m["content"])})
+    return normalized
+
+
+def auth_uid(user):
+    user = user or {}
+    return user.get("_id") or user.get("id") or user.get("uid")
+
+
+def new_session_id():
+    return f"session_{int(datetime.utcnow().timestamp()*1000)}"
+
+
+def new_chat_id():
+    return f"chat_{int(datetime.utcnow().timestamp()*1000)}"
+
+
+def sse(event, payload):
+    """Format one Server-Sent Events frame."""
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+
+# Simple HTML page that shows the Uiverse loader, useful to verify loader rendering from backend.
+LOADER_HTML = """
+<!doctype html>
+<html lang="en">
+  <head>
+    <meta charset="utf-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1">
+    <title>Omaju Loader</title>
+    <style>
+      body { margin:0; height:100vh; display:flex; align-items:center; justify-content:center; background:#0b0b0b; color:#fff; }
+      /* From Uiverse.io by alexruix */
+      .loader {
+        position: relative;
+        width: 120px;
+        height: 90px;
+        margin: 0 auto;
+      }
+      .loader:before {
+        content: "";
+        position: absolute;
+        bottom: 30px;
+        left: 50px;
+        height: 30px;
+        width: 30px;
+        border-radius: 50%;
+        background: #2a9d8f;
+        animation: loading-bounce 0.5s ease-in-out infinite alternate;
+      }
+      .loader:after {
+        content: "";
+        position: absolute;
+        right: 0;
+        top: 0;
+        height: 7px;
+        width: 45px;
+        border-radius: 4px;
+        box-shadow: 0 5px 0 #f2f2f2, -35px 50px 0 #f2f2f2, -70px 95px 0 #f2f2f2;
+        animation: loading-step 1s ease-in-out infinite;
+      }
+      @keyframes loading-bounce {
+        0% { transform: scale(1, 0.7); }
+        40% { transform: scale(0.8, 1.2); }
+        60% { transform: scale(1, 1); }
+        100% { bottom: 140px; }
+      }
+      @keyframes loading-step {
+        0% {
+          box-shadow: 0 10px 0 rgba(0, 0, 0, 0),
+                      0 10px 0 #f2f2f2,
+                      -35px 50px 0 #f2f2f2,
+                      -70px 90px 0 #f2f2f2;
+        }
+        100% {
+          box-shadow: 0 10px 0 #f2f2f2,
+                      -35px 50px 0 #f2f2f2,
+                      -70px 90px 0 #f2f2f2,
+                      -70px 90px 0 rgba(0, 0, 0, 0);
+        }
+      }
+    </style>
+  </head>
+  <body>
+    <div class="loader"></div>
+  </body>
+ </html>
+    """
@@ -1,10 +1,19 @@
 import argparse
 import requests
+from requests.adapters import HTTPAdapter
+import gzip
 import json
+import math
+import random
+import statistics
 import sys
 import os
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 
 # Import speech utilities (optional)
 try:
@@ -14,36 +23,70 @@ except ImportError:
     SPEECH_AVAILABLE = False
     print("Warning: Speech utilities not available. Install required packages for speech features.")
 
+# Messages fetched per /messages request when syncing history
+HISTORY_PAGE = 100
+
+
+def iter_sse(response: requests.Response):
+    """Yield (event, data) from a text/event-stream response as events arrive."""
+    buffer = b""
+    event, data = "message", []
+    # chunk_size=None hands over bytes as they are received instead of filling fixed-size blocks
+    for chunk in response.iter_content(chunk_size=None):
+        buffer += chunk
+        while b"\n" in buffer:
+            raw, buffer = buffer.split(b"\n", 1)
+            line = raw.rstrip(b"\r").decode("utf-8")
+            if not line:
+                if data:
+                    yield event, json.loads("\n".join(data))
+                event, data = "message", []
+            elif line.startswith("event:"):
+                event = line[6:].strip()
+            elif line.startswith("data:"):
+                data.append(line[5:].lstrip())
+
+
 class ChatClient:
-    def __init__(self, base_url: str = "http://localhost:5000", session_id: Optional[str] = None):
+    def __init__(self, base_url: str = "http://localhost:5000", session_id: Optional[str] = None,
+                 token: Optional[str] = None, pool_size: int = 4, speech: bool = True, timeout: float = 30):
         self.base_url = base_url.rstrip('/')
         self.session_id = session_id or f"session_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
         self.conversation_history = []
+        self.timeout = timeout
+        # Server-side messages of this session, and the index to sync from next
+        self.history_cache: List[Dict[str, Any]] = []
+        self._next_since = 0
+        
+        # One keep-alive connection pool for every request this client makes
+        self.http = requests.Session()
+        self.http.mount(self.base_url, HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        if token:
+            self.http.headers["Authorization"] = f"Bearer {token}"
         
         # Initialize speech handler if available
         self.speech_handler = None
-        if SPEECH_AVAILABLE:
+        if speech and SPEECH_AVAILABLE:
             try:
                 self.speech_handler = SpeechHandler(use_offline_tts=False)
                 print("✓ Speech features enabled")
             except Exception as e:
                 print(f"Warning: Speech features disabled due to error: {e}")
     
+    def close(self):
+        self.http.close()
+    
+    def post_chat(self, message: str) -> requests.Response:
+        """POST one turn to /chat and return the raw response."""
+        return self.http.post(
+            f"{self.base_url}/chat",
+            json={"session_id": self.session_id, "message": message},
+            timeout=self.timeout
+        )
+    
     def send_message(self, message: str) -> Optional[str]:
         try:
-            # Prepare request payload
-            payload = {
-                "session_id": self.session_id,
-                "message": message
-            }
-            
-            # Send POST request to /chat endpoint
-            response = requests.post(
-                f"{self.base_url}/chat",
-                json=payload,
-                headers={"Content-Type": "application/json"},
-                timeout=30
-            )
+            response = self.post_chat(message)
             
             if response.status_code == 200:
                 data = response.json()
@@ -58,12 +101,7 @@ class ChatClient:
                 
                 return ai_response
             else:
-                print(f"Error: HTTP {response.status_code}")
-                try:
-                    error_data = response.json()
-                    print(f"Error details: {error_data.get('error', 'Unknown error')}")
-                except:
-                    print(f"Response: {response.text}")
+                self._print_http_error(response)
                 return None
                 
         except requests.exceptions.ConnectionError:
@@ -77,117 +115,251 @@ class ChatClient:
             print(f"Error sending message: {e}")
             return None
     
-    def get_conversation_history(self) -> Optional[Dict[str, Any]]:
+    def stream_message(self, message: str, on_delta=None) -> Optional[str]:
+        """Send a message to /chat/stream, calling on_delta(text) for each chunk as it arrives."""
         try:
-            response = requests.get(f"{self.base_url}/history/{self.session_id}")
-            
-            if response.status_code == 200:
-                return response.json()
-            else:
-                print(f"Error retrieving history: HTTP {response.status_code}")
-                return None
+            response = self.http.post(
+                f"{self.base_url}/chat/stream",
+                json={"session_id": self.session_id, "message": message},
+                headers={"Accept": "text/event-stream"},
+                stream=True,
+                timeout=self.timeout
+            )
+            with response:
+                if response.status_code == 404:
+                    # Backend without streaming
+                    return self.send_message(message)
+                if response.status_code != 200:
+                    self._print_http_error(response)
+                    return None
                 
+                parts = []
+                ai_response = None
+                for event, data in iter_sse(response):
+                    if event == "delta":
+                        parts.append(data.get("delta", ""))
+                        if on_delta:
+                            on_delta(data.get("delta", ""))
+                    elif event == "error" and data.get("error"):
+                        print(f"\nError details: {data['error']}")
+                    elif event == "done":
+                        ai_response = data.get("response")
+                if ai_response is None:
+                    # Stream cut before "done": keep what arrived
+                    ai_response = "".join(parts)
+                if not ai_response:
+                    return None
+            
+            self.conversation_history.append({
+                "timestamp": datetime.now(),
+                "user": message,
+                "ai": ai_response
+            })
+            return ai_response
+            
+        except requests.exceptions.ConnectionError:
+            print(f"Error: Could not connect to backend at {self.base_url}")
+            print("Make sure the Flask backend is running.")
+            return None
+        except requests.exceptions.Timeout:
+            print("Error: Request timed out")
+            return None
+        except Exception as e:
+            print(f"Error sending message: {e}")
+            return None
+    
+    def _print_http_error(self, response: requests.Response):
+        print(f"Error: HTTP {response.status_code}")
+        try:
+            error_data = response.json()
+            print(f"Error details: {error_data.get('error') or error_data.get('message', 'Unknown error')}")
+        except:
+            print(f"Response: {response.text}")
+    
+    def sync_history(self) -> List[Dict[str, Any]]:
+        """Bring history_cache up to date, fetching only messages after the ones already held."""
+        while True:
+            since = self._next_since
+            response = self.http.get(
+                f"{self.base_url}/messages/{self.session_id}",
+                params={"since": since, "limit": HISTORY_PAGE},
+                timeout=self.timeout
+            )
+            response.raise_for_status()
+            data = response.json()
+            messages = data.get("messages", [])
+            next_since = data.get("next_since")
+            if next_since is None:
+                # Backend without ?since: it sent the whole session
+                self.history_cache = messages
+                self._next_since = len(messages)
+                return self.history_cache
+            if next_since < since:
+                # The session was cleared on the server: start over
+                self.history_cache, self._next_since = [], 0
+                continue
+            # Messages past a reply still being written are held back until the next sync
+            self.history_cache.extend(messages)
+            self._next_since = next_since
+            if next_since == since or len(messages) < HISTORY_PAGE:
+                return self.history_cache
+    
+    def get_conversation_history(self) -> Optional[Dict[str, Any]]:
+        try:
+            return {"session_id": self.session_id, "messages": self.sync_history()}
         except Exception as e:
             print(f"Error retrieving history: {e}")
             return None
     
-    def chat_loop(self, use_mic: bool = False, use_tts: bool = False, save_file: Optional[str] = None):
+    def chat_loop(self, use_mic: bool = False, use_tts: bool = False, save_file: Optional[str] = None,
+                  stream: bool = True):
         print(f"🤖 Conversational Agent Client")
         print(f"📡 Backend: {self.base_url}")
         print(f"🆔 Session: {self.session_id}")
         print(f"🎤 Microphone: {'Enabled' if use_mic else 'Disabled'}")
         print(f"🔊 Text-to-Speech: {'Enabled' if use_tts else 'Disabled'}")
         if save_file:
-            print(f"💾 Saving to: {save_file}")
+            print(f"💾 Recording transcript to: {save_file}")
         print("=" * 50)
         print("Type 'quit', 'exit', or 'bye' to end the conversation")
         print("Type 'history' to see conversation history")
         print("Type 'help' for available commands")
         print("=" * 50)
         
-        while True:
-            try:
-                # Get user input
-                if use_mic and self.speech_handler:
-                    print("\n🎤 Listening... (speak your message)")
-                    success, user_input = self.speech_handler.listen_to_mic()
-                    if not success:
-                        print(f"Speech recognition failed: {user_input}")
-                        continue
-                    print(f"🎯 Recognized: {user_input}")
-                else:
-                    user_input = input("\n💬 You: ").strip()
+        recorder = TranscriptRecorder(save_file, base_url=self.base_url) if save_file else None
+        try:
+            while True:
+                try:
+                    # Get user input
+                    if use_mic and self.speech_handler:
+                        print("\n🎤 Listening... (speak your message)")
+                        success, user_input = self.speech_handler.listen_to_mic()
+                        if not success:
+                            print(f"Speech recognition failed: {user_input}")
+                            continue
+                        print(f"🎯 Recognized: {user_input}")
+                    else:
+                        user_input = input("\n💬 You: ").strip()
                 
-                # Check for exit commands
-                if user_input.lower() in ['quit', 'exit', 'bye', 'q']:
-                    print("👋 Goodbye!")
-                    break
+                    # Check for exit commands
+                    if user_input.lower() in ['quit', 'exit', 'bye', 'q']:
+                        print("👋 Goodbye!")
+                        break
                 
-                # Check for special commands
-                if user_input.lower() == 'help':
-                    self._show_help()
-                    continue
-                elif user_input.lower() == 'history':
-                    self._show_history()
-                    continue
-                elif user_input.lower() == 'status':
-                    self._show_status()
-                    continue
-                elif user_input.lower() == 'clear':
-                    self.conversation_history.clear()
-                    print("🗑️  Conversation history cleared")
-                    continue
+                    # Check for special commands
+                    if user_input.lower() == 'help':
+                        self._show_help()
+                        continue
+                    elif user_input.lower() == 'history':
+                        self._show_history()
+                        continue
+                    elif user_input.lower() == 'status':
+                        self._show_status()
+                        continue
+                    elif user_input.lower() == 'clear':
+                        self.conversation_history.clear()
+                        print("🗑️  Conversation history cleared")
+                        continue
                 
-                # Skip empty input
-                if not user_input:
-                    continue
+                    # Skip empty input
+                    if not user_input:
+                        continue
                 
-                # Send message to backend
-                print("🔄 Sending message...")
-                ai_response = self.send_message(user_input)
+                    # Send message to backend
+                    started = time.perf_counter()
+                    first_delta = []
+                    speech = None
+                    if stream:
+                        # Print the reply as it is generated, and start speaking its first sentence
+                        # while the rest is still being generated
+                        if use_tts and self.speech_handler:
+                            speech = self.speech_handler.start_speaking()
+                        printed = []
+                        def on_delta(text):
+                            if not printed:
+                                first_delta.append(time.perf_counter() - started)
+                                print("🤖 AI: ", end="")
+                            printed.append(text)
+                            print(text, end="", flush=True)
+                            if speech:
+                                speech.feed(text)
+                        ai_response = self.stream_message(user_input, on_delta)
+                        if printed:
+                            print()
+                    else:
+                        print("🔄 Sending message...")
+                        ai_response = self.send_message(user_input)
+                        printed = []
+                    latency = time.perf_counter() - started
                 
-                if ai_response:
-                    print(f"🤖 AI: {ai_response}")
+                    if recorder:
+                        recorder.record(self.session_id, user_input, ai_response, latency,
+                                        ttft=first_delta[0] if first_delta else None, stream=stream)
+                
+                    if ai_response:
+                        if not printed:
+                            print(f"🤖 AI: {ai_response}")
                     
-                    # Text-to-speech if enabled
-                    if use_tts and self.speech_handler:
-                        print("🔊 Speaking response...")
-                        if self.speech_handler.speak_text(ai_response):
-                            print("✓ Response spoken successfully")
-                        else:
-                            print("✗ Failed to speak response")
+                        # Text-to-speech if enabled
+                        if use_tts and self.speech_handler:
+                            print("🔊 Speaking response...")
+                            if speech:
+                                if not printed:
+                                    # Reply did not come as a stream
+                                    speech.feed(ai_response)
+                                spoken = speech.finish()
+                            else:
+                                spoken = self.speech_handler.speak_text(ai_response)
+                            if spoken:
+                                first_audio = self.speech_handler.tts_stats.stats()["first_audio_ms"]
+                                print(f"✓ Response spoken (first audio after {first_audio.get('last', 0):.0f} ms)")
+                            else:
+                                print("✗ Failed to speak response")
+                    else:
+                        if speech:
+                            speech.finish()
+                        print("❌ Failed to get response from backend")
                     
-                    # Save to file if specified
-                    if save_file:
-                        self._save_to_file(user_input, ai_response, save_file)
-                else:
-                    print("❌ Failed to get response from backend")
-                    
-            except KeyboardInterrupt:
-                print("\n\n⚠️  Interrupted by user")
-                break
-            except EOFError:
-                print("\n\n👋 End of input")
-                break
+                except KeyboardInterrupt:
+                    print("\n\n⚠️  Interrupted by user")
+                    break
+                except EOFError:
+                    print("\n\n👋 End of input")
+                    break
+        finally:
+            if recorder:
+                recorder.close()
+            if self.speech_handler:
+                # Lets the last reply finish playing
+                self.speech_handler.close()
         
         # Final summary
         print(f"\n📊 Conversation Summary:")
         print(f"   Messages exchanged: {len(self.conversation_history)}")
         print(f"   Session ID: {self.session_id}")
         if save_file:
-            print(f"   Saved to: {save_file}")
+            print(f"   Transcript: {save_file} ({recorder.turns} turns)")
     
     def _show_help(self):
         """Show available commands."""
         print("\n📚 Available Commands:")
         print("  help     - Show this help message")
-        print("  history  - Show conversation history")
+        print("  history  - Show conversation history (synced from the backend)")
         print("  status   - Show connection status")
         print("  clear    - Clear local conversation history")
         print("  quit/exit/bye - End conversation")
     
     def _show_history(self):
-        """Show conversation history."""
+        """Show conversation history (the session as stored on the server, else local memory)."""
+        history = self.get_conversation_history()
+        if history and history["messages"]:
+            messages = history["messages"]
+            print(f"\n📝 Session History ({len(messages)} messages):")
+            for i, msg in enumerate(messages, 1):
+                who = "You" if msg.get("role") == "user" else "AI "
+                print(f"  {i}. {who}: {msg.get('content', '')}")
+            return
+        
         if not self.conversation_history:
             print("📝 No local conversation history")
             return
@@ -206,11 +378,20 @@ class ChatClient:
         print(f"  Session ID: {self.session_id}")
         print(f"  Speech Available: {'Yes' if SPEECH_AVAILABLE else 'No'}")
         print(f"  Speech Handler: {'Active' if self.speech_handler else 'Inactive'}")
+        if self.speech_handler:
+            tts = self.speech_handler.tts_stats.stats()
+            if tts["first_audio_ms"]:
+                print(f"  TTS: {tts['utterances']} replies, first audio p50 {tts['first_audio_ms']['p50']} ms")
+            cache = self.speech_handler.tts_cache
+            if cache:
+                cached = cache.stats()
+                print(f"  TTS cache: {cached['hits']} hits, {cached['misses']} misses, "
+                      f"{cached['bytes'] / 1024 / 1024:.1f}/{cached['max_bytes'] / 1024 / 1024:.0f} MB")
         print(f"  Local Messages: {len(self.conversation_history)}")
         
         # Test backend connection
         try:
-            response = requests.get(f"{self.base_url}/health", timeout=5)
+            response = self.http.get(f"{self.base_url}/health", timeout=5)
             if response.status_code == 200:
                 health_data = response.json()
                 print(f"  Backend Status: {health_data.get('status', 'Unknown')}")
@@ -220,17 +401,309 @@ class ChatClient:
                 print(f"  Backend Status: HTTP {response.status_code}")
         except:
             print("  Backend Status: Connection failed")
+
+# ============ Transcripts ============
+
+TRANSCRIPT_VERSION = 1
+
+
+def _compact(record: Dict[str, Any]) -> str:
+    return json.dumps(record, ensure_ascii=False, separators=(',', ':'))
+
+
+class TranscriptRecorder:
+    """Appends conversation turns to a JSONL transcript (gzip-compressed if the name ends in .gz).
+    
+    The file is opened once and lines are buffered, `flush_every` turns per
+    write, so recording adds no file I/O to most turns. A header line starts
+    each recording; every turn is one line:
+    
+        {"type":"turn","session_id":...,"ts":<epoch s>,"user":...,"ai":...,
+         "ok":true,"latency_ms":812.3,"ttft_ms":120.5,"stream":true}
+    
+    ``ttft_ms`` (first streamed chunk) is only present for streamed replies.
+    """
+    
+    def __init__(self, path: str, base_url: Optional[str] = None, flush_every: int = 20):
+        self.path = path
+        self.flush_every = flush_every
+        self._file = (gzip.open if path.endswith('.gz') else open)(path, 'at', encoding='utf-8')
+        self._lock = threading.Lock()
+        self._buffer: List[str] = []
+        self.turns = 0
+        self._add({"type": "header", "version": TRANSCRIPT_VERSION,
+                   "created": datetime.now().isoformat(timespec='seconds'), "base_url": base_url})
+    
+    def _add(self, record: Dict[str, Any]):
+        with self._lock:
+            self._buffer.append(_compact(record) + '\n')
+            if len(self._buffer) >= self.flush_every:
+                self._flush_locked()
+    
+    def _flush_locked(self):
+        if self._buffer:
+            self._file.write(''.join(self._buffer))
+            self._buffer.clear()
+    
+    def record(self, session_id: str, user: str, ai: Optional[str], latency: float,
+               ttft: Optional[float] = None, stream: bool = False):
+        """One turn; `ai` is None for a failed request. Timings in seconds."""
+        turn = {"type": "turn", "session_id": session_id, "ts": round(time.time() - latency, 3),
+                "user": user, "ai": ai, "ok": ai is not None, "latency_ms": round(latency * 1000, 1)}
+        if ttft is not None:
+            turn["ttft_ms"] = round(ttft * 1000, 1)
+        turn["stream"] = stream
+        self.turns += 1
+        self._add(turn)
     
-    def _save_to_file(self, user_msg: str, ai_msg: str, filename: str):
-        """Save conversation to file."""
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+            self._file.flush()
+    
+    def close(self):
+        with self._lock:
+            self._flush_locked()
+            self._file.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_transcripts(paths: List[str]) -> List[List[Dict[str, Any]]]:
+    """Recorded sessions from transcript files: per session, its turns in order."""
+    sessions: Dict[tuple, List[Dict[str, Any]]] = {}
+    for path in paths:
+        with open(path, 'rb') as f:
+            gzipped = f.read(2) == b'\x1f\x8b'
+        with (gzip.open if gzipped else open)(path, 'rt', encoding='utf-8') as f:
+            for n, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    raise ValueError(f"{path}:{n}: not a JSON line")
+                if record.get("type") == "turn":
+                    sessions.setdefault((path, record["session_id"]), []).append(record)
+    return list(sessions.values())
+
+
+class Replay:
+    """Re-drives recorded sessions against a backend and compares latencies with the recording.
+    
+    Every recorded session is replayed concurrently under a new session id,
+    sending its messages at the recorded times divided by `speed` (2 = twice
+    as fast; 0 = as fast as possible, each message right after the previous
+    reply). A message is never sent before the previous reply of its session
+    has arrived. Replies are requested from /chat, so latencies are compared
+    with the recorded full-reply latency (latency_ms) of successful turns.
+    """
+    
+    def __init__(self, base_url: str, sessions: List[List[Dict[str, Any]]], speed: float = 1.0,
+                 token: Optional[str] = None, timeout: float = 30,
+                 recorder: Optional[TranscriptRecorder] = None):
+        self.base_url = base_url
+        self.sessions = sessions
+        self.speed = speed
+        self.token = token
+        self.timeout = timeout
+        self.recorder = recorder
+        self.run_id = datetime.now().strftime('%Y%m%d_%H%M%S')
+        self._lock = threading.Lock()
+        self.pairs: List[tuple] = []
+        self.outcomes: Counter = Counter()
+    
+    def _wait_until(self, started: float, offset: float):
+        if self.speed > 0:
+            delay = started + offset / self.speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+    
+    def _session(self, args):
+        k, turns, origin, started = args
+        client = ChatClient(self.base_url, session_id=f"replay_{self.run_id}_{k}", token=self.token,
+                            pool_size=1, speech=False, timeout=self.timeout)
         try:
-            timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            with open(filename, 'a', encoding='utf-8') as f:
-                f.write(f"[{timestamp}] User: {user_msg}\n")
-                f.write(f"[{timestamp}] AI: {ai_msg}\n")
-                f.write("-" * 50 + "\n")
-        except Exception as e:
-            print(f"⚠️  Failed to save to file: {e}")
+            for turn in turns:
+                self._wait_until(started, turn["ts"] - origin)
+                sent = time.perf_counter()
+                ai = None
+                try:
+                    response = client.post_chat(turn["user"])
+                    outcome = str(response.status_code)
+                    if response.status_code == 200:
+                        ai = response.json().get("response")
+                except requests.RequestException as e:
+                    outcome = type(e).__name__
+                latency = time.perf_counter() - sent
+                with self._lock:
+                    self.outcomes[outcome] += 1
+                    if outcome == "200" and turn.get("ok"):
+                        self.pairs.append((turn["latency_ms"] / 1000, latency))
+                if self.recorder:
+                    self.recorder.record(client.session_id, turn["user"], ai, latency)
+        finally:
+            client.close()
+    
+    def run(self) -> Dict[str, Any]:
+        origin = min(turns[0]["ts"] for turns in self.sessions)
+        started = time.perf_counter()
+        jobs = [(k, turns, origin, started) for k, turns in enumerate(self.sessions)]
+        with ThreadPoolExecutor(max_workers=len(jobs)) as pool:
+            list(pool.map(self._session, jobs))
+        wall = time.perf_counter() - started
+        requests_sent = sum(self.outcomes.values())
+        errors = requests_sent - self.outcomes.get("200", 0)
+        recorded = latency_summary([r for r, _ in self.pairs])
+        replayed = latency_summary([p for _, p in self.pairs])
+        return {
+            "sessions": len(self.sessions),
+            "speed": self.speed,
+            "requests": requests_sent,
+            "errors": errors,
+            "error_rate": round(errors / requests_sent, 4) if requests_sent else 0.0,
+            "outcomes": dict(self.outcomes),
+            "wall_s": round(wall, 2),
+            "compared": len(self.pairs),
+            "recorded_ms": recorded,
+            "replayed_ms": replayed,
+            "delta_ms": {k: round(replayed[k] - recorded[k], 1) for k in recorded},
+            # Share of turns more than twice as slow as when recorded
+            "slower_2x": round(sum(p > 2 * r for r, p in self.pairs) / len(self.pairs), 4) if self.pairs else 0.0,
+        }
+
+
+def print_replay_report(report: Dict[str, Any]):
+    speed = "max speed" if report['speed'] <= 0 else f"{report['speed']:g}x speed"
+    print(f"\n🔁 Replay: {report['sessions']} sessions at {speed} in {report['wall_s']} s")
+    print(f"   Requests: {report['requests']}  Errors: {report['errors']} ({report['error_rate']:.2%})")
+    print(f"   Outcomes: {', '.join(f'{k}={v}' for k, v in sorted(report['outcomes'].items()))}")
+    if report['compared']:
+        print(f"   Latency (ms, {report['compared']} turns ok in both):")
+        print(f"   {'':10}" + "".join(f"{k:>9}" for k in report['recorded_ms']))
+        for label, key in (("recorded", "recorded_ms"), ("replayed", "replayed_ms"), ("delta", "delta_ms")):
+            print(f"   {label:10}" + "".join(f"{v:>9}" for v in report[key].values()))
+        print(f"   Turns >2x slower than recorded: {report['slower_2x']:.1%}")
+
+# ============ Load generation ============
+
+DEFAULT_PROMPTS = [
+    "hi",
+    "who made you?",
+    "tell me a joke",
+    "what's a good book to read this weekend?",
+    "can you explain how rainbows form, step by step?",
+]
+
+
+def load_prompts(path: Optional[str]) -> List[str]:
+    """Prompts from a file (one per line, '#' comments skipped), or the built-in set."""
+    if not path:
+        return DEFAULT_PROMPTS
+    with open(path, encoding='utf-8') as f:
+        prompts = [line.strip() for line in f if line.strip() and not line.lstrip().startswith('#')]
+    if not prompts:
+        raise ValueError(f"no prompts in {path}")
+    return prompts
+
+
+def latency_summary(seconds: List[float]) -> Dict[str, float]:
+    """p50/p90/p95/p99/mean/max in milliseconds (nearest rank)."""
+    if not seconds:
+        return {}
+    ordered = sorted(seconds)
+    
+    def pct(p):
+        return ordered[min(len(ordered) - 1, max(0, math.ceil(p / 100 * len(ordered)) - 1))]
+    
+    summary = {f"p{p}": round(pct(p) * 1000, 1) for p in (50, 90, 95, 99)}
+    summary["mean"] = round(statistics.fmean(ordered) * 1000, 1)
+    summary["max"] = round(ordered[-1] * 1000, 1)
+    return summary
+
+
+class LoadRun:
+    """Synthetic users hitting /chat concurrently.
+    
+    Each user is a ChatClient with its own session id and keep-alive
+    connection. Users start evenly spread over `ramp_up` seconds, then send
+    `turns` prompts with an exponentially distributed pause of `think_time`
+    seconds on average between them (like independent people typing).
+    """
+    
+    def __init__(self, base_url: str, users: int, turns: int, prompts: List[str], think_time: float = 0.0,
+                 ramp_up: float = 0.0, token: Optional[str] = None, timeout: float = 30):
+        self.base_url = base_url
+        self.users = users
+        self.turns = turns
+        self.prompts = prompts
+        self.think_time = think_time
+        self.ramp_up = ramp_up
+        self.token = token
+        self.timeout = timeout
+        self.run_id = datetime.now().strftime('%Y%m%d_%H%M%S')
+        self._lock = threading.Lock()
+        self.latencies: List[float] = []
+        self.outcomes: Counter = Counter()
+    
+    def _record(self, outcome: str, seconds: float):
+        with self._lock:
+            self.outcomes[outcome] += 1
+            if outcome == "200":
+                self.latencies.append(seconds)
+    
+    def _user(self, k: int):
+        time.sleep(self.ramp_up * k / self.users)
+        client = ChatClient(self.base_url, session_id=f"load_{self.run_id}_{k}", token=self.token,
+                            pool_size=1, speech=False, timeout=self.timeout)
+        try:
+            for turn in range(self.turns):
+                if turn and self.think_time > 0:
+                    time.sleep(random.expovariate(1 / self.think_time))
+                prompt = self.prompts[(k + turn) % len(self.prompts)]
+                started = time.perf_counter()
+                try:
+                    outcome = str(client.post_chat(prompt).status_code)
+                except requests.RequestException as e:
+                    outcome = type(e).__name__
+                self._record(outcome, time.perf_counter() - started)
+        finally:
+            client.close()
+    
+    def run(self) -> Dict[str, Any]:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.users) as pool:
+            list(pool.map(self._user, range(self.users)))
+        wall = time.perf_counter() - started
+        requests_sent = sum(self.outcomes.values())
+        errors = requests_sent - self.outcomes.get("200", 0)
+        return {
+            "users": self.users,
+            "turns": self.turns,
+            "think_time_s": self.think_time,
+            "ramp_up_s": self.ramp_up,
+            "requests": requests_sent,
+            "errors": errors,
+            "error_rate": round(errors / requests_sent, 4) if requests_sent else 0.0,
+            "outcomes": dict(self.outcomes),
+            "wall_s": round(wall, 2),
+            "throughput_rps": round(requests_sent / wall, 2) if wall else 0.0,
+            "latency_ms": latency_summary(self.latencies),
+        }
+
+
+def print_load_report(report: Dict[str, Any]):
+    print(f"\n📈 Load run: {report['users']} users x {report['turns']} turns in {report['wall_s']} s")
+    print(f"   Requests: {report['requests']} ({report['throughput_rps']} req/s)")
+    print(f"   Errors: {report['errors']} ({report['error_rate']:.2%})")
+    print(f"   Outcomes: {', '.join(f'{k}={v}' for k, v in sorted(report['outcomes'].items()))}")
+    if report['latency_ms']:
+        print("   Latency (ms, successful): " + "  ".join(f"{k}={v}" for k, v in report['latency_ms'].items()))
+
 
 def main():
     """Main entry point for the client application."""
@@ -243,8 +716,11 @@ Examples:
   python client.py --mic             # Use microphone for input
   python client.py --tts             # Speak AI responses aloud
   python client.py --mic --tts       # Full speech interaction
-  python client.py --save chat.txt   # Save conversation to file
+  python client.py --save chat.jsonl.gz  # Record a transcript
+  python client.py --replay chat.jsonl.gz --speed 10  # Replay it 10x faster
+  python client.py --no-stream       # Print replies only once complete
   python client.py --url http://192.168.1.100:5000  # Custom backend URL
+  python client.py --load 50 --turns 10 --think-time 2 --ramp-up 30 --prompts prompts.txt
         """
     )
     
@@ -258,12 +734,63 @@ Examples:
     parser.add_argument('--offline-tts', action='store_true',
                        help='Use offline TTS (pyttsx3) instead of online (gTTS)')
     parser.add_argument('--save', metavar='FILE',
-                       help='Save conversation to specified file')
+                       help='Record a JSONL transcript to FILE (gzip-compressed if it ends in .gz)')
     parser.add_argument('--test-speech', action='store_true',
                        help='Test speech features and exit')
+    parser.add_argument('--no-stream', action='store_true',
+                       help='Wait for the full reply (/chat) instead of streaming it')
+    parser.add_argument('--token', default=os.getenv('OMAJU_TOKEN'),
+                       help='Bearer token for the backend (default: $OMAJU_TOKEN)')
+    
+    load = parser.add_argument_group('load generation')
+    load.add_argument('--load', type=int, metavar='USERS',
+                      help='Run USERS synthetic sessions concurrently instead of chatting')
+    load.add_argument('--turns', type=int, default=5, help='Messages per synthetic session (default: 5)')
+    load.add_argument('--prompts', metavar='FILE', help='Prompt file, one per line (default: built-in prompts)')
+    load.add_argument('--think-time', type=float, default=1.0,
+                      help='Mean seconds between a reply and the next message (default: 1.0)')
+    load.add_argument('--ramp-up', type=float, default=0.0,
+                      help='Seconds over which sessions are started (default: 0)')
+    load.add_argument('--report', metavar='FILE', help='Also write the load or replay report as JSON')
+    
+    replay = parser.add_argument_group('transcript replay')
+    replay.add_argument('--replay', nargs='+', metavar='TRANSCRIPT',
+                        help='Re-drive recorded transcripts (from --save) and compare latencies')
+    replay.add_argument('--speed', type=float, default=1.0,
+                        help='Replay speed: 1 = as recorded, 10 = ten times faster, 0 = max (default: 1)')
     
     args = parser.parse_args()
     
+    if args.replay:
+        sessions = read_transcripts(args.replay)
+        if not sessions:
+            print("❌ No recorded turns in the given transcripts")
+            sys.exit(1)
+        recorder = TranscriptRecorder(args.save, base_url=args.url) if args.save else None
+        try:
+            run = Replay(args.url, sessions, speed=args.speed, token=args.token, recorder=recorder)
+            print(f"🔁 Replaying {len(sessions)} sessions against {args.url} ...")
+            report = run.run()
+        finally:
+            if recorder:
+                recorder.close()
+        print_replay_report(report)
+        if args.report:
+            with open(args.report, 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2)
+        sys.exit(1 if report['requests'] and report['errors'] == report['requests'] else 0)
+    
+    if args.load:
+        run = LoadRun(args.url, args.load, args.turns, load_prompts(args.prompts),
+                      think_time=args.think_time, ramp_up=args.ramp_up, token=args.token)
+        print(f"🚀 {args.load} users x {args.turns} turns against {args.url} ...")
+        report = run.run()
+        print_load_report(report)
+        if args.report:
+            with open(args.report, 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2)
+        sys.exit(1 if report['requests'] and report['errors'] == report['requests'] else 0)
+    
     # Test speech features if requested
     if args.test_speech:
         if not SPEECH_AVAILABLE:
@@ -298,7 +825,7 @@ Examples:
     
     # Create and run client
     try:
-        client = ChatClient(base_url=args.url, session_id=args.session)
+        client = ChatClient(base_url=args.url, session_id=args.session, token=args.token)
         
         # Update speech handler if offline TTS requested
         if args.offline_tts and client.speech_handler:
@@ -312,7 +839,8 @@ Examples:
         client.chat_loop(
             use_mic=args.mic,
             use_tts=args.tts,
-            save_file=args.save
+            save_file=args.save,
+            stream=not args.no_stream
         )
         
     except KeyboardInterrupt:
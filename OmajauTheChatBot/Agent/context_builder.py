@@ -0,0 +1,88 @@
+"""Token-budgeted prompt context.
+
+Stored messages carry a ``tokens`` field computed once when they are saved
+(``count_tokens``). ``select_context`` walks the recent messages newest first
+and keeps as many as fit in the budget, which also has to cover the fixed
+identity prompt. Messages saved before the field existed are counted on the fly.
+
+Counts are an estimate (about four characters per token plus a small
+per-message overhead), which is close enough for Gemini to keep prompts
+inside the budget without a tokenizer round trip.
+"""
+import threading
+from typing import Any, Dict, List, Sequence, Tuple
+
+CHARS_PER_TOKEN = 4
+# Role markers and separators the model adds around every message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def count_tokens(text: str) -> int:
+    """Estimated token count of one message with content ``text``."""
+    return -(-len(text or "") // CHARS_PER_TOKEN) + MESSAGE_OVERHEAD_TOKENS
+
+
+def message_tokens(msg: Dict[str, Any]) -> int:
+    tokens = msg.get("tokens")
+    if isinstance(tokens, int):
+        return tokens
+    return count_tokens(msg.get("content", ""))
+
+
+def select_context(msgs: Sequence[Dict[str, Any]], budget: int, reserved: int = 0) -> Tuple[List[Dict[str, Any]], int]:
+    """Pick the newest messages whose tokens fit in ``budget - reserved``.
+
+    The newest message (the user's turn) is always kept, even if it alone is
+    over budget. Returns (messages in chronological order, tokens used
+    including ``reserved``).
+    """
+    used = reserved
+    picked = []
+    for msg in reversed(msgs):
+        tokens = message_tokens(msg)
+        if picked and used + tokens > budget:
+            break
+        picked.append(msg)
+        used += tokens
+    picked.reverse()
+    return picked, used
+
+
+class PromptStats:
+    """Running totals of the prompts sent to the model, reported in /health."""
+
+    # Upper bounds (in tokens) of the size distribution buckets
+    BOUNDS = (250, 500, 1000, 2000, 4000, 8000, 16000, 32000)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.prompts = 0
+        self.total_tokens = 0
+        self.total_messages = 0
+        self.max_tokens = 0
+        self.truncated = 0
+        self._buckets = [0] * (len(self.BOUNDS) + 1)
+
+    def record(self, tokens: int, messages: int, dropped: int):
+        """Record one prompt of ``tokens`` carrying ``messages`` history messages."""
+        slot = next((k for k, bound in enumerate(self.BOUNDS) if tokens <= bound), len(self.BOUNDS))
+        with self._lock:
+            self.prompts += 1
+            self.total_tokens += tokens
+            self.total_messages += messages
+            self.max_tokens = max(self.max_tokens, tokens)
+            if dropped:
+                self.truncated += 1
+            self._buckets[slot] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            labels = [f"<={bound}" for bound in self.BOUNDS] + [f">{self.BOUNDS[-1]}"]
+            return {
+                "prompts": self.prompts,
+                "avg_tokens": round(self.total_tokens / self.prompts, 1) if self.prompts else 0.0,
+                "avg_messages": round(self.total_messages / self.prompts, 1) if self.prompts else 0.0,
+                "max_tokens": self.max_tokens,
+                "truncated": self.truncated,
+                "tokens_distribution": dict(zip(labels, self._buckets)),
+            }
@@ -0,0 +1,919 @@
+"""Message persistence.
+
+Sessions live in ``convos`` as small metadata documents and their messages in
+fixed-size buckets in ``convo_buckets``:
+
+    convos:        {_id: session_id, chat_id, created_at, count, bucket_size}
+    convo_buckets: {session_id, seq, messages: [{role, content, timestamp, i}, ...]}
+
+Each message gets a per-session sequence index ``i`` reserved with an atomic
+``$inc`` of ``count``. Message ``i`` lives in bucket ``i // bucket_size``, so
+``count`` doubles as the pointer to the tail bucket and no document grows
+past ``bucket_size`` messages.
+
+Sessions written before buckets existed keep an embedded ``messages`` array
+(in convos, or in the legacy ``conversations`` collection). They are read
+as-is and converted the first time they are written to, or all at once with
+``flask --app app migrate-buckets``.
+
+Deleting a session marks its convos document with ``deleted_at``; reads
+treat it as gone right away and ``purger.Purger`` removes its buckets in the
+background. Reusing the id of a deleted session purges it inline first.
+
+``ConvoStore`` takes a pymongo database; ``AsyncConvoStore`` takes a Motor
+database and issues exactly the same queries. Either can be given a
+``MessageWriteBehind`` to queue message pushes off the request path.
+"""
+import asyncio
+import os
+import threading
+import time
+from datetime import datetime
+
+from pymongo import ASCENDING, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from purger import DELETED, NOT_DELETED, tombstone
+
+# Messages per bucket for newly created sessions (existing sessions keep their own size)
+BUCKET_SIZE = int(os.getenv("BUCKET_SIZE", "50"))
+# Most stored messages read back as prompt context (trimmed further by CONTEXT_TOKEN_BUDGET)
+CONTEXT_MESSAGES = int(os.getenv("CONTEXT_MESSAGES", "50"))
+CHAT_TOUCH_INTERVAL = float(os.getenv("CHAT_TOUCH_INTERVAL", "2"))
+# Write-behind mode for message pushes (see MessageWriteBehind)
+WRITE_BEHIND = (os.getenv("WRITE_BEHIND", "false").lower() == "true")
+WRITE_BEHIND_INTERVAL = float(os.getenv("WRITE_BEHIND_INTERVAL", "0.05"))
+WRITE_BEHIND_BATCH = int(os.getenv("WRITE_BEHIND_BATCH", "200"))
+WRITE_BEHIND_MAX_PENDING = int(os.getenv("WRITE_BEHIND_MAX_PENDING", "5000"))
+
+META_FIELDS = {"count": 1, "bucket_size": 1, "chat_id": 1}
+# Bucket bookkeeping fields that are not part of the public convo shape
+STORE_FIELDS = {"messages": 0, "count": 0, "bucket_size": 0}
+# Per-message fields kept out of API responses: the sequence index and token estimate
+INTERNAL_FIELDS = ("i", "tokens")
+
+
+def _reserve_filter(session_id):
+    # Embedded-layout sessions must be converted before indexes can be reserved,
+    # and deleted ones purged before their id is reused
+    return {"_id": session_id, "messages": {"$exists": False}, **NOT_DELETED}
+
+
+
+def _reserve_update(n, chat_id):
+    return {
+        "$inc": {"count": n},
+        "$setOnInsert": {"chat_id": chat_id, "created_at": datetime.utcnow(), "bucket_size": BUCKET_SIZE},
+    }
+
+
+def _new_session(session_id, chat_id, docs):
+    return {
+        "_id": session_id,
+        "chat_id": chat_id,
+        "created_at": datetime.utcnow(),
+        "count": len(docs),
+        "bucket_size": BUCKET_SIZE,
+    }
+
+
+def _indexed(docs, first_index):
+    return [dict(doc, i=first_index + k) for k, doc in enumerate(docs)]
+
+
+def _group(docs, size):
+    """Yield (seq, messages) for messages already carrying their index."""
+    groups = {}
+    for doc in docs:
+        groups.setdefault(doc["i"] // size, []).append(doc)
+    return sorted(groups.items())
+
+
+def _bucket_push(msgs):
+    return {"$push": {"messages": {"$each": msgs, "$sort": {"i": 1}}}}
+
+
+def _flatten(buckets):
+    return [m for b in buckets for m in b.get("messages", [])]
+
+
+def public_messages(messages):
+    """Messages without the fields only the store and prompt builder use."""
+    return [{k: v for k, v in m.items() if k not in INTERNAL_FIELDS} for m in messages]
+
+
+def _convo_shape(meta, messages):
+    return {
+        "_id": meta.get("_id"),
+        "session_id": meta.get("_id"),
+        "chat_id": meta.get("chat_id"),
+        "created_at": meta.get("created_at"),
+        "messages": public_messages(messages),
+    }
+
+
+def _page_bounds(total, limit, before, since=None):
+    """Index range [start, end) of the `limit` messages before `before` (default: the latest),
+    or with `since`, of the first `limit` messages from index `since` on."""
+    if since is not None:
+        start = min(since, total)
+        return start, min(total, start + limit)
+    end = total if before is None else max(0, min(before, total))
+    return max(0, end - limit), end
+
+
+def _page_cursor(start, end, since, msgs=None, total=None):
+    """``next_before`` for backward pages, ``next_since`` for forward ones.
+
+    Bucket pages (`msgs` given) can have holes in the latest turn, whose user
+    message or reply is reserved but not written yet; ``next_since`` stops at
+    the first one so it is fetched later. Older holes (a reply lost to a crash)
+    are skipped, or they would hold back every later sync.
+    """
+    if since is None:
+        return {"next_before": start or None}
+    if msgs is None:
+        return {"next_since": end}
+    present = {m.get("i") for m in msgs}
+    pending = max(start, (total if total is not None else end) - 2)
+    for i in range(pending, end):
+        if i not in present:
+            return {"next_since": i}
+    return {"next_since": end}
+
+
+def _embedded_page(doc, limit, before, since=None):
+    """Page of an embedded-layout document (converted sessions take the bucket path)."""
+    msgs = doc.get("messages", [])
+    start, end = _page_bounds(len(msgs), limit, before, since)
+    return dict(doc, messages=msgs[start:end], **_page_cursor(start, end, since))
+
+
+def _bucket_range(session_id, start, end, size):
+    return {"session_id": session_id, "seq": {"$gte": start // size, "$lte": (end - 1) // size}}
+
+
+def _conversion(doc, from_legacy, size):
+    """Plan the conversion of an embedded-layout document.
+
+    Returns (session_id, bucket upsert ops, meta fields).
+    """
+    session_id = doc["session_id"] if from_legacy else doc["_id"]
+    indexed = _indexed(doc.get("messages", []), 0)
+    # $addToSet, never a replace: a conversion running late must not drop messages
+    # pushed after another one finished, and copying the same messages twice is a no-op
+    ops = [
+        UpdateOne({"session_id": session_id, "seq": seq}, {"$addToSet": {"messages": {"$each": msgs}}}, upsert=True)
+        for seq, msgs in _group(indexed, size)
+    ]
+    return session_id, ops, {"count": len(indexed), "bucket_size": size}
+
+
+class Turn:
+    """Result of saving a user message: the context to prompt with and where the reply goes."""
+
+    def __init__(self, session_id, recent, reply_index, bucket_size):
+        self.session_id = session_id
+        self.recent = recent
+        self.reply_index = reply_index
+        self.bucket_size = bucket_size
+        # Set by append_reply; routes fill unanswered slots with a fallback reply
+        self.replied = False
+
+
+class ConvoStore:
+    def __init__(self, db, write_behind=None):
+        self.convos = db["convos"]
+        self.buckets = db["convo_buckets"]
+        self.conversations = db["conversations"]
+        # Optional MessageWriteBehind; message pushes are queued instead of written inline
+        self.write_behind = write_behind
+
+    def ensure_bucket_index(self):
+        self.buckets.create_index([("session_id", ASCENDING), ("seq", ASCENDING)], unique=True)
+
+    # ---- writes ----
+
+    def _reserve(self, session_id, n, chat_id=None, create=True, legacy=True):
+        """Reserve `n` message indexes. Returns the session meta after the $inc, or None."""
+        upsert = bool(chat_id) and create
+        for _ in range(4):
+            try:
+                meta = self.convos.find_one_and_update(
+                    _reserve_filter(session_id),
+                    _reserve_update(n, chat_id),
+                    projection=META_FIELDS,
+                    upsert=upsert,
+                    return_document=ReturnDocument.AFTER,
+                )
+            except DuplicateKeyError:
+                # An embedded-layout session, or another request created it first
+                meta = None
+            if meta is not None:
+                return meta
+            if not self.migrate_session(session_id, legacy=legacy):
+                if not create:
+                    return None
+                self._revive(session_id)
+                upsert = True
+        raise RuntimeError(f"could not reserve message index for session {session_id}")
+
+    def _push(self, session_id, docs, size):
+        for seq, msgs in _group(docs, size):
+            try:
+                self.buckets.update_one({"session_id": session_id, "seq": seq}, _bucket_push(msgs), upsert=True)
+            except DuplicateKeyError:
+                # Lost the race to create this bucket; it exists now
+                self.buckets.update_one({"session_id": session_id, "seq": seq}, _bucket_push(msgs))
+
+    def _save(self, session_id, docs, size):
+        """Push indexed messages now, or queue them in write-behind mode."""
+        if self.write_behind is None:
+            self._push(session_id, docs, size)
+        elif self.write_behind.add(session_id, docs, size):
+            # Queue is full: this request pays for the flush (backpressure)
+            self.write_behind.flush(self.buckets)
+
+    def _queued(self, session_id, start=0, end=None):
+        """Queued messages of the session with index in [start, end), to _merge into a read.
+
+        Take this before querying the buckets: a flush finishing in between then
+        leaves a message in both (deduplicated) instead of in neither.
+        """
+        if self.write_behind is None:
+            return []
+        return [m for m in self.write_behind.queued(session_id) if start <= m["i"] and (end is None or m["i"] < end)]
+
+    def append_user_message(self, session_id, chat_id, user_doc, limit=CONTEXT_MESSAGES):
+        """Save the user's message, reserving the next index for the reply.
+
+        Returns a Turn with the last `limit` messages (ending with this one).
+        Before the model call this takes two or three round trips:
+        - the index reservation
+        - a push into the tail bucket that returns the bucket
+        - a read of the older bucket(s), whenever the last `limit` messages
+          start before the tail bucket, which is most turns with the
+          default CONTEXT_MESSAGES == BUCKET_SIZE
+        append_reply adds one more write, so a turn is three to four in all.
+        In write-behind mode the push is queued and the context buckets are
+        read in one query instead.
+        """
+        meta = self._reserve(session_id, 2, chat_id)
+        size = meta["bucket_size"]
+        index = meta["count"] - 2
+        seq = index // size
+        doc = dict(user_doc, i=index)
+        first_seq = max(0, index + 1 - limit) // size
+        if self.write_behind is not None:
+            self._save(session_id, [doc], size)
+            queued = self._queued(session_id, first_seq * size, index + 1)
+            stored = self.buckets.find({"session_id": session_id, "seq": {"$gte": first_seq, "$lte": seq}}).sort("seq", 1)
+            msgs = _merge(_flatten(stored), queued)
+            recent = [m for m in msgs if m.get("i", -1) <= index][-limit:]
+            return Turn(session_id, recent, index + 1, size)
+        try:
+            bucket = self.buckets.find_one_and_update(
+                {"session_id": session_id, "seq": seq}, _bucket_push([doc]),
+                projection={"messages": 1}, upsert=True, return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            bucket = self.buckets.find_one_and_update(
+                {"session_id": session_id, "seq": seq}, _bucket_push([doc]),
+                projection={"messages": 1}, return_document=ReturnDocument.AFTER,
+            )
+        msgs = bucket.get("messages", [])
+        if first_seq < seq:
+            older = self.buckets.find({"session_id": session_id, "seq": {"$gte": first_seq, "$lt": seq}}).sort("seq", 1)
+            msgs = _flatten(older) + msgs
+        recent = [m for m in msgs if m.get("i", -1) <= index][-limit:]
+        return Turn(session_id, recent, index + 1, size)
+
+    def append_reply(self, turn, ai_doc):
+        """Write the assistant reply into the slot reserved by append_user_message (one round trip)."""
+        turn.replied = True
+        self._save(turn.session_id, [dict(ai_doc, i=turn.reply_index)], turn.bucket_size)
+
+    def append_messages(self, session_id, docs):
+        """Append messages to an existing convos session. Returns False if it does not exist."""
+        meta = self._reserve(session_id, len(docs), create=False, legacy=False)
+        if meta is None:
+            return False
+        self._save(session_id, _indexed(docs, meta["count"] - len(docs)), meta["bucket_size"])
+        return True
+
+    def create_session(self, session_id, chat_id, docs):
+        """Insert a new bucketed session; raises DuplicateKeyError if it exists."""
+        doc = _new_session(session_id, chat_id, docs)
+        try:
+            self.convos.insert_one(doc)
+        except DuplicateKeyError:
+            if not self._revive(session_id):
+                raise
+            self.convos.insert_one(doc)
+        self._push(session_id, _indexed(docs, 0), BUCKET_SIZE)
+
+    def delete_session(self, session_id):
+        """Mark a convos session deleted; the purger removes it. Returns the number of sessions marked."""
+        if self.write_behind is not None:
+            self.write_behind.discard(session_id)
+        res = self.convos.update_one({"_id": session_id, **NOT_DELETED}, tombstone())
+        return res.modified_count
+
+    def _revive(self, session_id):
+        """Purge a deleted session inline so its id can be reused. Returns True if there was one."""
+        # Tombstone first: a purger holding it fails its next renewal and stops
+        if self.convos.find_one_and_delete({"_id": session_id, **DELETED}, projection={"_id": 1}) is None:
+            return False
+        self.buckets.delete_many({"session_id": session_id})
+        return True
+
+    # ---- reads ----
+
+    def get_session(self, session_id):
+        """Return the session in the /messages convo shape, the raw legacy document, or None."""
+        meta = self.convos.find_one({"_id": session_id})
+        if meta is not None:
+            if "deleted_at" in meta:
+                return None
+            if "messages" in meta:
+                return _convo_shape(meta, meta["messages"])
+            queued = self._queued(session_id)
+            buckets = self.buckets.find({"session_id": session_id}).sort("seq", 1)
+            return _convo_shape(meta, _merge(_flatten(buckets), queued))
+        return self.conversations.find_one({"session_id": session_id})
+
+    def get_session_page(self, session_id, limit, before=None, since=None):
+        """Like get_session, but with only the `limit` messages before index `before`
+        (default: the latest) and `next_before` to request the page before it (None
+        once the first message is included). Reads only the buckets holding the page.
+
+        With `since`, the page runs forward instead: up to `limit` messages from
+        index `since` on, and `next_since` to ask for what came after them. Clients
+        keeping a local copy use it to fetch only new messages.
+        """
+        meta = self.convos.find_one({"_id": session_id})
+        if meta is None:
+            legacy = self.conversations.find_one({"session_id": session_id})
+            return _embedded_page(legacy, limit, before, since) if legacy is not None else None
+        if "deleted_at" in meta:
+            return None
+        if "messages" in meta:
+            return _embedded_page(_convo_shape(meta, meta["messages"]), limit, before, since)
+        start, end = _page_bounds(meta.get("count", 0), limit, before, since)
+        msgs = []
+        if end > start:
+            queued = self._queued(session_id, start, end)
+            buckets = self.buckets.find(_bucket_range(session_id, start, end, meta["bucket_size"])).sort("seq", 1)
+            msgs = _merge([m for m in _flatten(buckets) if start <= m.get("i", -1) < end], queued)
+        cursor = _page_cursor(start, end, since, msgs, meta.get("count", 0))
+        if since is not None:
+            # Whatever lies past a pending slot comes again with the next page
+            msgs = [m for m in msgs if m["i"] < cursor["next_since"]]
+        return dict(_convo_shape(meta, msgs), **cursor)
+
+    # ---- migration ----
+
+    def migrate_session(self, session_id, legacy=True):
+        """Convert one embedded-layout session to buckets. Returns True if one was converted."""
+        doc = self.convos.find_one({"_id": session_id, "messages": {"$exists": True}, **NOT_DELETED})
+        if doc is not None:
+            self._convert(doc, from_legacy=False)
+            return True
+        if legacy and self.convos.find_one({"_id": session_id}, {"_id": 1}) is None:
+            doc = self.conversations.find_one({"session_id": session_id})
+            if doc is not None:
+                self._convert(doc, from_legacy=True)
+                return True
+        return False
+
+    def _convert(self, doc, from_legacy):
+        while True:
+            session_id, ops, fields = _conversion(doc, from_legacy, BUCKET_SIZE)
+            if ops:
+                self.buckets.bulk_write(ops, ordered=False)
+            if from_legacy:
+                try:
+                    self.convos.insert_one({"_id": session_id, "chat_id": None, "created_at": doc.get("created_at") or datetime.utcnow(), **fields})
+                except DuplicateKeyError:
+                    pass  # converted concurrently
+                self.conversations.delete_one({"_id": doc["_id"]})
+                return
+            # Only drop the array if nobody appended to it while we were copying
+            res = self.convos.update_one(
+                {"_id": session_id, "messages": {"$size": fields["count"]}},
+                {"$unset": {"messages": ""}, "$set": fields},
+            )
+            if res.matched_count:
+                return
+            doc = self.convos.find_one({"_id": session_id, "messages": {"$exists": True}})
+            if doc is None:
+                return
+
+    def migrate_all(self, batch=100, progress=None):
+        """Convert every embedded-layout session. Safe to re-run; returns the number converted."""
+        converted = 0
+        sources = [
+            (self.convos, {"messages": {"$exists": True}, **NOT_DELETED}, "_id"),
+            (self.conversations, {}, "session_id"),
+        ]
+        for col, query, key in sources:
+            seen = 0
+            for doc in col.find(query, {key: 1}).batch_size(batch):
+                seen += 1
+                if self.migrate_session(doc[key]):
+                    converted += 1
+                if progress and seen % batch == 0:
+                    progress(f"[migrate] {col.name}: {seen} sessions checked, {converted} converted so far")
+            if progress:
+                progress(f"[migrate] {col.name}: done, {seen} sessions checked")
+        return converted
+
+
+class AsyncConvoStore:
+    """Motor twin of ConvoStore (same queries, awaited)."""
+
+    def __init__(self, db, write_behind=None):
+        self.convos = db["convos"]
+        self.buckets = db["convo_buckets"]
+        self.conversations = db["conversations"]
+        self.write_behind = write_behind
+
+    async def ensure_bucket_index(self):
+        await self.buckets.create_index([("session_id", ASCENDING), ("seq", ASCENDING)], unique=True)
+
+    async def _reserve(self, session_id, n, chat_id=None, create=True, legacy=True):
+        upsert = bool(chat_id) and create
+        for _ in range(4):
+            try:
+                meta = await self.convos.find_one_and_update(
+                    _reserve_filter(session_id),
+                    _reserve_update(n, chat_id),
+                    projection=META_FIELDS,
+                    upsert=upsert,
+                    return_document=ReturnDocument.AFTER,
+                )
+            except DuplicateKeyError:
+                meta = None
+            if meta is not None:
+                return meta
+            if not await self.migrate_session(session_id, legacy=legacy):
+                if not create:
+                    return None
+                await self._revive(session_id)
+                upsert = True
+        raise RuntimeError(f"could not reserve message index for session {session_id}")
+
+    async def _push(self, session_id, docs, size):
+        for seq, msgs in _group(docs, size):
+            try:
+                await self.buckets.update_one({"session_id": session_id, "seq": seq}, _bucket_push(msgs), upsert=True)
+            except DuplicateKeyError:
+                await self.buckets.update_one({"session_id": session_id, "seq": seq}, _bucket_push(msgs))
+
+    async def _save(self, session_id, docs, size):
+        if self.write_behind is None:
+            await self._push(session_id, docs, size)
+        elif self.write_behind.add(session_id, docs, size):
+            await self.write_behind.aflush(self.buckets)
+
+    _queued = ConvoStore._queued
+
+    async def append_user_message(self, session_id, chat_id, user_doc, limit=CONTEXT_MESSAGES):
+        meta = await self._reserve(session_id, 2, chat_id)
+        size = meta["bucket_size"]
+        index = meta["count"] - 2
+        seq = index // size
+        doc = dict(user_doc, i=index)
+        first_seq = max(0, index + 1 - limit) // size
+        if self.write_behind is not None:
+            await self._save(session_id, [doc], size)
+            queued = self._queued(session_id, first_seq * size, index + 1)
+            query = {"session_id": session_id, "seq": {"$gte": first_seq, "$lte": seq}}
+            stored = await self.buckets.find(query).sort("seq", 1).to_list(None)
+            msgs = _merge(_flatten(stored), queued)
+            recent = [m for m in msgs if m.get("i", -1) <= index][-limit:]
+            return Turn(session_id, recent, index + 1, size)
+        try:
+            bucket = await self.buckets.find_one_and_update(
+                {"session_id": session_id, "seq": seq}, _bucket_push([doc]),
+                projection={"messages": 1}, upsert=True, return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            bucket = await self.buckets.find_one_and_update(
+                {"session_id": session_id, "seq": seq}, _bucket_push([doc]),
+                projection={"messages": 1}, return_document=ReturnDocument.AFTER,
+            )
+        msgs = bucket.get("messages", [])
+        if first_seq < seq:
+            older = await self.buckets.find({"session_id": session_id, "seq": {"$gte": first_seq, "$lt": seq}}).sort("seq", 1).to_list(None)
+            msgs = _flatten(older) + msgs
+        recent = [m for m in msgs if m.get("i", -1) <= index][-limit:]
+        return Turn(session_id, recent, index + 1, size)
+
+    async def append_reply(self, turn, ai_doc):
+        turn.replied = True
+        await self._save(turn.session_id, [dict(ai_doc, i=turn.reply_index)], turn.bucket_size)
+
+    async def append_messages(self, session_id, docs):
+        meta = await self._reserve(session_id, len(docs), create=False, legacy=False)
+        if meta is None:
+            return False
+        await self._save(session_id, _indexed(docs, meta["count"] - len(docs)), meta["bucket_size"])
+        return True
+
+    async def create_session(self, session_id, chat_id, docs):
+        doc = _new_session(session_id, chat_id, docs)
+        try:
+            await self.convos.insert_one(doc)
+        except DuplicateKeyError:
+            if not await self._revive(session_id):
+                raise
+            await self.convos.insert_one(doc)
+        await self._push(session_id, _indexed(docs, 0), BUCKET_SIZE)
+
+    async def delete_session(self, session_id):
+        if self.write_behind is not None:
+            self.write_behind.discard(session_id)
+        res = await self.convos.update_one({"_id": session_id, **NOT_DELETED}, tombstone())
+        return res.modified_count
+
+    async def _revive(self, session_id):
+        if await self.convos.find_one_and_delete({"_id": session_id, **DELETED}, projection={"_id": 1}) is None:
+            return False
+        await self.buckets.delete_many({"session_id": session_id})
+        return True
+
+    async def get_session(self, session_id):
+        meta = await self.convos.find_one({"_id": session_id})
+        if meta is not None:
+            if "deleted_at" in meta:
+                return None
+            if "messages" in meta:
+                return _convo_shape(meta, meta["messages"])
+            queued = self._queued(session_id)
+            buckets = await self.buckets.find({"session_id": session_id}).sort("seq", 1).to_list(None)
+            return _convo_shape(meta, _merge(_flatten(buckets), queued))
+        return await self.conversations.find_one({"session_id": session_id})
+
+    async def get_session_page(self, session_id, limit, before=None, since=None):
+        meta = await self.convos.find_one({"_id": session_id})
+        if meta is None:
+            legacy = await self.conversations.find_one({"session_id": session_id})
+            return _embedded_page(legacy, limit, before, since) if legacy is not None else None
+        if "deleted_at" in meta:
+            return None
+        if "messages" in meta:
+            return _embedded_page(_convo_shape(meta, meta["messages"]), limit, before, since)
+        start, end = _page_bounds(meta.get("count", 0), limit, before, since)
+        msgs = []
+        if end > start:
+            queued = self._queued(session_id, start, end)
+            query = _bucket_range(session_id, start, end, meta["bucket_size"])
+            buckets = await self.buckets.find(query).sort("seq", 1).to_list(None)
+            msgs = _merge([m for m in _flatten(buckets) if start <= m.get("i", -1) < end], queued)
+        cursor = _page_cursor(start, end, since, msgs, meta.get("count", 0))
+        if since is not None:
+            # Whatever lies past a pending slot comes again with the next page
+            msgs = [m for m in msgs if m["i"] < cursor["next_since"]]
+        return dict(_convo_shape(meta, msgs), **cursor)
+
+    async def migrate_session(self, session_id, legacy=True):
+        doc = await self.convos.find_one({"_id": session_id, "messages": {"$exists": True}, **NOT_DELETED})
+        if doc is not None:
+            await self._convert(doc, from_legacy=False)
+            return True
+        if legacy and await self.convos.find_one({"_id": session_id}, {"_id": 1}) is None:
+            doc = await self.conversations.find_one({"session_id": session_id})
+            if doc is not None:
+                await self._convert(doc, from_legacy=True)
+                return True
+        return False
+
+    async def _convert(self, doc, from_legacy):
+        while True:
+            session_id, ops, fields = _conversion(doc, from_legacy, BUCKET_SIZE)
+            if ops:
+                await self.buckets.bulk_write(ops, ordered=False)
+            if from_legacy:
+                try:
+                    await self.convos.insert_one({"_id": session_id, "chat_id": None, "created_at": doc.get("created_at") or datetime.utcnow(), **fields})
+                except DuplicateKeyError:
+                    pass
+                await self.conversations.delete_one({"_id": doc["_id"]})
+                return
+            res = await self.convos.update_one(
+                {"_id": session_id, "messages": {"$size": fields["count"]}},
+                {"$unset": {"messages": ""}, "$set": fields},
+            )
+            if res.matched_count:
+                return
+            doc = await self.convos.find_one({"_id": session_id, "messages": {"$exists": True}})
+            if doc is None:
+                return
+
+
+class ChatTouchBatcher:
+    """Coalesces chats.updated_at bumps into one bulk_write per interval.
+
+    Only the newest timestamp per chat is kept, and ``$max`` makes the write
+    safe against out-of-order flushes from several processes.
+    """
+
+    def __init__(self):
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def touch(self, chat_id, when=None):
+        when = when or datetime.utcnow()
+        with self._lock:
+            if when > self._pending.get(chat_id, datetime.min):
+                self._pending[chat_id] = when
+
+    def _take(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        return pending
+
+    def _requeue(self, pending):
+        for chat_id, when in pending.items():
+            self.touch(chat_id, when)
+
+    @staticmethod
+    def _ops(pending):
+        return [UpdateOne({"_id": chat_id}, {"$max": {"updated_at": when}}) for chat_id, when in pending.items()]
+
+    def flush(self, chats_col):
+        """Write pending bumps; they are kept for the next flush if the write fails."""
+        pending = self._take()
+        if not pending:
+            return 0
+        try:
+            chats_col.bulk_write(self._ops(pending), ordered=False)
+        except Exception:
+            self._requeue(pending)
+            raise
+        return len(pending)
+
+    async def aflush(self, chats_col):
+        pending = self._take()
+        if not pending:
+            return 0
+        try:
+            await chats_col.bulk_write(self._ops(pending), ordered=False)
+        except Exception:
+            self._requeue(pending)
+            raise
+        return len(pending)
+
+    def start(self, chats_col, interval=CHAT_TOUCH_INTERVAL):
+        """Flush from a daemon thread every `interval` seconds."""
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.flush(chats_col)
+                except Exception as e:
+                    print("[store] chat touch flush failed:", e)
+
+        thread = threading.Thread(target=run, name="chat-touch-flusher", daemon=True)
+        thread.start()
+        return thread
+
+
+def _bucket_filter(session_id, msgs, size):
+    # Matches only while none of the messages is in the bucket, so writing a
+    # push again (requeued after a failure that had partly applied) is a no-op
+    return {"session_id": session_id, "seq": msgs[0]["i"] // size, "messages.i": {"$nin": [m["i"] for m in msgs]}}
+
+
+def _merge(stored, queued):
+    """Stored messages plus queued ones not written yet, ordered by index."""
+    if not queued:
+        return stored
+    by_index = {m.get("i"): m for m in stored}
+    for m in queued:
+        by_index.setdefault(m["i"], m)
+    return sorted(by_index.values(), key=lambda m: m.get("i", -1))
+
+
+class MessageWriteBehind:
+    """Queue of bucket pushes written as grouped bulk_writes (WRITE_BEHIND=true).
+
+    Messages already carry their reserved index, and every bucket push sorts
+    by it, so the order flushes land in never changes the order of a session.
+    Pushes for the same bucket are merged into one update. Queued and in-flight
+    messages are visible through ``queued()`` so reads of a session see them
+    before they are written.
+
+    A flush is due every ``interval`` seconds or once ``max_batch`` messages are
+    queued. Past ``max_pending`` messages, ``add`` tells the caller to flush
+    inline, so producers slow down to the speed of Mongo instead of growing
+    the queue. Failed writes are requeued; a push only applies while none of
+    its messages is in the bucket, so one that had landed before the failure
+    is not written twice.
+    """
+
+    def __init__(self, max_batch=None, max_pending=None, interval=None):
+        self.max_batch = max_batch or WRITE_BEHIND_BATCH
+        self.max_pending = max_pending or WRITE_BEHIND_MAX_PENDING
+        self.interval = interval or WRITE_BEHIND_INTERVAL
+        self._pending = []     # [(session_id, bucket_size, messages)] in arrival order
+        self._in_flight = []
+        self._count = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._aflush_lock = None
+        self._due = threading.Event()
+        # asyncio counterpart of _due and the loop it belongs to (set by wait_due)
+        self._adue = None
+        self._loop = None
+        self.flushes = 0
+        self.written = 0
+        self.backpressure = 0
+        self.failures = 0
+
+    def add(self, session_id, docs, size):
+        """Queue messages (already indexed). Returns True if the caller must flush now."""
+        with self._lock:
+            self._pending.append((session_id, size, list(docs)))
+            self._count += len(docs)
+            if self._count >= self.max_batch:
+                self._due.set()
+                if self._loop is not None:
+                    try:
+                        self._loop.call_soon_threadsafe(self._adue.set)
+                    except RuntimeError:
+                        pass  # loop closed
+            full = self._count >= self.max_pending
+            if full:
+                self.backpressure += 1
+        return full
+
+    def queued(self, session_id):
+        """Messages of `session_id` that may not be in Mongo yet."""
+        with self._lock:
+            return [
+                m
+                for entries in (self._in_flight, self._pending)
+                for sid, _, msgs in entries if sid == session_id
+                for m in msgs
+            ]
+
+    def discard(self, session_id):
+        """Drop queued messages of a session that is being deleted.
+
+        Messages already in flight still land and can leave an orphan bucket.
+        """
+        with self._lock:
+            kept = [entry for entry in self._pending if entry[0] != session_id]
+            self._count -= sum(len(msgs) for sid, _, msgs in self._pending if sid == session_id)
+            self._pending = kept
+
+    def _take(self):
+        with self._lock:
+            entries, self._pending, self._count = self._pending, [], 0
+            self._in_flight = entries
+            self._due.clear()
+        return self._merged(entries)
+
+    def _finish(self, entries, failed):
+        with self._lock:
+            self._in_flight = []
+            if failed:
+                self._pending = failed + self._pending
+                self._count += sum(len(msgs) for _, _, msgs in failed)
+                self.failures += 1
+            if entries:
+                self.flushes += 1
+                self.written += sum(len(msgs) for _, _, msgs in entries) - sum(len(msgs) for _, _, msgs in failed)
+
+    @staticmethod
+    def _merged(entries):
+        """One (session_id, size, messages) entry per bucket, in arrival order."""
+        grouped = {}
+        for session_id, size, msgs in entries:
+            for seq, group in _group(msgs, size):
+                grouped.setdefault((session_id, seq), (session_id, size, []))[2].extend(group)
+        return list(grouped.values())
+
+    @staticmethod
+    def _ops(entries, upsert):
+        return [
+            UpdateOne(_bucket_filter(session_id, msgs, size), _bucket_push(msgs), upsert=upsert)
+            for session_id, size, msgs in entries
+        ]
+
+    @staticmethod
+    def _unapplied(error, entries):
+        """(entries to retry without upsert, entries that failed) from a BulkWriteError."""
+        errors = error.details.get("writeErrors", [])
+        if all(err.get("code") == 11000 for err in errors):
+            # Lost races to create these buckets; they exist now
+            return [entries[err["index"]] for err in errors], []
+        return [], [entries[err["index"]] for err in errors]
+
+    @staticmethod
+    def _singles(entries):
+        return [(session_id, size, [m]) for session_id, size, msgs in entries for m in msgs]
+
+    @classmethod
+    def _partly_stored(cls, result, entries, upsert):
+        """Entries to push again one message at a time, after a retry without upsert.
+
+        Such a retry only follows a duplicate key on upsert, so the buckets exist;
+        a push that matched nothing holds messages already stored, possibly next
+        to new ones merged into it after a failed flush.
+        """
+        if upsert or result.matched_count >= len(entries):
+            return []
+        singles = cls._singles(entries)
+        return singles if len(singles) > len(entries) else []
+
+    def _write(self, buckets, entries, upsert=True):
+        """bulk_write the entries; returns the ones that were not applied."""
+        try:
+            result = buckets.bulk_write(self._ops(entries, upsert), ordered=False)
+        except BulkWriteError as e:
+            retry, failed = self._unapplied(e, entries)
+            if retry and upsert:
+                return self._write(buckets, retry, upsert=False)
+            return failed or retry
+        singles = self._partly_stored(result, entries, upsert)
+        return self._write(buckets, singles, upsert=False) if singles else []
+
+    async def _awrite(self, buckets, entries, upsert=True):
+        try:
+            result = await buckets.bulk_write(self._ops(entries, upsert), ordered=False)
+        except BulkWriteError as e:
+            retry, failed = self._unapplied(e, entries)
+            if retry and upsert:
+                return await self._awrite(buckets, retry, upsert=False)
+            return failed or retry
+        singles = self._partly_stored(result, entries, upsert)
+        return await self._awrite(buckets, singles, upsert=False) if singles else []
+
+    def flush(self, buckets):
+        """Write everything queued; unapplied pushes are requeued. Returns the number of bucket updates."""
+        with self._flush_lock:
+            entries = self._take()
+            failed = entries
+            try:
+                failed = self._write(buckets, entries) if entries else []
+            finally:
+                self._finish(entries, failed)
+        if failed:
+            raise RuntimeError(f"{len(failed)} bucket updates failed and were requeued")
+        return len(entries)
+
+    async def aflush(self, buckets):
+        if self._aflush_lock is None:
+            self._aflush_lock = asyncio.Lock()
+        async with self._aflush_lock:
+            entries = self._take()
+            failed = entries
+            try:
+                failed = await self._awrite(buckets, entries) if entries else []
+            finally:
+                self._finish(entries, failed)
+        if failed:
+            raise RuntimeError(f"{len(failed)} bucket updates failed and were requeued")
+        return len(entries)
+
+    async def wait_due(self):
+        """Sleep until a flush is due: `interval` seconds, or sooner once a batch is full."""
+        if self._adue is None:
+            self._adue = asyncio.Event()
+            self._loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._count >= self.max_batch:
+                return
+        try:
+            await asyncio.wait_for(self._adue.wait(), self.interval)
+        except asyncio.TimeoutError:
+            pass
+        self._adue.clear()
+
+    def start(self, buckets):
+        """Flush from a daemon thread every `interval` seconds, or sooner once a batch is full."""
+        def run():
+            while True:
+                self._due.wait(self.interval)
+                try:
+                    self.flush(buckets)
+                except Exception as e:
+                    print("[store] message write-behind flush failed:", e)
+
+        thread = threading.Thread(target=run, name="message-write-behind", daemon=True)
+        thread.start()
+        return thread
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queued": self._count,
+                "in_flight": sum(len(msgs) for _, _, msgs in self._in_flight),
+                "flushes": self.flushes,
+                "written": self.written,
+                "backpressure": self.backpressure,
+                "failures": self.failures,
+            }
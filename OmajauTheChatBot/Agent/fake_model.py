@@ -0,0 +1,133 @@
+"""Deterministic stand-in for the Gemini chat model (MODEL_BACKEND=fake).
+
+Implements the part of the LangChain chat model interface the apps use
+(``invoke``/``ainvoke``/``stream``/``astream``) without network or quota, so
+auth, Mongo and serialization can be load-tested and profiled offline.
+
+Every call is seeded from ``seed`` and the prompt text, so the same prompt
+always gets the same reply, latency and failure decision. Timing follows
+a configurable first-token latency distribution followed by ``tokens_per_sec``
+streaming, and ``error_rate`` injects failures (some before the first token,
+some mid-stream). Retries and hedged requests from model_calls.py
+(``config={"metadata": {"attempt": n}}``) keep the reply but draw their own
+latency and failure.
+"""
+import asyncio
+import hashlib
+import math
+import random
+import time
+from typing import Iterator, List
+
+from langchain_core.messages import AIMessage, AIMessageChunk
+
+WORDS = (
+    "hey", "sure", "omaju", "here", "is", "a", "quick", "thought", "about", "that", "and",
+    "maybe", "we", "can", "try", "something", "fun", "together", "buddy", "really", "nice",
+    "question", "let", "me", "think", "it", "through", "step", "by", "so", "the", "answer",
+)
+
+
+class FakeModelError(RuntimeError):
+    """Injected model failure."""
+
+
+def _attempt(config):
+    """Attempt number passed by model_calls.py in the LangChain run config."""
+    return int(((config or {}).get("metadata") or {}).get("attempt", 0))
+
+
+class FakeChatModel:
+    """Fake chat model with seeded latency, token rate and error injection."""
+
+    DISTRIBUTIONS = ("const", "uniform", "exp", "lognormal")
+
+    def __init__(self, latency_ms=300.0, jitter_ms=100.0, distribution="lognormal",
+                 tokens_per_sec=50.0, reply_tokens=60, error_rate=0.0, seed=0):
+        if distribution not in self.DISTRIBUTIONS:
+            raise ValueError(f"unknown latency distribution {distribution!r} (expected one of {self.DISTRIBUTIONS})")
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.distribution = distribution
+        self.tokens_per_sec = tokens_per_sec
+        self.reply_tokens = reply_tokens
+        self.error_rate = error_rate
+        self.seed = seed
+        self.model = "fake"
+
+    # ---- planning (pure, shared by sync and async paths) ----
+
+    def _rng(self, messages, attempt=0) -> random.Random:
+        seed = f"{self.seed}/{attempt}" if attempt else str(self.seed)
+        h = hashlib.sha256(seed.encode("utf-8"))
+        for msg in messages:
+            h.update(b"\x1e")
+            h.update(str(getattr(msg, "content", msg)).encode("utf-8"))
+        return random.Random(h.digest())
+
+    def _first_token_delay(self, rng: random.Random) -> float:
+        mean, jitter = self.latency_ms, self.jitter_ms
+        if self.distribution == "const":
+            ms = mean
+        elif self.distribution == "uniform":
+            ms = rng.uniform(mean - jitter, mean + jitter)
+        elif self.distribution == "exp":
+            ms = rng.expovariate(1.0 / mean) if mean > 0 else 0.0
+        else:
+            # lognormal with the given mean and standard deviation
+            if mean > 0:
+                sigma2 = math.log(1 + (jitter / mean) ** 2)
+                ms = rng.lognormvariate(math.log(mean) - sigma2 / 2, math.sqrt(sigma2))
+            else:
+                ms = 0.0
+        return max(0.0, ms) / 1000.0
+
+    def _plan(self, messages, attempt=0):
+        """Returns (first-token delay, per-token delay, tokens, index of the failing token or None)."""
+        rng = self._rng(messages)
+        delay = self._first_token_delay(rng)
+        tokens = [rng.choice(WORDS) + " " for _ in range(max(1, self.reply_tokens))]
+        tokens[0] = tokens[0].capitalize()
+        if attempt:
+            # Retries and hedges get the same reply with their own latency and failure draws
+            rng = self._rng(messages, attempt)
+            delay = self._first_token_delay(rng)
+        per_token = 1.0 / self.tokens_per_sec if self.tokens_per_sec > 0 else 0.0
+        fail_at = None
+        if rng.random() < self.error_rate:
+            # Half the failures happen before anything is produced
+            fail_at = 0 if rng.random() < 0.5 else rng.randrange(len(tokens))
+        return delay, per_token, tokens, fail_at
+
+    @staticmethod
+    def _fail(fail_at, k):
+        if fail_at is not None and k == fail_at:
+            raise FakeModelError(f"injected fake model failure at token {k}")
+
+    # ---- LangChain-compatible surface ----
+
+    def stream(self, messages, config=None) -> Iterator[AIMessageChunk]:
+        delay, per_token, tokens, fail_at = self._plan(messages, _attempt(config))
+        time.sleep(delay)
+        for k, token in enumerate(tokens):
+            self._fail(fail_at, k)
+            if k:
+                time.sleep(per_token)
+            yield AIMessageChunk(content=token)
+
+    async def astream(self, messages, config=None):
+        delay, per_token, tokens, fail_at = self._plan(messages, _attempt(config))
+        await asyncio.sleep(delay)
+        for k, token in enumerate(tokens):
+            self._fail(fail_at, k)
+            if k:
+                await asyncio.sleep(per_token)
+            yield AIMessageChunk(content=token)
+
+    def invoke(self, messages, config=None) -> AIMessage:
+        parts: List[str] = [chunk.content for chunk in self.stream(messages, config)]
+        return AIMessage(content="".join(parts).rstrip())
+
+    async def ainvoke(self, messages, config=None) -> AIMessage:
+        parts: List[str] = [chunk.content async for chunk in self.astream(messages, config)]
+        return AIMessage(content="".join(parts).rstrip())
@@ -0,0 +1,115 @@
+"""Index bootstrap and query-plan diagnostics.
+
+``INDEXES`` lists the indexes the routes rely on; ``ensure_indexes`` creates
+any that are missing (create_index is a no-op for existing ones). Both apps
+run it at startup unless ENSURE_INDEXES=false, and
+``flask --app app ensure-indexes`` runs it by hand.
+
+``explain_queries`` runs ``explain()`` on the query behind each route and
+flags plans that scan the whole collection (COLLSCAN) or sort in memory
+(SORT), i.e. plans no index covers.
+"""
+import logging
+
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+
+from purger import DELETED, NOT_DELETED
+
+# Deleted chats and sessions waiting for the purger (only tombstones are indexed)
+TOMBSTONES = ([("deleted_at", ASCENDING)], {"partialFilterExpression": {"deleted_at": {"$exists": True}}})
+
+# collection -> [(keys, options)]
+INDEXES = {
+    # GET /chats/<uid>: {uid} sorted by updated_at desc
+    "chats": [([("uid", ASCENDING), ("updated_at", DESCENDING), ("_id", DESCENDING)], {}), TOMBSTONES],
+    # GET /convos/<chat_id>: {chat_id} sorted by created_at desc; the purger finds a chat's sessions by chat_id
+    "convos": [([("chat_id", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)], {}), TOMBSTONES],
+    # Legacy sessions are looked up by session_id
+    "conversations": [([("session_id", ASCENDING)], {})],
+    # Message buckets, one per (session, seq)
+    "convo_buckets": [([("session_id", ASCENDING), ("seq", ASCENDING)], {"unique": True})],
+}
+
+# (label, collection, operation, filter, sort)
+QUERIES = [
+    ("GET /chats/<uid>", "chats", "find", {"uid": "uid", **NOT_DELETED}, [("updated_at", DESCENDING)]),
+    ("GET /convos/<chat_id>", "convos", "find", {"chat_id": "chat_id", **NOT_DELETED}, [("created_at", DESCENDING)]),
+    ("purge: claim chat", "chats", "find", DELETED, [("deleted_at", ASCENDING)]),
+    ("purge: claim session", "convos", "find", DELETED, [("deleted_at", ASCENDING)]),
+    ("purge: sessions of a chat", "convos", "find", {"chat_id": "chat_id"}, None),
+    ("GET /messages/<session_id> (legacy)", "conversations", "find", {"session_id": "session_id"}, None),
+    ("GET /messages/<session_id> (buckets)", "convo_buckets", "find", {"session_id": "session_id"}, [("seq", ASCENDING)]),
+    ("POST /chat (context buckets)", "convo_buckets", "find",
+     {"session_id": "session_id", "seq": {"$gte": 0, "$lt": 1}}, [("seq", ASCENDING)]),
+]
+
+BAD_STAGES = ("COLLSCAN", "SORT")
+
+
+def ensure_indexes(db):
+    """Create missing indexes. Returns {collection: [index names]}."""
+    created = {}
+    for name, specs in INDEXES.items():
+        for keys, options in specs:
+            try:
+                created.setdefault(name, []).append(db[name].create_index(keys, **options))
+            except OperationFailure as e:
+                # e.g. an equivalent index exists under another name; leave it alone
+                logging.warning("[indexes] %s %s: %s", name, keys, e)
+    return created
+
+
+async def aensure_indexes(db):
+    """Motor twin of ensure_indexes."""
+    created = {}
+    for name, specs in INDEXES.items():
+        for keys, options in specs:
+            try:
+                created.setdefault(name, []).append(await db[name].create_index(keys, **options))
+            except OperationFailure as e:
+                logging.warning("[indexes] %s %s: %s", name, keys, e)
+    return created
+
+
+def _stages(plan):
+    """All stage names in an explain plan tree (classic and SBE layouts)."""
+    found = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            found.append(plan["stage"])
+        for value in plan.values():
+            found.extend(_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            found.extend(_stages(value))
+    return found
+
+
+def _explain(db, collection, operation, query, sort):
+    if operation == "delete":
+        return db.command(
+            "explain",
+            {"delete": collection, "deletes": [{"q": query, "limit": 0}]},
+            verbosity="queryPlanner",
+        )
+    cursor = db[collection].find(query)
+    if sort:
+        cursor = cursor.sort(sort)
+    return cursor.explain()
+
+
+def explain_queries(db):
+    """Explain each route query. Returns [{route, collection, stages, flagged}]."""
+    report = []
+    for label, collection, operation, query, sort in QUERIES:
+        explained = _explain(db, collection, operation, query, sort)
+        winning = explained.get("queryPlanner", {}).get("winningPlan", {})
+        stages = _stages(winning)
+        report.append({
+            "route": label,
+            "collection": collection,
+            "stages": stages,
+            "flagged": sorted({s for s in stages if s in BAD_STAGES}),
+        })
+    return report
@@ -0,0 +1,259 @@
+"""Admission control in front of the model.
+
+At most ``max_in_flight`` model calls run at once. Requests beyond that wait
+in per-user queues served round-robin, so one user firing many requests
+cannot starve everyone else. A user with ``max_queue_per_user`` requests
+already waiting gets a fast 429, a full global queue (``max_queue``) or a
+wait longer than ``max_wait`` seconds a 503, both with a Retry-After hint
+derived from recent model call durations.
+
+The same scheduler serves threads (``acquire``) and asyncio tasks
+(``aacquire``); the returned ``Slot`` is released exactly once, either
+explicitly or as a context manager. ``hold`` takes a slot without waiting,
+for model work that outlives its request (see model_calls.py).
+"""
+import asyncio
+import math
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Any, Dict
+
+
+class SchedulerBusy(Exception):
+    """No model slot available; answer with ``status`` and Retry-After."""
+
+    def __init__(self, status: int, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    __slots__ = ("uid", "granted", "event", "loop", "future")
+
+    def __init__(self, uid, event=None, loop=None, future=None):
+        self.uid = uid
+        self.granted = False
+        self.event = event
+        self.loop = loop
+        self.future = future
+
+    def wake(self):
+        if self.event is not None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(self._resolve)
+
+    def _resolve(self):
+        if not self.future.done():
+            self.future.set_result(True)
+
+
+class Slot:
+    """A held model slot."""
+
+    def __init__(self, scheduler):
+        self._scheduler = scheduler
+        self._started = time.monotonic()
+        self._released = False
+        self._lock = threading.Lock()
+
+    def release(self):
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        self._scheduler._release(time.monotonic() - self._started)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class _HeldSlot(Slot):
+    """Slot taken by ModelScheduler.hold."""
+
+    def release(self):
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        self._scheduler._release_held()
+
+
+class ModelScheduler:
+    # Upper bounds (ms) of the queue-wait distribution buckets
+    WAIT_BOUNDS = (1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+    def __init__(self, max_in_flight=32, max_queue_per_user=4, max_queue=256, max_wait=30.0, retry_after=2.0):
+        self.max_in_flight = max_in_flight
+        self.max_queue_per_user = max_queue_per_user
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.retry_after = retry_after
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._held = 0
+        self._queues: "OrderedDict[str, deque]" = OrderedDict()
+        self._queued = 0
+        self._avg_hold = None
+        self.admitted = 0
+        self.rejected_user = 0
+        self.rejected_full = 0
+        self.timeouts = 0
+        self.max_queued = 0
+        self._waits = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._wait_buckets = [0] * (len(self.WAIT_BOUNDS) + 1)
+
+    # ---- admission ----
+
+    def _retry_after_locked(self):
+        """Seconds until a slot is likely free for a request queued now."""
+        if not self._avg_hold or self.max_in_flight <= 0:
+            return max(1, math.ceil(self.retry_after))
+        estimate = self._avg_hold * (self._queued + 1) / self.max_in_flight
+        return max(1, math.ceil(max(estimate, self.retry_after)))
+
+    def _enter(self, uid, make_waiter):
+        """Take a free slot (returns None) or queue a waiter (returns it)."""
+        with self._lock:
+            if self.max_in_flight <= 0 or (self._in_flight < self.max_in_flight and not self._queued):
+                self._in_flight += 1
+                self.admitted += 1
+                return None
+            queue = self._queues.get(uid)
+            if queue is not None and len(queue) >= self.max_queue_per_user:
+                self.rejected_user += 1
+                raise SchedulerBusy(429, "Too many requests in progress for this user", self._retry_after_locked())
+            if self._queued >= self.max_queue:
+                self.rejected_full += 1
+                raise SchedulerBusy(503, "Model is busy, please retry", self._retry_after_locked())
+            waiter = make_waiter()
+            if queue is None:
+                queue = self._queues[uid] = deque()
+            queue.append(waiter)
+            self._queued += 1
+            self.max_queued = max(self.max_queued, self._queued)
+            return waiter
+
+    def _settle(self, waiter):
+        """After waiting: True if the slot was handed over, else dequeue and return False."""
+        with self._lock:
+            if waiter.granted:
+                self.admitted += 1
+                return True
+            queue = self._queues.get(waiter.uid)
+            if queue is not None:
+                queue.remove(waiter)
+                if not queue:
+                    del self._queues[waiter.uid]
+                self._queued -= 1
+            return False
+
+    def _timed_out(self):
+        with self._lock:
+            self.timeouts += 1
+            retry_after = self._retry_after_locked()
+        return SchedulerBusy(503, "Timed out waiting for the model, please retry", retry_after)
+
+    def acquire(self, uid) -> Slot:
+        """Block until a slot is free; raises SchedulerBusy instead of queueing without bound."""
+        started = time.monotonic()
+        waiter = self._enter(uid, lambda: _Waiter(uid, event=threading.Event()))
+        if waiter is not None:
+            waiter.event.wait(self.max_wait)
+            if not self._settle(waiter):
+                raise self._timed_out()
+        self._record_wait(time.monotonic() - started)
+        return Slot(self)
+
+    async def aacquire(self, uid) -> Slot:
+        """Async acquire; waiting does not block the event loop."""
+        started = time.monotonic()
+        loop = asyncio.get_running_loop()
+        waiter = self._enter(uid, lambda: _Waiter(uid, loop=loop, future=loop.create_future()))
+        if waiter is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(waiter.future), self.max_wait)
+            except asyncio.TimeoutError:
+                pass
+            except asyncio.CancelledError:
+                # Caller went away: give back a slot handed over in the meantime
+                if self._settle(waiter):
+                    self._release(None)
+                raise
+            if not self._settle(waiter):
+                raise self._timed_out()
+        self._record_wait(time.monotonic() - started)
+        return Slot(self)
+
+    def hold(self) -> Slot:
+        """Count work that is already running against ``max_in_flight``, even past it.
+
+        The work cannot wait for a slot, but while it holds one new requests queue.
+        """
+        with self._lock:
+            self._in_flight += 1
+            self._held += 1
+        return _HeldSlot(self)
+
+    def _release_held(self):
+        with self._lock:
+            self._held -= 1
+        self._release(None)
+
+    def _release(self, held):
+        with self._lock:
+            if held is not None:
+                self._avg_hold = held if self._avg_hold is None else 0.9 * self._avg_hold + 0.1 * held
+            if self._queues and self._in_flight <= self.max_in_flight:
+                # Hand the slot straight to the next user in round-robin order
+                uid, queue = next(iter(self._queues.items()))
+                waiter = queue.popleft()
+                self._queued -= 1
+                if queue:
+                    self._queues.move_to_end(uid)
+                else:
+                    del self._queues[uid]
+                waiter.granted = True
+                waiter.wake()
+                return
+            self._in_flight -= 1
+
+    # ---- metrics ----
+
+    def _record_wait(self, seconds):
+        ms = seconds * 1000
+        slot = next((k for k, bound in enumerate(self.WAIT_BOUNDS) if ms <= bound), len(self.WAIT_BOUNDS))
+        with self._lock:
+            self._waits += 1
+            self._wait_total += seconds
+            self._wait_max = max(self._wait_max, seconds)
+            self._wait_buckets[slot] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            labels = [f"<={bound}" for bound in self.WAIT_BOUNDS] + [f">{self.WAIT_BOUNDS[-1]}"]
+            return {
+                "in_flight": self._in_flight,
+                "held": self._held,
+                "max_in_flight": self.max_in_flight,
+                "queued": self._queued,
+                "queued_users": len(self._queues),
+                "max_queued": self.max_queued,
+                "admitted": self.admitted,
+                "rejected_user": self.rejected_user,
+                "rejected_full": self.rejected_full,
+                "timeouts": self.timeouts,
+                "wait_ms": {
+                    "avg": round(self._wait_total / self._waits * 1000, 2) if self._waits else 0.0,
+                    "max": round(self._wait_max * 1000, 2),
+                    "distribution": dict(zip(labels, self._wait_buckets)),
+                },
+            }
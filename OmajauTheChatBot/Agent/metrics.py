@@ -0,0 +1,298 @@
+"""Prometheus metrics for the Omaju backend, served at /metrics.
+
+A small in-process registry (counters, gauges and histograms with labels)
+rendered in the Prometheus text format. Recording is a dict lookup, a bisect
+and a few additions under a per-metric lock, cheap enough to leave on in
+production. Values are per process: with several workers, scrape each one.
+
+Besides per-route request counts and latencies, ``omaju_stage_seconds``
+splits request time into stages:
+
+- ``auth``: token validation, cache hits included
+- ``prompt``: selecting history and building the LangChain messages
+- ``model``: the /chat model call, retries and hedges included
+- ``model_stream``: a /chat/stream generation, first byte to last
+- ``serialization``: JSON response encoding
+
+MongoDB time is recorded per command and collection by
+``MongoCommandMetrics``, a pymongo command listener, so queries issued by
+background flushes and by Motor are covered too.
+
+For requests that opted in (``begin_request_stages``), stage and MongoDB
+times are also summed per request for the Server-Timing header.
+"""
+import bisect
+import functools
+import inspect
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Tuple
+
+from pymongo import monitoring
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+MONGO_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+TOKEN_BUCKETS = (250, 500, 1000, 2000, 4000, 8000, 16000, 32000)
+HISTORY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+# Per-request stage totals (seconds) for Server-Timing; None when the request did not opt in
+_request_stages: ContextVar = ContextVar("request_stages", default=None)
+
+
+def begin_request_stages() -> Dict[str, float]:
+    stages = {}
+    _request_stages.set(stages)
+    return stages
+
+
+def end_request_stages():
+    _request_stages.set(None)
+
+
+def _add_request_stage(stage, seconds):
+    stages = _request_stages.get()
+    if stages is not None:
+        stages[stage] = stages.get(stage, 0.0) + seconds
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values, extra=()) -> str:
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _number(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value)) if abs(value) < 1e15 else repr(value)
+    return repr(value)
+
+
+class _Metric:
+    TYPE = ""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple, object] = {}
+
+    def _key(self, labelvalues):
+        if len(labelvalues) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {labelvalues}")
+        return tuple(str(v) for v in labelvalues)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.TYPE}"]
+        with self._lock:
+            items = sorted(self._values.items())
+            lines.extend(self._render_samples(items))
+        return lines
+
+    def _render_samples(self, items):
+        return [f"{self.name}{_labels(self.labelnames, key)} {_number(value)}" for key, value in items]
+
+
+class Counter(_Metric):
+    TYPE = "counter"
+
+    def inc(self, *labelvalues, amount=1):
+        key = self._key(labelvalues)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    TYPE = "gauge"
+
+    def inc(self, *labelvalues, amount=1):
+        key = self._key(labelvalues)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, *labelvalues, amount=1):
+        self.inc(*labelvalues, amount=-amount)
+
+    def set(self, value, *labelvalues):
+        key = self._key(labelvalues)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    TYPE = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labelvalues):
+        key = self._key(labelvalues)
+        slot = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # per-bucket counts (last one is +Inf), then sum
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][slot] += 1
+            state[1] += value
+
+    @contextmanager
+    def time(self, *labelvalues):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labelvalues)
+
+    def _render_samples(self, items):
+        lines = []
+        bounds = [_number(float(b)) for b in self.buckets] + ["+Inf"]
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+class _StageHistogram(Histogram):
+    def observe(self, value, *labelvalues):
+        super().observe(value, *labelvalues)
+        _add_request_stage(labelvalues[0], value)
+
+
+class _Callback:
+    """A value read at scrape time (e.g. queue depth from a stats() dict)."""
+
+    def __init__(self, name, documentation, fn: Callable[[], float], kind="gauge"):
+        self.name = name
+        self.documentation = documentation
+        self.fn = fn
+        self.kind = kind
+
+    def render(self) -> List[str]:
+        try:
+            value = self.fn()
+        except Exception:
+            return []
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}", f"{self.name} {_number(value)}"]
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, object] = {}
+
+    def _add(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"metric {metric.name} already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()) -> Counter:
+        return self._add(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()) -> Gauge:
+        return self._add(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS, cls=Histogram) -> Histogram:
+        return self._add(cls(name, documentation, labelnames, buckets))
+
+    def callback(self, name, documentation, fn, kind="gauge"):
+        """Register (or replace, e.g. on app reload) a value computed at scrape time."""
+        with self._lock:
+            self._metrics[name] = _Callback(name, documentation, fn, kind)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.counter("omaju_requests_total", "HTTP requests by route, method and status", ("route", "method", "status"))
+REQUEST_SECONDS = REGISTRY.histogram(
+    "omaju_request_duration_seconds", "Time to produce the response (headers, for streams)", ("route", "method"))
+IN_FLIGHT = REGISTRY.gauge("omaju_requests_in_flight", "Requests being handled")
+STAGE_SECONDS = REGISTRY.histogram(
+    "omaju_stage_seconds", "Time spent per request stage", ("stage",), cls=_StageHistogram)
+MONGO_SECONDS = REGISTRY.histogram(
+    "omaju_mongo_command_seconds", "MongoDB command latency", ("command", "collection"), buckets=MONGO_BUCKETS)
+ERRORS = REGISTRY.counter("omaju_errors_total", "Errors by where they happened and exception type", ("kind", "type"))
+HISTORY_MESSAGES = REGISTRY.histogram(
+    "omaju_history_messages", "Stored messages read as prompt history per model call", buckets=HISTORY_BUCKETS)
+PROMPT_TOKENS = REGISTRY.histogram(
+    "omaju_prompt_tokens", "Estimated tokens sent to the model per call", buckets=TOKEN_BUCKETS)
+
+
+def route_label(url_rule):
+    """Route template (``/messages/<session_id>``) rather than the raw path, to bound label values."""
+    return url_rule.rule if url_rule is not None else "unmatched"
+
+
+def timed(stage):
+    """Decorator recording a sync or async function's duration under ``stage``."""
+    def decorate(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with STAGE_SECONDS.time(stage):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with STAGE_SECONDS.time(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Times every MongoDB command; pass as ``event_listeners=[...]`` to the client."""
+
+    def __init__(self):
+        self._collections: Dict[Tuple, str] = {}
+
+    @staticmethod
+    def _key(event):
+        return event.request_id, event.connection_id
+
+    def started(self, event):
+        command = event.command
+        collection = command.get("collection") if event.command_name == "getMore" else command.get(event.command_name)
+        self._collections[self._key(event)] = collection if isinstance(collection, str) else "-"
+
+    def _finish(self, event):
+        collection = self._collections.pop(self._key(event), "-")
+        seconds = event.duration_micros / 1e6
+        MONGO_SECONDS.observe(seconds, event.command_name, collection)
+        _add_request_stage("mongo", seconds)
+
+    def succeeded(self, event):
+        self._finish(event)
+
+    def failed(self, event):
+        self._finish(event)
+        failure = event.failure if isinstance(event.failure, dict) else {}
+        ERRORS.inc("mongo", failure.get("codeName") or "unknown")
@@ -0,0 +1,337 @@
+"""Deadline-aware model calls for /chat.
+
+Every call gets a latency budget (``budget`` seconds) that covers all of its
+attempts. Inside it:
+
+- retryable failures (rate limits, 5xx, timeouts, dropped connections) are
+  retried after a full-jitter backoff, but only while the backoff still fits
+  in the remaining budget
+- with hedging on, an attempt that is still running after the hedge delay
+  (the observed ``hedge_quantile`` of attempt latency, ``hedge_delay`` until
+  enough samples exist) gets a second, identical request; the first success
+  wins and the other is cancelled. Only calls slower than that quantile are
+  hedged, so the extra model cost stays around ``1 - hedge_quantile``.
+
+Budget exhaustion raises ``DeadlineExceeded``, which the routes answer with
+the usual fallback reply.
+
+``invoke`` runs attempts on a small thread pool so the calling thread can stop
+waiting at the deadline; a losing or timed-out attempt cannot be interrupted
+and finishes in the background with its result discarded. Until it does, it
+holds a slot of its own from ``hold`` (``ModelScheduler.hold`` in the apps),
+so abandoned attempts count against the scheduler's in-flight cap and cannot
+pile up in the pool once /chat has released its slot. ``ainvoke`` cancels
+losing tasks outright.
+
+The model client's own retries (``max_retries``, GEMINI_MAX_RETRIES) would
+run outside the budget, so attempts go to a copy of the model with them off.
+Streams do not pass through here and keep them.
+
+Attempt ``n`` of a call (0, 1, ...) passes ``config={"metadata": {"attempt": n}}``,
+which LangChain models hand to their callbacks; the fake model uses it to vary
+latency and injected failures between attempts.
+"""
+import asyncio
+import itertools
+import math
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Dict
+
+# HTTP statuses and exception class names (google.api_core, httpx, the fake model) worth retrying
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+RETRYABLE_NAMES = {
+    "ResourceExhausted", "ServiceUnavailable", "DeadlineExceeded", "InternalServerError",
+    "TooManyRequests", "BadGateway", "GatewayTimeout", "Aborted", "Unavailable",
+    "ConnectError", "ReadTimeout", "ConnectTimeout", "RemoteProtocolError", "FakeModelError",
+}
+
+
+class DeadlineExceeded(TimeoutError):
+    """The model call did not finish within its latency budget."""
+
+
+def is_retryable(e: BaseException) -> bool:
+    """True for transient failures, looking through wrapped causes."""
+    seen = set()
+    while e is not None and id(e) not in seen:
+        seen.add(id(e))
+        if isinstance(e, DeadlineExceeded):
+            return False
+        if isinstance(e, (TimeoutError, ConnectionError)):
+            return True
+        if type(e).__name__ in RETRYABLE_NAMES:
+            return True
+        for attr in ("status_code", "code"):
+            status = getattr(e, attr, None)
+            if isinstance(status, int) and status in RETRYABLE_STATUS:
+                return True
+        e = e.__cause__ or e.__context__
+    return False
+
+
+class ModelCallPolicy:
+    # Upper bounds (ms) of the attempt latency distribution buckets
+    LATENCY_BOUNDS = (100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000)
+    OUTCOMES = ("ok", "retryable_error", "error", "cancelled")
+
+    def __init__(self, budget=30.0, max_attempts=3, backoff=0.25, backoff_max=2.0,
+                 hedge=False, hedge_quantile=0.95, hedge_delay=2.0, hedge_min_samples=20,
+                 workers=32, window=500, hold=None):
+        self.budget = budget
+        self.max_attempts = max(1, max_attempts)
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_delay = hedge_delay
+        self.hedge_min_samples = hedge_min_samples
+        self._workers = workers
+        # Called for each abandoned attempt; returns something to release() when it finishes
+        self.hold = hold
+        self._pool = None
+        self._unretried = None
+        self._lock = threading.Lock()
+        self._samples = deque(maxlen=window)
+        self._quantile = None
+        self.calls = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.deadline_exceeded = 0
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.abandoned = 0
+        self.attempts = dict.fromkeys(self.OUTCOMES, 0)
+        self._latency_buckets = [0] * (len(self.LATENCY_BOUNDS) + 1)
+
+    # ---- timing ----
+
+    def current_hedge_delay(self):
+        """Seconds before a hedge is sent: the latency quantile once known, else ``hedge_delay``."""
+        with self._lock:
+            return self._quantile if self._quantile is not None else self.hedge_delay
+
+    def _backoff_delay(self, retry):
+        return random.uniform(0, min(self.backoff_max, self.backoff * (2 ** retry)))
+
+    def _record(self, outcome, seconds=None):
+        with self._lock:
+            self.attempts[outcome] += 1
+            if seconds is None:
+                return
+            ms = seconds * 1000
+            slot = next((k for k, bound in enumerate(self.LATENCY_BOUNDS) if ms <= bound), len(self.LATENCY_BOUNDS))
+            self._latency_buckets[slot] += 1
+            if outcome != "ok":
+                return
+            self._samples.append(seconds)
+            if len(self._samples) >= self.hedge_min_samples and len(self._samples) % 10 == 0:
+                ordered = sorted(self._samples)
+                self._quantile = ordered[min(len(ordered) - 1, math.ceil(self.hedge_quantile * len(ordered)) - 1)]
+
+    def _finish(self, error=None, hedge_won=False):
+        with self._lock:
+            self.calls += 1
+            if error is None:
+                self.succeeded += 1
+                self.hedge_wins += hedge_won
+            elif isinstance(error, DeadlineExceeded):
+                self.deadline_exceeded += 1
+            else:
+                self.failed += 1
+
+    def _retry_or_raise(self, error, retry, deadline):
+        """Backoff before the next retry, or re-raise when out of attempts or budget."""
+        if not is_retryable(error) or retry + 1 >= self.max_attempts:
+            raise error
+        delay = self._backoff_delay(retry)
+        if time.monotonic() + delay >= deadline:
+            raise error
+        with self._lock:
+            self.retries += 1
+        return delay
+
+    def _single_attempts(self, model):
+        """``model`` with its client-side retries off; models without them as they are."""
+        if not getattr(model, "max_retries", 0) or not hasattr(model, "model_copy"):
+            return model
+        with self._lock:
+            if self._unretried is None or self._unretried[0] is not model:
+                self._unretried = (model, model.model_copy(update={"max_retries": 0}))
+            return self._unretried[1]
+
+    # ---- sync ----
+
+    def _executor(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix="model-call")
+            return self._pool
+
+    def _run(self, model, prompt, attempt):
+        started = time.monotonic()
+        try:
+            result = model.invoke(prompt, config={"metadata": {"attempt": attempt}})
+        except Exception as e:
+            self._record("retryable_error" if is_retryable(e) else "error", time.monotonic() - started)
+            raise
+        self._record("ok", time.monotonic() - started)
+        return result
+
+    def _round(self, model, prompt, deadline, attempts):
+        """One attempt, plus a hedge if it runs long. Returns (result, hedge_won)."""
+        pool = self._executor()
+        primary = pool.submit(self._run, model, prompt, next(attempts))
+        running = {primary}
+        hedged = not self.hedge
+        error = None
+        try:
+            while running:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise DeadlineExceeded(f"model call exceeded its {self.budget:g}s budget")
+                timeout = remaining if hedged else min(remaining, self.current_hedge_delay())
+                done, running = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        return future.result(), future is not primary
+                    except Exception as e:
+                        error = e
+                if not hedged and running:
+                    # Still nothing back after the hedge delay: race a second request
+                    hedged = True
+                    with self._lock:
+                        self.hedges += 1
+                    running.add(pool.submit(self._run, model, prompt, next(attempts)))
+            raise error
+        finally:
+            # Threads cannot be interrupted: attempts already running finish unobserved
+            for future in running:
+                if future.cancel():
+                    self._record("cancelled")
+                else:
+                    with self._lock:
+                        self.abandoned += 1
+                    self._hold_until_done(future)
+
+    def _hold_until_done(self, future):
+        if self.hold is None:
+            return
+        slot = self.hold()
+        future.add_done_callback(lambda _: slot.release())
+
+    def invoke(self, model, prompt):
+        """``model.invoke(prompt)`` within the budget, with retries and optional hedging."""
+        if self.budget <= 0:
+            return model.invoke(prompt)
+        deadline = time.monotonic() + self.budget
+        attempts = itertools.count()
+        retry = 0
+        model = self._single_attempts(model)
+        while True:
+            try:
+                result, hedge_won = self._round(model, prompt, deadline, attempts)
+            except Exception as e:
+                try:
+                    delay = self._retry_or_raise(e, retry, deadline)
+                except Exception as final:
+                    self._finish(final)
+                    raise
+                time.sleep(delay)
+                retry += 1
+                continue
+            self._finish(hedge_won=hedge_won)
+            return result
+
+    # ---- async ----
+
+    async def _arun(self, model, prompt, attempt):
+        started = time.monotonic()
+        try:
+            result = await model.ainvoke(prompt, config={"metadata": {"attempt": attempt}})
+        except asyncio.CancelledError:
+            self._record("cancelled")
+            raise
+        except Exception as e:
+            self._record("retryable_error" if is_retryable(e) else "error", time.monotonic() - started)
+            raise
+        self._record("ok", time.monotonic() - started)
+        return result
+
+    async def _around(self, model, prompt, deadline, attempts):
+        primary = asyncio.ensure_future(self._arun(model, prompt, next(attempts)))
+        running = {primary}
+        hedged = not self.hedge
+        error = None
+        try:
+            while running:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise DeadlineExceeded(f"model call exceeded its {self.budget:g}s budget")
+                timeout = remaining if hedged else min(remaining, self.current_hedge_delay())
+                done, running = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    try:
+                        return task.result(), task is not primary
+                    except Exception as e:
+                        error = e
+                if not hedged and running:
+                    hedged = True
+                    with self._lock:
+                        self.hedges += 1
+                    running.add(asyncio.ensure_future(self._arun(model, prompt, next(attempts))))
+            raise error
+        finally:
+            # Losers and timed-out attempts are cancelled for real (recorded by _arun)
+            for task in running:
+                task.cancel()
+
+    async def ainvoke(self, model, prompt):
+        """Async ``invoke``."""
+        if self.budget <= 0:
+            return await model.ainvoke(prompt)
+        deadline = time.monotonic() + self.budget
+        attempts = itertools.count()
+        retry = 0
+        model = self._single_attempts(model)
+        while True:
+            try:
+                result, hedge_won = await self._around(model, prompt, deadline, attempts)
+            except Exception as e:
+                try:
+                    delay = self._retry_or_raise(e, retry, deadline)
+                except Exception as final:
+                    self._finish(final)
+                    raise
+                await asyncio.sleep(delay)
+                retry += 1
+                continue
+            self._finish(hedge_won=hedge_won)
+            return result
+
+    # ---- metrics ----
+
+    def stats(self) -> Dict[str, Any]:
+        hedge_delay = self.current_hedge_delay()
+        with self._lock:
+            labels = [f"<={bound}" for bound in self.LATENCY_BOUNDS] + [f">{self.LATENCY_BOUNDS[-1]}"]
+            return {
+                "budget_s": self.budget,
+                "max_attempts": self.max_attempts,
+                "hedge": self.hedge,
+                "hedge_delay_ms": round(hedge_delay * 1000, 1) if self.hedge else None,
+                "calls": self.calls,
+                "succeeded": self.succeeded,
+                "failed": self.failed,
+                "deadline_exceeded": self.deadline_exceeded,
+                "retries": self.retries,
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+                "abandoned": self.abandoned,
+                "attempts": dict(self.attempts),
+                "attempt_ms": dict(zip(labels, self._latency_buckets)),
+            }
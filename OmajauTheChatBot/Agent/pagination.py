@@ -0,0 +1,128 @@
+"""Keyset pagination for the listing routes.
+
+Listings are ordered by a timestamp field and ``_id``, both descending, and a
+page cursor encodes the (timestamp, _id) of the last item returned. The next
+page starts strictly after it, so pages stay stable while new items are added
+and no query skips over earlier results.
+
+Cursors are opaque URL-safe strings; clients pass back ``next_cursor`` as
+``?cursor=``. Requests without ``limit`` or ``cursor`` keep the unpaginated
+response.
+"""
+import base64
+import binascii
+import json
+import os
+from datetime import datetime
+
+from bson import ObjectId
+from bson.errors import InvalidId
+
+PAGE_SIZE_DEFAULT = int(os.getenv("PAGE_SIZE_DEFAULT", "20"))
+PAGE_SIZE_MAX = int(os.getenv("PAGE_SIZE_MAX", "100"))
+
+
+class PageError(ValueError):
+    """Malformed paging parameters (answered with 400)."""
+
+
+def _tag(value):
+    if isinstance(value, datetime):
+        return {"$date": value.isoformat()}
+    if isinstance(value, ObjectId):
+        return {"$oid": str(value)}
+    return value
+
+
+def _untag(value):
+    if isinstance(value, dict):
+        if "$date" in value:
+            return datetime.fromisoformat(value["$date"])
+        if "$oid" in value:
+            return ObjectId(value["$oid"])
+    return value
+
+
+def encode_cursor(value, last_id):
+    raw = json.dumps([_tag(value), _tag(last_id)], separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Returns (timestamp, _id) from a cursor made by encode_cursor."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        value, last_id = json.loads(raw)
+        return _untag(value), _untag(last_id)
+    except (ValueError, TypeError, binascii.Error, InvalidId) as e:
+        raise PageError("invalid cursor") from e
+
+
+def page_limit(raw):
+    if raw is None or raw == "":
+        return PAGE_SIZE_DEFAULT
+    try:
+        limit = int(raw)
+    except ValueError:
+        raise PageError("limit must be an integer")
+    if limit < 1:
+        raise PageError("limit must be positive")
+    return min(limit, PAGE_SIZE_MAX)
+
+
+def page_args(args):
+    """Parse ?limit=&cursor=. Returns None for an unpaginated request, else (limit, cursor)."""
+    if "limit" not in args and "cursor" not in args:
+        return None
+    cursor = args.get("cursor")
+    return page_limit(args.get("limit")), decode_cursor(cursor) if cursor else None
+
+
+def _message_index(raw, name):
+    if raw in (None, ""):
+        return None
+    try:
+        index = int(raw)
+    except ValueError:
+        raise PageError(f"{name} must be a message index")
+    if index < 0:
+        raise PageError(f"{name} must be a message index")
+    return index
+
+
+def message_page_args(args):
+    """Parse ?limit=&before=&since= for /messages. Returns None or (limit, before, since)."""
+    if "limit" not in args and "before" not in args and "since" not in args:
+        return None
+    before = _message_index(args.get("before"), "before")
+    since = _message_index(args.get("since"), "since")
+    if before is not None and since is not None:
+        raise PageError("before and since cannot be combined")
+    return page_limit(args.get("limit")), before, since
+
+
+def keyset_sort(field):
+    return [(field, -1), ("_id", -1)]
+
+
+def keyset_filter(query, field, cursor):
+    """``query`` restricted to items after ``cursor`` in keyset_sort(field) order."""
+    if cursor is None:
+        return query
+    value, last_id = cursor
+    same_value = {field: value, "_id": {"$lt": last_id}}
+    if value is None:
+        # Missing timestamps sort last; only smaller _ids among them remain
+        after = [same_value]
+    else:
+        after = [{field: {"$lt": value}}, same_value, {field: None}]
+    return {**query, "$or": after}
+
+
+def split_page(docs, field, limit):
+    """Split a fetch of ``limit + 1`` documents into (items, next_cursor)."""
+    items = docs[:limit]
+    if len(docs) <= limit or not items:
+        return items, None
+    last = items[-1]
+    return items, encode_cursor(last.get(field), last["_id"])
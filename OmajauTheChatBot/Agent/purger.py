@@ -0,0 +1,291 @@
+"""Background removal of deleted chats and sessions.
+
+Deleting a chat or a session only marks its document with ``deleted_at``.
+That hides it from the routes at once and makes the document the purge job
+itself:
+
+    chats:  {_id, ..., deleted_at, purge_until, purge_owner}
+    convos: {_id, ..., deleted_at, purge_until, purge_owner}
+
+``Purger`` claims marked documents and removes what belongs to them in
+bounded batches:
+
+- a chat: its sessions, ``PURGE_SESSIONS`` at a time, each batch's buckets
+  first and then its convos documents, then the chat itself
+- a session: its buckets, then the convos document
+
+Each delete removes at most ``PURGE_BATCH`` documents, with ``PURGE_PAUSE``
+seconds between batches, so a chat with thousands of long sessions turns into
+many small deletes spread over time instead of one long one competing with
+live traffic.
+
+A claim is a lease (``purge_until``, renewed after every batch). Several
+workers can purge side by side, and work left by a crash or restart is picked
+up again once its lease expires. Batches delete whatever is still there, so a
+resumed purge simply carries on. Renewing checks that the tombstone is still
+ours: if a deleted session's id is reused meanwhile, the store purges it
+inline (``ConvoStore._revive``), the renewal fails and the purger leaves the
+new session alone.
+
+    flask --app app purge      # drain everything pending now
+"""
+import asyncio
+import logging
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+
+from pymongo import ASCENDING
+
+# Documents removed per delete_many
+PURGE_BATCH = int(os.getenv("PURGE_BATCH", "500"))
+# Sessions of a deleted chat handled per batch
+PURGE_SESSIONS = int(os.getenv("PURGE_SESSIONS", "50"))
+# Seconds between batches (throttle), and between polls when there is nothing to purge
+PURGE_PAUSE = float(os.getenv("PURGE_PAUSE", "0.2"))
+PURGE_INTERVAL = float(os.getenv("PURGE_INTERVAL", "10"))
+# Seconds a claim stays valid without renewal before another worker may take it over
+PURGE_LEASE = float(os.getenv("PURGE_LEASE", "120"))
+
+# Run the purger in this process (turn off where a separate process drains with `flask --app app purge`)
+PURGE_WORKER = (os.getenv("PURGE_WORKER", "true").lower() == "true")
+
+DELETED = {"deleted_at": {"$exists": True}}
+NOT_DELETED = {"deleted_at": {"$exists": False}}
+
+
+def tombstone(now=None):
+    return {"$set": {"deleted_at": now or datetime.utcnow()}}
+
+
+def _claimable(now):
+    return {
+        **DELETED,
+        "$or": [{"purge_until": {"$exists": False}}, {"purge_until": {"$lt": now}}],
+    }
+
+
+class LeaseLost(Exception):
+    """The tombstone is gone or was claimed by another worker."""
+
+
+class Purger:
+    """Removes marked chats and sessions; ``run_once``/``arun_once`` handle one of them."""
+
+    def __init__(self, db, write_behind=None, batch=PURGE_BATCH, sessions=PURGE_SESSIONS,
+                 pause=PURGE_PAUSE, interval=PURGE_INTERVAL, lease=PURGE_LEASE):
+        self.chats = db["chats"]
+        self.convos = db["convos"]
+        self.buckets = db["convo_buckets"]
+        # Queued message pushes of purged sessions are dropped (same process only)
+        self.write_behind = write_behind
+        self.batch = batch
+        self.sessions = sessions
+        self.pause = pause
+        self.interval = interval
+        self.lease = lease
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{id(self):x}"
+        self._lock = threading.Lock()
+        self.purged = {"chats": 0, "sessions": 0}
+        self.deleted = {"convos": 0, "convo_buckets": 0}
+        self.batches = 0
+        self.lost = 0
+        self.failures = 0
+        self.last_error = None
+
+    # ---- shared ----
+
+    def _lease_update(self):
+        return {"$set": {"purge_until": datetime.utcnow() + timedelta(seconds=self.lease), "purge_owner": self.owner}}
+
+    def _mine(self, doc):
+        return {"_id": doc["_id"], "purge_owner": self.owner}
+
+    def _counted(self, collection, n):
+        with self._lock:
+            self.deleted[collection] += n
+            self.batches += 1
+
+    def _discard(self, session_ids):
+        if self.write_behind is not None:
+            for session_id in session_ids:
+                self.write_behind.discard(session_id)
+
+    def _done(self, kind):
+        with self._lock:
+            self.purged[kind] += 1
+
+    def _lease_lost(self, e):
+        logging.info("[purge] gave up %s: tombstone gone or claimed elsewhere", e)
+        with self._lock:
+            self.lost += 1
+
+    def _failed(self, e):
+        logging.warning("[purge] failed: %s", e)
+        with self._lock:
+            self.failures += 1
+            self.last_error = str(e)
+
+    # ---- sync ----
+
+    def _claim(self, col):
+        return col.find_one_and_update(
+            _claimable(datetime.utcnow()), self._lease_update(),
+            projection={"_id": 1}, sort=[("deleted_at", ASCENDING)],
+        )
+
+    def _renew(self, col, doc):
+        if not col.update_one(self._mine(doc), self._lease_update()).matched_count:
+            raise LeaseLost(f"{col.name} {doc['_id']}")
+        if self.pause > 0:
+            time.sleep(self.pause)
+
+    def _purge_buckets(self, col, doc, session_filter):
+        while True:
+            ids = [b["_id"] for b in self.buckets.find(session_filter, {"_id": 1}).limit(self.batch)]
+            if not ids:
+                return
+            # Renew between reading and deleting: the buckets read belong to the tombstone still held
+            self._renew(col, doc)
+            self._counted("convo_buckets", self.buckets.delete_many({"_id": {"$in": ids}}).deleted_count)
+
+    def _purge_chat(self, chat):
+        while True:
+            cursor = self.convos.find({"chat_id": chat["_id"]}, {"_id": 1}).limit(self.sessions)
+            session_ids = [c["_id"] for c in cursor]
+            if not session_ids:
+                break
+            self._discard(session_ids)
+            self._purge_buckets(self.chats, chat, {"session_id": {"$in": session_ids}})
+            self._counted("convos", self.convos.delete_many({"_id": {"$in": session_ids}}).deleted_count)
+            self._renew(self.chats, chat)
+        self.chats.delete_one(self._mine(chat))
+        self._done("chats")
+
+    def _purge_session(self, convo):
+        self._discard([convo["_id"]])
+        self._purge_buckets(self.convos, convo, {"session_id": convo["_id"]})
+        self._counted("convos", self.convos.delete_one(self._mine(convo)).deleted_count)
+        self._done("sessions")
+
+    def run_once(self):
+        """Purge one deleted chat or session. Returns False if there was nothing to do."""
+        try:
+            chat = self._claim(self.chats)
+            if chat is not None:
+                self._purge_chat(chat)
+                return True
+            convo = self._claim(self.convos)
+            if convo is not None:
+                self._purge_session(convo)
+                return True
+        except LeaseLost as e:
+            self._lease_lost(e)
+            return True
+        return False
+
+    def drain(self):
+        """Purge until nothing is left. Returns the number of chats and sessions handled."""
+        handled = 0
+        while self.run_once():
+            handled += 1
+        return handled
+
+    def start(self):
+        """Purge from a daemon thread, polling every `interval` seconds when idle."""
+        def run():
+            while True:
+                try:
+                    busy = self.run_once()
+                except Exception as e:
+                    # The claim lapses and the work is retried once the lease expires
+                    self._failed(e)
+                    busy = False
+                if not busy:
+                    time.sleep(self.interval)
+
+        thread = threading.Thread(target=run, name="purger", daemon=True)
+        thread.start()
+        return thread
+
+    # ---- async ----
+
+    async def _aclaim(self, col):
+        return await col.find_one_and_update(
+            _claimable(datetime.utcnow()), self._lease_update(),
+            projection={"_id": 1}, sort=[("deleted_at", ASCENDING)],
+        )
+
+    async def _arenew(self, col, doc):
+        if not (await col.update_one(self._mine(doc), self._lease_update())).matched_count:
+            raise LeaseLost(f"{col.name} {doc['_id']}")
+        if self.pause > 0:
+            await asyncio.sleep(self.pause)
+
+    async def _apurge_buckets(self, col, doc, session_filter):
+        while True:
+            ids = [b["_id"] for b in await self.buckets.find(session_filter, {"_id": 1}).limit(self.batch).to_list(None)]
+            if not ids:
+                return
+            await self._arenew(col, doc)
+            self._counted("convo_buckets", (await self.buckets.delete_many({"_id": {"$in": ids}})).deleted_count)
+
+    async def _apurge_chat(self, chat):
+        while True:
+            cursor = self.convos.find({"chat_id": chat["_id"]}, {"_id": 1}).limit(self.sessions)
+            session_ids = [c["_id"] for c in await cursor.to_list(None)]
+            if not session_ids:
+                break
+            self._discard(session_ids)
+            await self._apurge_buckets(self.chats, chat, {"session_id": {"$in": session_ids}})
+            self._counted("convos", (await self.convos.delete_many({"_id": {"$in": session_ids}})).deleted_count)
+            await self._arenew(self.chats, chat)
+        await self.chats.delete_one(self._mine(chat))
+        self._done("chats")
+
+    async def _apurge_session(self, convo):
+        self._discard([convo["_id"]])
+        await self._apurge_buckets(self.convos, convo, {"session_id": convo["_id"]})
+        self._counted("convos", (await self.convos.delete_one(self._mine(convo))).deleted_count)
+        self._done("sessions")
+
+    async def arun_once(self):
+        try:
+            chat = await self._aclaim(self.chats)
+            if chat is not None:
+                await self._apurge_chat(chat)
+                return True
+            convo = await self._aclaim(self.convos)
+            if convo is not None:
+                await self._apurge_session(convo)
+                return True
+        except LeaseLost as e:
+            self._lease_lost(e)
+            return True
+        return False
+
+    async def arun(self):
+        """Purge forever (run as a task), polling every `interval` seconds when idle."""
+        while True:
+            try:
+                busy = await self.arun_once()
+            except Exception as e:
+                self._failed(e)
+                busy = False
+            if not busy:
+                await asyncio.sleep(self.interval)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "batch": self.batch,
+                "pause_s": self.pause,
+                "purged": dict(self.purged),
+                "deleted": dict(self.deleted),
+                "batches": self.batches,
+                "lost_leases": self.lost,
+                "failures": self.failures,
+                "last_error": self.last_error,
+            }
@@ -0,0 +1,205 @@
+"""Opt-in request profiling for app.py.
+
+Two independent switches, both off by default:
+
+- ``SERVER_TIMING=true`` adds a ``Server-Timing`` header with the time each
+  stage (auth, mongo, prompt, model, serialization) took in that request,
+  readable in the browser's network panel.
+- ``PROFILE_SAMPLE_RATE`` (fraction of requests) and/or ``PROFILE_TOKEN``
+  (profile requests sent with ``X-Profile: <token>``) capture the request
+  under cProfile and dump it to ``PROFILE_DIR``. One capture runs at a time;
+  requests arriving meanwhile are not profiled.
+
+When both are off the request hooks skip all of this after one flag check.
+
+Captures are ordinary ``.prof`` files (``python -m pstats``, snakeviz, ...).
+To merge them into folded stacks for flamegraph.pl, speedscope or inferno:
+
+    python request_profiler.py collapse profiles/ -o chat.folded --route /chat
+    flamegraph.pl chat.folded > chat.svg
+
+cProfile records caller/callee pairs rather than full stacks, so the folded
+stacks spread each function's time over its callers in proportion to the
+calls made from each one. That is exact for most code but an estimate for
+functions reached along several paths.
+"""
+import argparse
+import cProfile
+import os
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional
+
+# Order of the stages in the Server-Timing header
+STAGE_ORDER = ("auth", "mongo", "prompt", "model", "serialization")
+
+
+def server_timing(stages: Dict[str, float], total: float) -> str:
+    """``Server-Timing`` value for per-stage seconds plus the whole request."""
+    names = [name for name in STAGE_ORDER if name in stages]
+    names += sorted(name for name in stages if name not in STAGE_ORDER)
+    parts = [f"{name};dur={stages[name] * 1000:.1f}" for name in names]
+    parts.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(parts)
+
+
+def _slug(label: str) -> str:
+    return re.sub(r"[^A-Za-z0-9]+", "_", label).strip("_") or "root"
+
+
+class RequestProfiler:
+    """Decides which requests to profile and writes their captures."""
+
+    def __init__(self, directory="profiles", sample_rate=0.0, token="", max_files=200):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.token = token
+        self.max_files = max_files
+        self.enabled = sample_rate > 0 or bool(token)
+        self._busy = threading.Lock()
+        self.captures = 0
+        self.skipped_busy = 0
+
+    def wanted(self, header_value: Optional[str]) -> bool:
+        if self.token and header_value == self.token:
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def start(self) -> Optional[cProfile.Profile]:
+        """Start a capture on this thread, or return None if one is already running."""
+        if not self._busy.acquire(blocking=False):
+            self.skipped_busy += 1
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler (a debugger, or cProfile elsewhere) holds the hook
+            self._busy.release()
+            self.skipped_busy += 1
+            return None
+        return profile
+
+    def finish(self, profile: cProfile.Profile, label: str, seconds: float) -> Optional[str]:
+        """Stop the capture and write it to ``<dir>/<ms>-<route>-<duration>ms-<pid>.prof``."""
+        try:
+            profile.disable()
+            os.makedirs(self.directory, exist_ok=True)
+            name = f"{int(time.time() * 1000)}-{_slug(label)}-{int(seconds * 1000)}ms-{os.getpid()}.prof"
+            path = os.path.join(self.directory, name)
+            profile.dump_stats(path)
+            self.captures += 1
+            self._prune()
+            return path
+        finally:
+            self._busy.release()
+
+    def _prune(self):
+        files = sorted(f for f in os.listdir(self.directory) if f.endswith(".prof"))
+        for name in files[:max(0, len(files) - self.max_files)]:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "sample_rate": self.sample_rate,
+            "header_trigger": bool(self.token),
+            "directory": self.directory,
+            "captures": self.captures,
+            "skipped_busy": self.skipped_busy,
+        }
+
+
+# ============ Aggregation (CLI) ============
+
+def _frame(func) -> str:
+    filename, line, name = func
+    if filename == "~":
+        return name  # built-ins: "<built-in method time.sleep>"
+    return f"{name} ({os.path.basename(filename)}:{line})".replace(";", ":")
+
+
+def collapse(paths: Iterable[str], max_depth=128, min_us=1) -> Dict[str, int]:
+    """Merge cProfile captures into ``{"root;caller;callee": microseconds of self time}``."""
+    import pstats
+
+    paths = list(paths)
+    if not paths:
+        return {}
+    merged = pstats.Stats(paths[0])
+    for path in paths[1:]:
+        merged.add(path)
+
+    children = defaultdict(list)
+    for func, (_, _, _, _, callers) in merged.stats.items():
+        for caller, edge in callers.items():
+            children[caller].append((func, edge[3]))
+    roots = [func for func, row in merged.stats.items() if not row[4]]
+
+    folded: Dict[str, int] = defaultdict(int)
+
+    def walk(func, stack: List[str], on_path: set, cumulative: float):
+        _, _, self_time, total, _ = merged.stats[func]
+        ratio = cumulative / total if total > 0 else 0.0
+        frames = stack + [_frame(func)]
+        us = int(self_time * ratio * 1e6)
+        if us >= min_us:
+            folded[";".join(frames)] += us
+        if len(frames) >= max_depth:
+            return
+        on_path.add(func)
+        for child, edge_total in children.get(func, ()):
+            share = edge_total * ratio
+            if child not in on_path and share * 1e6 >= min_us:
+                walk(child, frames, on_path, share)
+        on_path.discard(func)
+
+    for root in roots:
+        walk(root, [], set(), merged.stats[root][3])
+    return dict(folded)
+
+
+def _capture_files(inputs, route=None) -> List[str]:
+    files = []
+    for item in inputs:
+        if os.path.isdir(item):
+            files.extend(os.path.join(item, f) for f in sorted(os.listdir(item)) if f.endswith(".prof"))
+        else:
+            files.append(item)
+    if route:
+        files = [f for f in files if f"-{_slug(route)}-" in os.path.basename(f)]
+    return files
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Work with request profiles captured by app.py")
+    sub = parser.add_subparsers(dest="command", required=True)
+    fold = sub.add_parser("collapse", help="Merge .prof captures into folded stacks for flame graphs")
+    fold.add_argument("inputs", nargs="+", help="Capture files or directories")
+    fold.add_argument("-o", "--output", help="Output file (default: stdout)")
+    fold.add_argument("--route", help="Only captures of this route, e.g. /chat")
+    fold.add_argument("--max-depth", type=int, default=128)
+    args = parser.parse_args()
+
+    files = _capture_files(args.inputs, args.route)
+    if not files:
+        parser.error("no captures found")
+    folded = collapse(files, max_depth=args.max_depth)
+    lines = [f"{stack} {us}" for stack, us in sorted(folded.items())]
+    text = "\n".join(lines) + "\n"
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+        print(f"{len(files)} captures -> {len(lines)} stacks in {args.output}")
+    else:
+        print(text, end="")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""Cache of model replies for repeated prompts.
+
+Keys are a SHA-256 of the normalized system prompt and the whole
+conversation, so "Who made you?" and "who made you" share an entry as long as
+the conversation leading up to them matches. Only conversations of at most
+``history_tail`` messages before the user's one are cached, so the key always
+covers everything the model is shown.
+
+``ResponseCache`` is the backend interface; ``MemoryResponseCache`` is the
+in-process implementation. A shared store (Redis, Mongo TTL collection, ...)
+only has to implement ``get``/``put``/``stats`` and be registered in
+``BACKENDS``.
+"""
+import hashlib
+import re
+from abc import ABC, abstractmethod
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+_SPACE = re.compile(r"\s+")
+_EDGE_PUNCT = " \t\n.,!?;:'\"`"
+
+
+def normalize(text: str) -> str:
+    """Case-fold, collapse whitespace and drop leading/trailing punctuation."""
+    return _SPACE.sub(" ", (text or "").casefold()).strip(_EDGE_PUNCT)
+
+
+def cache_key(system_prompt: str, msgs: Sequence[Dict[str, Any]], history_tail: int) -> Optional[str]:
+    """Key for replying to ``msgs[-1]`` given the ``history_tail`` messages before it.
+
+    None when the conversation is longer than that: the model would see older
+    messages the key ignores (names, facts the user shared), and the cached
+    reply could reach another conversation, or user, with a different past.
+    """
+    if history_tail >= 0 and len(msgs) > history_tail + 1:
+        return None
+    tail = list(msgs)
+    h = hashlib.sha256()
+    h.update(normalize(system_prompt).encode("utf-8"))
+    for msg in tail:
+        h.update(b"\x1e")
+        h.update(str(msg.get("role", "")).encode("utf-8"))
+        h.update(b"\x1f")
+        h.update(normalize(str(msg.get("content", ""))).encode("utf-8"))
+    return h.hexdigest()
+
+
+class ResponseCache(ABC):
+    """Backend interface for cached replies."""
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[str]:
+        """The cached reply for ``key``, or None."""
+
+    @abstractmethod
+    def put(self, key: str, response: str):
+        """Store ``response`` under ``key``."""
+
+    @abstractmethod
+    def stats(self) -> Dict[str, Any]:
+        """Counters for /health."""
+
+
+class MemoryResponseCache(ResponseCache):
+    """In-process TTL cache with LRU eviction past ``max_entries``."""
+
+    def __init__(self, ttl: float = 300.0, max_entries: int = 1000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: str, response: str):
+        if self.ttl <= 0 or self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, response)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "backend": "memory",
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+BACKENDS = {"memory": MemoryResponseCache}
+
+
+def create_response_cache(backend: str, **options) -> Optional[ResponseCache]:
+    """Build the configured backend, or return None when caching is off."""
+    if not backend or backend == "off":
+        return None
+    if backend not in BACKENDS:
+        raise ValueError(f"unknown response cache backend {backend!r} (expected one of {sorted(BACKENDS)} or 'off')")
+    return BACKENDS[backend](**options)
@@ -1,33 +1,480 @@
 import speech_recognition as sr
 from gtts import gTTS
 import pyttsx3
+import atexit
+import io
 import os
+import queue
+import re
+import shlex
+import shutil
+import subprocess
+import sys
 import tempfile
+import threading
 import time
-from typing import Optional, Tuple
+from concurrent.futures import Future
+from typing import Callable, List, Optional, Tuple
+
+from tts_cache import TTSCache, cache_key, create_tts_cache
+
+# Player fed MP3 audio on stdin; default: the first of mpg123, mpv and ffplay found on PATH
+TTS_PLAYER = os.getenv("TTS_PLAYER", "")
+# Sentences synthesized ahead of the one playing
+TTS_LOOKAHEAD = int(os.getenv("TTS_LOOKAHEAD", "2"))
+# Longest chunk sent to the TTS engine at once (longer sentences are cut at commas or spaces)
+TTS_MAX_CHUNK = int(os.getenv("TTS_MAX_CHUNK", "300"))
+
+_PLAYERS = (
+    ["mpg123", "-q", "-"],
+    ["mpv", "--no-terminal", "--no-video", "--cache=no", "-"],
+    ["ffplay", "-nodisp", "-loglevel", "quiet", "-probesize", "32", "-"],
+)
+
+# Players for one audio file (cached pyttsx3 output), tried in order
+_FILE_PLAYERS = (
+    ["aplay", "-q"],
+    ["paplay"],
+    ["afplay"],
+    ["ffplay", "-nodisp", "-autoexit", "-loglevel", "quiet"],
+)
+
+# Sentence end: . ! ? or … (plus closing quotes/brackets) followed by whitespace, or a blank line
+_SENTENCE_END = re.compile(r'(?<=[.!?\u2026])["\')\]]*\s+|\n\s*\n')
+# Fragments shorter than this ("Dr.", "1.") are joined with the next sentence
+_MIN_CHUNK = 12
+
+
+class SentenceSplitter:
+    """Cuts text that arrives in pieces (e.g. streamed deltas) into sentence-sized chunks."""
+    
+    def __init__(self, max_chunk: int = TTS_MAX_CHUNK):
+        self.max_chunk = max_chunk
+        self._buffer = ""
+    
+    def feed(self, text: str) -> List[str]:
+        """Add text; return the chunks completed by it."""
+        self._buffer += text
+        chunks = []
+        start = 0
+        for match in _SENTENCE_END.finditer(self._buffer):
+            chunk = self._buffer[start:match.start() + len(match.group().rstrip())].strip()
+            if len(chunk) >= _MIN_CHUNK:
+                chunks.extend(self._cut(chunk))
+                start = match.end()
+        self._buffer = self._buffer[start:]
+        if len(self._buffer) > self.max_chunk:
+            # No sentence end in sight: speak what is there rather than wait
+            head, self._buffer = self._cut_once(self._buffer)
+            chunks.append(head)
+        return chunks
+    
+    def flush(self) -> List[str]:
+        """Return whatever is left once the text is complete."""
+        rest, self._buffer = self._buffer.strip(), ""
+        return self._cut(rest) if rest else []
+    
+    def _cut_once(self, text: str) -> Tuple[str, str]:
+        window = text[:self.max_chunk]
+        cut = max(window.rfind(", "), window.rfind("; "))
+        if cut < self.max_chunk // 2:
+            cut = window.rfind(" ")
+        if cut <= 0:
+            cut = self.max_chunk - 1
+        return text[:cut + 1].strip(), text[cut + 1:].lstrip()
+    
+    def _cut(self, chunk: str) -> List[str]:
+        parts = []
+        while len(chunk) > self.max_chunk:
+            head, chunk = self._cut_once(chunk)
+            parts.append(head)
+        if chunk:
+            parts.append(chunk)
+        return parts
+
+
+def split_sentences(text: str, max_chunk: int = TTS_MAX_CHUNK) -> List[str]:
+    splitter = SentenceSplitter(max_chunk)
+    return splitter.feed(text) + splitter.flush()
+
+
+class AudioPlayer:
+    """One long-lived player process that MP3 audio is written to, chunk after chunk.
+    
+    MP3 frames can simply be concatenated, so consecutive chunks play back to
+    back from the same stream with no temp files and no process start per
+    chunk. Without a stdin-capable player (e.g. on Windows), each chunk is
+    written to a temp file and opened with the system player instead; those
+    files are removed on exit, not while they may still be playing.
+    """
+    
+    def __init__(self, command: Optional[str] = None):
+        self.command = self._find_command(command if command is not None else TTS_PLAYER)
+        self.file_command = next((list(c) for c in _FILE_PLAYERS if shutil.which(c[0])), None)
+        self._process = None
+        self._lock = threading.Lock()
+        self._temp_files: List[str] = []
+        atexit.register(self.close)
+    
+    @staticmethod
+    def _find_command(configured: str) -> Optional[List[str]]:
+        if configured:
+            return shlex.split(configured)
+        for command in _PLAYERS:
+            if shutil.which(command[0]):
+                return list(command)
+        return None
+    
+    def play(self, audio: bytes):
+        """Queue MP3 audio behind what is already playing; returns once it is handed over."""
+        with self._lock:
+            if self.command is None:
+                self._play_file(audio)
+                return
+            for attempt in (1, 2):
+                if self._process is None or self._process.poll() is not None:
+                    self._process = subprocess.Popen(
+                        self.command, stdin=subprocess.PIPE,
+                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                    )
+                try:
+                    # Blocks while the pipe is full, i.e. until the player has caught up
+                    self._process.stdin.write(audio)
+                    self._process.stdin.flush()
+                    return
+                except (BrokenPipeError, OSError):
+                    # The player exited (killed, device error): start a new one once
+                    self._process = None
+                    if attempt == 2:
+                        raise
+    
+    @property
+    def can_stream(self) -> bool:
+        """Whether chunks queue up behind each other. The fallback opens each in the
+        system player and returns at once, so chunks would play over each other."""
+        return self.command is not None
+    
+    @property
+    def can_play_files(self) -> bool:
+        return os.name == 'nt' or self.file_command is not None
+    
+    def play_file(self, path: str):
+        """Play an audio file (WAV/AIFF) to the end."""
+        with self._lock:
+            if os.name == 'nt':
+                import winsound
+                winsound.PlaySound(path, winsound.SND_FILENAME)
+            else:
+                subprocess.run(self.file_command + [path], stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL, check=True)
+    
+    def _play_file(self, audio: bytes):
+        with tempfile.NamedTemporaryFile(delete=False, suffix='.mp3') as temp_file:
+            temp_file.write(audio)
+        self._temp_files.append(temp_file.name)
+        if os.name == 'nt':  # Windows
+            os.startfile(temp_file.name)
+        elif os.name == 'posix':  # macOS and Linux
+            opener = 'open' if os.uname().sysname == 'Darwin' else 'xdg-open'
+            subprocess.Popen([opener, temp_file.name], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    
+    def close(self):
+        """Let queued audio finish playing, then stop the player."""
+        with self._lock:
+            if self._process is not None:
+                try:
+                    self._process.stdin.close()
+                    self._process.wait()
+                except OSError:
+                    pass
+                self._process = None
+            for name in self._temp_files:
+                try:
+                    os.unlink(name)
+                except OSError:
+                    pass
+            self._temp_files.clear()
+
+
+class TTSStats:
+    """Time to first audio and synthesis time, across utterances."""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.utterances = 0
+        self.chunks = 0
+        self.cached_chunks = 0
+        self.synth_s = 0.0
+        self.first_audio: List[float] = []
+        self.failures = 0
+    
+    def add_chunk(self, synth_s: float = 0.0, cached: bool = False):
+        with self._lock:
+            self.chunks += 1
+            if cached:
+                self.cached_chunks += 1
+            self.synth_s += synth_s
+    
+    def add_utterance(self, first_audio_s: Optional[float], ok: bool):
+        with self._lock:
+            self.utterances += 1
+            if first_audio_s is not None:
+                self.first_audio.append(first_audio_s)
+            if not ok:
+                self.failures += 1
+    
+    def stats(self) -> dict:
+        with self._lock:
+            ordered = sorted(self.first_audio)
+            first_audio = {}
+            if ordered:
+                first_audio = {
+                    "last": round(self.first_audio[-1] * 1000, 1),
+                    "p50": round(ordered[len(ordered) // 2] * 1000, 1),
+                    "max": round(ordered[-1] * 1000, 1),
+                }
+            return {
+                "utterances": self.utterances,
+                "chunks": self.chunks,
+                "cached_chunks": self.cached_chunks,
+                "synth_ms": round(self.synth_s * 1000, 1),
+                "first_audio_ms": first_audio,
+                "failures": self.failures,
+            }
+
+
+class OfflineEngine:
+    """A pyttsx3 engine that lives on one thread of its own.
+    
+    The SAPI5 (Windows) and NSSS (macOS) drivers only work from the thread that
+    created the engine, so ``pyttsx3.init()`` and every later call run on the
+    ``tts-engine`` thread. ``say`` and ``save_to_file`` hand it the work and
+    block until it is done; calls from several threads simply take turns.
+    """
+    
+    def __init__(self, on_utterance_started: Optional[Callable] = None):
+        self.voice = None
+        self.rate = None
+        self._jobs: queue.Queue = queue.Queue()
+        self._ready = threading.Event()
+        self._error: Optional[Exception] = None
+        self._thread = threading.Thread(target=self._serve, args=(on_utterance_started,),
+                                        name="tts-engine", daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        if self._error is not None:
+            raise self._error
+    
+    def _serve(self, on_utterance_started):
+        try:
+            engine = pyttsx3.init()
+            # Configure voice properties
+            voices = engine.getProperty('voices')
+            if voices:
+                engine.setProperty('voice', voices[0].id)
+            engine.setProperty('rate', 150)
+            engine.setProperty('volume', 0.9)
+            if on_utterance_started:
+                engine.connect('started-utterance', on_utterance_started)
+            # Read once here; the cache key needs them from other threads
+            self.voice = engine.getProperty('voice')
+            self.rate = engine.getProperty('rate')
+        except Exception as e:
+            self._error = e
+            return
+        finally:
+            self._ready.set()
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            fn, future = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(engine))
+            except BaseException as e:
+                future.set_exception(e)
+    
+    def run(self, fn: Callable):
+        """``fn(engine)`` on the engine thread; returns its result."""
+        future: Future = Future()
+        self._jobs.put((fn, future))
+        return future.result()
+    
+    def say(self, text: str):
+        """Speak ``text`` and return once it has been spoken."""
+        def speak(engine):
+            engine.say(text)
+            engine.runAndWait()
+        self.run(speak)
+    
+    def save_to_file(self, text: str, path: str):
+        def save(engine):
+            engine.save_to_file(text, path)
+            engine.runAndWait()
+        self.run(save)
+    
+    def voices(self) -> list:
+        return self.run(lambda engine: [voice.name for voice in engine.getProperty('voices')])
+    
+    def close(self):
+        self._jobs.put(None)
+
+
+class SpeechPipeline:
+    """Speaks text as it is fed, sentence by sentence.
+    
+    ``feed()`` splits incoming text into sentences and returns at once, so it
+    can be called with streamed deltas. With gTTS a worker thread synthesizes
+    up to `lookahead` sentences ahead while a second one hands finished audio
+    to the player, so sentence N+1 is ready by the time sentence N has played.
+    With pyttsx3 a worker thread speaks the queued sentences one by one as
+    they arrive; with the TTS cache on, pyttsx3 renders sentences to files
+    instead and they are played the same way as gTTS audio. ``finish()``
+    waits until everything is spoken (pyttsx3) or handed to the player (gTTS).
+    Without a player that queues MP3 chunks (see ``AudioPlayer.can_stream``),
+    gTTS text is collected and synthesized as one chunk in ``finish()``.
+    
+    ``first_audio_s`` is the time from creation to the first audio: the
+    first chunk reaching the player, or pyttsx3 starting its first utterance.
+    """
+    
+    def __init__(self, handler: "SpeechHandler", lookahead: int = TTS_LOOKAHEAD):
+        self.handler = handler
+        self.started = time.perf_counter()
+        self.first_audio_s: Optional[float] = None
+        self.ok = True
+        self._splitter = SentenceSplitter()
+        # gTTS without a streaming player: the whole text, spoken at finish()
+        self._whole: Optional[List[str]] = None
+        if not handler.use_offline_tts and not handler.player.can_stream:
+            self._whole = []
+        self._text: queue.Queue = queue.Queue()
+        self._threads = []
+        if handler.use_offline_tts and handler.tts_engine and not handler.offline_cached:
+            self._threads.append(threading.Thread(target=self._speak_offline, name="tts-speak", daemon=True))
+        else:
+            self._audio: queue.Queue = queue.Queue(maxsize=max(1, lookahead))
+            self._threads.append(threading.Thread(target=self._synthesize, name="tts-synth", daemon=True))
+            self._threads.append(threading.Thread(target=self._play, name="tts-play", daemon=True))
+        for thread in self._threads:
+            thread.start()
+    
+    def feed(self, text: str):
+        if self._whole is not None:
+            self._whole.append(text)
+            return
+        for chunk in self._splitter.feed(text):
+            self._text.put(chunk)
+    
+    def finish(self) -> bool:
+        if self._whole is not None:
+            text = "".join(self._whole).strip()
+            if text:
+                self._text.put(text)
+        else:
+            for chunk in self._splitter.flush():
+                self._text.put(chunk)
+        self._text.put(None)
+        for thread in self._threads:
+            thread.join()
+        self.handler.tts_stats.add_utterance(self.first_audio_s, self.ok)
+        return self.ok
+    
+    def _mark_first_audio(self):
+        if self.first_audio_s is None:
+            self.first_audio_s = time.perf_counter() - self.started
+    
+    def _failed(self, e):
+        if self.ok:
+            print(f"Error in TTS: {e}")
+        self.ok = False
+    
+    # gTTS and cached pyttsx3: producer
+    def _synthesize(self):
+        try:
+            while True:
+                chunk = self._text.get()
+                if chunk is None:
+                    break
+                if not self.ok:
+                    continue
+                try:
+                    audio = self.handler._chunk_audio(chunk)
+                except Exception as e:
+                    self._failed(e)
+                    continue
+                # Blocks while `lookahead` chunks are waiting to be played
+                self._audio.put(audio)
+        finally:
+            self._audio.put(None)
+    
+    # gTTS and cached pyttsx3: consumer
+    def _play(self):
+        while True:
+            audio = self._audio.get()
+            if audio is None:
+                return
+            if not self.ok:
+                continue
+            try:
+                if self.handler.use_offline_tts:
+                    # pyttsx3 output is a file (WAV/AIFF); play_file returns once it has played
+                    self._mark_first_audio()
+                    self.handler.player.play_file(audio)
+                else:
+                    self.handler.player.play(audio)
+                    self._mark_first_audio()
+            except Exception as e:
+                self._failed(e)
+    
+    # pyttsx3: consumer (the engine synthesizes and plays in one step)
+    def _speak_offline(self):
+        with self.handler._engine_lock:
+            self.handler._utterance_started = self._mark_first_audio
+            try:
+                while True:
+                    chunk = self._text.get()
+                    if chunk is None:
+                        return
+                    if not self.ok:
+                        continue
+                    try:
+                        started = time.perf_counter()
+                        self.handler.tts_engine.say(chunk)
+                        self.handler.tts_stats.add_chunk(time.perf_counter() - started)
+                    except Exception as e:
+                        self._failed(e)
+            finally:
+                self.handler._utterance_started = None
+
 
 class SpeechHandler:    
     """Handles speech recognition and text-to-speech operations."""
     
-    def __init__(self, use_offline_tts: bool = False):
+    def __init__(self, use_offline_tts: bool = False, lang: str = 'en', cache: Optional[TTSCache] = None):
         self.use_offline_tts = use_offline_tts
+        self.lang = lang
+        # Shared on-disk audio cache (tts_cache.py); TTS_CACHE=false turns it off
+        self.tts_cache = cache if cache is not None else create_tts_cache()
         self.recognizer = sr.Recognizer()
+        self.tts_stats = TTSStats()
+        self._player = None
+        # One pipeline speaks at a time, so two replies never interleave
+        self._engine_lock = threading.Lock()
+        self._utterance_started = None
         
         # Initialize TTS engine
         if use_offline_tts:
             try:
-                self.tts_engine = pyttsx3.init()
-                # Configure voice properties
-                voices = self.tts_engine.getProperty('voices')
-                if voices:
-                    self.tts_engine.setProperty('voice', voices[0].id)
-                self.tts_engine.setProperty('rate', 150)
-                self.tts_engine.setProperty('volume', 0.9)
+                self.tts_engine = OfflineEngine(self._on_utterance_started)
                 print("Offline TTS engine initialized successfully")
             except Exception as e:
                 print(f"Failed to initialize offline TTS: {e}")
                 print("Falling back to online TTS")
                 self.use_offline_tts = False
+                self.tts_engine = None
         else:
             self.tts_engine = None
             print("Online TTS (gTTS) will be used")
@@ -63,49 +510,81 @@ class SpeechHandler:
         except Exception as e:
             return False, f"Error during speech recognition: {e}"
     
+    @property
+    def player(self) -> AudioPlayer:
+        """The long-lived audio player, started on first use (gTTS only)."""
+        if self._player is None:
+            self._player = AudioPlayer()
+        return self._player
+    
+    def _on_utterance_started(self, name):
+        if self._utterance_started:
+            self._utterance_started()
+    
+    def start_speaking(self) -> SpeechPipeline:
+        """A pipeline to feed text into as it arrives; call finish() at the end."""
+        return SpeechPipeline(self)
+    
     def speak_text(self, text: str) -> bool:
+        """Speak text sentence by sentence, the first one as soon as it is synthesized."""
         try:
-            if self.use_offline_tts and self.tts_engine:
-                # Use offline TTS (pyttsx3)
-                self.tts_engine.say(text)
-                self.tts_engine.runAndWait()
-                return True
-            else:
-                # Use online TTS (gTTS)
-                return self._speak_with_gtts(text)
-                
+            pipeline = self.start_speaking()
+            pipeline.feed(text)
+            return pipeline.finish()
         except Exception as e:
             print(f"Error in TTS: {e}")
             return False
     
-    def _speak_with_gtts(self, text: str) -> bool:
-        try:
-            # Create temporary file for audio
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.mp3') as temp_file:
-                temp_filename = temp_file.name
-            
-            # Generate speech
-            tts = gTTS(text=text, lang='en', slow=False)
-            tts.save(temp_filename)
-            
-            # Play audio (platform-specific)
-            if os.name == 'nt':  # Windows
-                os.system(f'start {temp_filename}')
-            elif os.name == 'posix':  # macOS and Linux
-                os.system(f'open {temp_filename}' if os.uname().sysname == 'Darwin' else f'xdg-open {temp_filename}')
-            
-            # Clean up after a delay
-            time.sleep(0.5)
-            try:
-                os.unlink(temp_filename)
-            except:
-                pass
-                
-            return True
-            
-        except Exception as e:
-            print(f"Error with gTTS: {e}")
-            return False
+    @property
+    def offline_cached(self) -> bool:
+        """Whether pyttsx3 output goes through the cache (needs a player for audio files)."""
+        return self.tts_cache is not None and self.use_offline_tts and self.player.can_play_files
+    
+    def _chunk_audio(self, text: str):
+        """Audio for one chunk, from the cache when this exact utterance was synthesized before.
+        
+        gTTS: MP3 bytes. pyttsx3: the path of an audio file in the cache.
+        """
+        started = time.perf_counter()
+        if self.use_offline_tts:
+            engine = self.tts_engine
+            ext = 'aiff' if sys.platform == 'darwin' else 'wav'
+            key = cache_key(text, 'pyttsx3', voice=engine.voice, rate=engine.rate)
+            path = self.tts_cache.get_path(key, ext)
+            if path is not None:
+                self.tts_stats.add_chunk(cached=True)
+                return path
+            temp = self.tts_cache.temp_path(ext)
+            engine.save_to_file(text, temp)
+            self.tts_stats.add_chunk(time.perf_counter() - started)
+            path = self.tts_cache.adopt(key, ext, temp)
+            if path is None:
+                raise RuntimeError("pyttsx3 produced no audio")
+            return path
+        
+        key = cache_key(text, 'gtts', self.lang, voice='com', rate='normal')
+        audio = self.tts_cache.get(key, 'mp3') if self.tts_cache else None
+        if audio is not None:
+            self.tts_stats.add_chunk(cached=True)
+            return audio
+        audio = self._synthesize_gtts(text)
+        self.tts_stats.add_chunk(time.perf_counter() - started)
+        if self.tts_cache:
+            self.tts_cache.put(key, 'mp3', audio)
+        return audio
+    
+    def _synthesize_gtts(self, text: str) -> bytes:
+        """MP3 audio for one chunk of text (a request to Google's TTS service)."""
+        buffer = io.BytesIO()
+        gTTS(text=text, lang=self.lang, slow=False).write_to_fp(buffer)
+        return buffer.getvalue()
+    
+    def close(self):
+        """Let queued audio finish, then stop the player process and the pyttsx3 thread."""
+        if self._player is not None:
+            self._player.close()
+        if self.tts_engine is not None:
+            self.tts_engine.close()
     
     def test_microphone(self) -> bool:
         try:
@@ -121,8 +600,7 @@ class SpeechHandler:
             return []
         
         try:
-            voices = self.tts_engine.getProperty('voices')
-            return [voice.name for voice in voices]
+            return self.tts_engine.voices()
         except:
             return []
 
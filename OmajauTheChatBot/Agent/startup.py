@@ -0,0 +1,231 @@
+"""Startup bookkeeping for app.py: deferred clients, background warm-up and readiness.
+
+Heavy work is kept out of module import so a cold process binds its port
+quickly:
+- importing LangChain and the Gemini SDK
+- building the Gemini client
+- the first MongoDB round trip
+- ensuring indexes
+
+``Deferred`` builds a value on first use. ``WarmUp`` runs the same builders
+in a background thread right after start, so the first real request usually
+finds them done. ``/ready`` reports warm-up state, separately from ``/health``.
+
+``StartupReport`` records how long each startup phase took. For the import
+part, ``python startup.py importtime`` breaks module import time down per
+package (via ``python -X importtime``) to track regressions:
+
+    python startup.py importtime --top 15
+    python startup.py importtime --json startup.json --max-ms 1500   # exit 1 above budget
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from typing import Any, Callable, Dict, List, Optional
+
+
+class StartupReport:
+    """Durations of named startup phases, measured from ``started``."""
+
+    def __init__(self, started: Optional[float] = None):
+        self.started = started if started is not None else time.perf_counter()
+        self._lock = threading.Lock()
+        self.phases: Dict[str, float] = {}
+
+    def record(self, name: str, seconds: float):
+        with self._lock:
+            self.phases[name] = seconds
+
+    @contextmanager
+    def phase(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "uptime_s": round(time.perf_counter() - self.started, 1),
+                "phases_ms": {name: round(seconds * 1000, 1) for name, seconds in self.phases.items()},
+            }
+
+
+class Deferred:
+    """A value built by ``factory`` on first ``get()``, at most once, thread-safe.
+
+    Concurrent callers wait for the build in progress. If the factory raises,
+    nothing is cached and the next ``get()`` tries again.
+    """
+
+    def __init__(self, name: str, factory: Callable[[], Any], report: Optional[StartupReport] = None):
+        self.name = name
+        self._factory = factory
+        self._report = report
+        self._lock = threading.Lock()
+        self._ready = False
+        self._value = None
+
+    @property
+    def ready(self) -> bool:
+        return self._ready
+
+    def get(self):
+        if self._ready:
+            return self._value
+        with self._lock:
+            if not self._ready:
+                with self._report.phase(self.name) if self._report else nullcontext():
+                    self._value = self._factory()
+                self._ready = True
+        return self._value
+
+
+class WarmUp:
+    """Runs startup steps in a background thread and tracks readiness.
+
+    Required steps are retried every ``retry_interval`` seconds until they
+    succeed; the process is ready once all of them have. Optional steps run
+    once and only log on failure.
+    """
+
+    def __init__(self, report: Optional[StartupReport] = None, retry_interval=5.0):
+        self._report = report
+        self.retry_interval = retry_interval
+        self._steps: List[tuple] = []
+        self._lock = threading.Lock()
+        self._state: Dict[str, Dict[str, Any]] = {}
+        self.started = False
+
+    def add(self, name: str, fn: Callable[[], Any], required=True):
+        self._steps.append((name, fn, required))
+        self._state[name] = {"state": "pending", "required": required}
+
+    @property
+    def ready(self) -> bool:
+        with self._lock:
+            return all(s["state"] == "ok" for s in self._state.values() if s["required"])
+
+    def _set(self, name, **fields):
+        with self._lock:
+            self._state[name].update(fields)
+
+    def _run_step(self, name, fn, required):
+        attempts = 0
+        while True:
+            attempts += 1
+            started = time.perf_counter()
+            try:
+                fn()
+            except Exception as e:
+                self._set(name, state="failed", error=str(e), attempts=attempts)
+                logging.warning("[startup] %s failed (attempt %d): %s", name, attempts, e)
+                if not required:
+                    return
+                time.sleep(self.retry_interval)
+                continue
+            elapsed = time.perf_counter() - started
+            self._set(name, state="ok", ms=round(elapsed * 1000, 1), attempts=attempts, error=None)
+            if self._report is not None:
+                self._report.record(f"warmup.{name}", elapsed)
+            return
+
+    def run(self):
+        for name, fn, required in self._steps:
+            self._run_step(name, fn, required)
+        if self._report is not None:
+            self._report.record("ready", time.perf_counter() - self._report.started)
+        logging.info("[startup] warm-up finished")
+
+    def start(self) -> threading.Thread:
+        self.started = True
+        thread = threading.Thread(target=self.run, name="startup-warmup", daemon=True)
+        thread.start()
+        return thread
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            steps = {name: dict(state) for name, state in self._state.items()}
+        return {"ready": self.ready, "warmup": self.started, "steps": steps}
+
+
+# ============ Import-time report (CLI) ============
+
+_IMPORTTIME = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+
+def import_times(module="app", cwd=None) -> List[Dict[str, Any]]:
+    """Run ``python -X importtime -c 'import <module>'`` and parse its report."""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=cwd or os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True,
+    )
+    if proc.returncode != 0:
+        tail = "\n".join(proc.stderr.strip().splitlines()[-5:])
+        raise RuntimeError(f"importing {module} failed:\n{tail}")
+    rows = []
+    for line in proc.stderr.splitlines():
+        match = _IMPORTTIME.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            rows.append({
+                "module": name,
+                "self_us": int(self_us),
+                "cumulative_us": int(cumulative_us),
+                "depth": (len(indent) - 1) // 2,
+            })
+    return rows
+
+
+def by_package(rows, module) -> Dict[str, float]:
+    """Import ms of ``module`` split over the packages it imports first (interpreter startup excluded)."""
+    end = max(k for k, row in enumerate(rows) if row["depth"] == 0 and row["module"] == module)
+    totals = defaultdict(float)
+    totals[f"{module} (own code)"] = rows[end]["self_us"] / 1000.0
+    # Direct imports are listed just before the module itself, one level deeper
+    for row in reversed(rows[:end]):
+        if row["depth"] == 0:
+            break
+        if row["depth"] == 1:
+            totals[row["module"].split(".")[0]] += row["cumulative_us"] / 1000.0
+    return dict(sorted(totals.items(), key=lambda item: -item[1]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup-time reports for the Omaju backend")
+    sub = parser.add_subparsers(dest="command", required=True)
+    imports = sub.add_parser("importtime", help="Import-time breakdown per package")
+    imports.add_argument("--module", default="app", help="Module to import (default: app)")
+    imports.add_argument("--top", type=int, default=20, help="Packages to list")
+    imports.add_argument("--json", dest="json_out", help="Also write the report to this JSON file")
+    imports.add_argument("--max-ms", type=float, help="Exit 1 if the total import time exceeds this")
+    args = parser.parse_args()
+
+    rows = import_times(args.module)
+    packages = by_package(rows, args.module)
+    total_ms = sum(packages.values())
+    print(f"import {args.module}: {total_ms:.1f} ms total")
+    print(f"{'package':<32} {'ms':>9} {'share':>7}")
+    for name, ms in list(packages.items())[:args.top]:
+        print(f"{name:<32} {ms:9.1f} {ms / total_ms:7.1%}")
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump({"module": args.module, "total_ms": round(total_ms, 1), "packages_ms": packages}, f, indent=2)
+    if args.max_ms is not None and total_ms > args.max_ms:
+        print(f"import time {total_ms:.1f} ms exceeds budget {args.max_ms:.0f} ms", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+import functools
+
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+import backup
+import convo_store
+from backup import export_records, import_lines, ndjson_chunks
+from convo_store import ConvoStore
+
+
+def msg(role, content):
+    return {"role": role, "content": content}
+
+
+@pytest.fixture(autouse=True)
+def small_buckets(monkeypatch):
+    monkeypatch.setattr(convo_store, "BUCKET_SIZE", 2)
+    monkeypatch.setattr(backup, "ImportPlan", functools.partial(backup.ImportPlan, bucket_size=2))
+
+
+def new_db():
+    db = mongomock.MongoClient()["test"]
+    ConvoStore(db).ensure_bucket_index()
+    return db
+
+
+def session(store, session_id, chat_id, turns):
+    for n in range(turns):
+        t = store.append_user_message(session_id, chat_id, msg("user", f"{session_id} u{n}"))
+        store.append_reply(t, msg("assistant", f"{session_id} a{n}"))
+
+
+def backup_lines(uid="u1"):
+    """Export lines of a user with two chats, three sessions and 16 messages."""
+    db = new_db()
+    store = ConvoStore(db)
+    for chat_id in ("c1", "c2"):
+        db["chats"].insert_one({"_id": chat_id, "uid": uid, "title": chat_id})
+    session(store, "s1", "c1", 3)
+    session(store, "s2", "c1", 2)
+    session(store, "s3", "c2", 3)
+    return b"".join(ndjson_chunks(export_records(db, uid))).splitlines()
+
+
+def contents(db, session_id):
+    session = ConvoStore(db).get_session(session_id)
+    return [m["content"] for m in session["messages"]]
+
+
+def test_import_restores_an_export():
+    db = new_db()
+    stats = import_lines(db, "u2", backup_lines(), batch=3)
+    assert stats["imported"] == {"chats": 2, "sessions": 3, "messages": 16}
+    assert {c["uid"] for c in db["chats"].find()} == {"u2"}
+    assert contents(db, "s1") == ["s1 u0", "s1 a0", "s1 u1", "s1 a1", "s1 u2", "s1 a2"]
+    assert db["convos"].find_one({"_id": "s3"})["count"] == 6
+
+
+def test_rejects_a_chat_owned_by_another_uid():
+    db = new_db()
+    db["chats"].insert_one({"_id": "c1", "uid": "someone", "title": "theirs"})
+    stats = import_lines(db, "u1", backup_lines())
+    assert stats["skipped"] == {"chats": 1, "sessions": 2, "messages": 10}
+    assert stats["imported"] == {"chats": 1, "sessions": 1, "messages": 6}
+    assert db["chats"].find_one({"_id": "c1"})["uid"] == "someone"
+    assert db["convos"].count_documents({"chat_id": "c1"}) == 0
+    assert db["convo_buckets"].count_documents({"session_id": {"$in": ["s1", "s2"]}}) == 0
+
+
+def test_reimport_skips_what_exists():
+    db = new_db()
+    lines = backup_lines()
+    import_lines(db, "u1", lines)
+    stats = import_lines(db, "u1", lines)
+    assert stats["imported"] == {"chats": 0, "sessions": 0, "messages": 0}
+    assert stats["skipped"] == {"chats": 2, "sessions": 3, "messages": 16}
+
+
+def cut_off(lines, n):
+    """The first `n` lines, then a dropped connection."""
+    yield from lines[:n]
+    raise ConnectionError("connection reset")
+
+
+# Cut off before anything is written, with s1's buckets but not its session document,
+# right after s1, mid s2 and mid s3
+@pytest.mark.parametrize("n", [3, 8, 10, 13, 21])
+def test_rerun_completes_a_partial_import(n):
+    db = new_db()
+    lines = backup_lines()
+    with pytest.raises(ConnectionError):
+        import_lines(db, "u1", cut_off(lines, n), batch=2)
+    import_lines(db, "u1", lines, batch=2)
+    assert db["chats"].count_documents({}) == 2
+    for session_id, turns in (("s1", 3), ("s2", 2), ("s3", 3)):
+        expected = [f"{session_id} {role}{k}" for k in range(turns) for role in ("u", "a")]
+        assert contents(db, session_id) == expected
+        assert db["convos"].find_one({"_id": session_id})["count"] == 2 * turns
+    seqs = [(b["session_id"], b["seq"]) for b in db["convo_buckets"].find()]
+    assert len(seqs) == len(set(seqs))
@@ -0,0 +1,19 @@
+import pytest
+
+pytest.importorskip("dotenv")
+
+from chat_core import normalize_messages
+
+
+def test_normalize_messages_drops_non_string_content():
+    msgs = [
+        {"role": "user", "content": "hi"},
+        {"role": "user", "content": {"text": "hi"}},
+        {"role": "assistant", "content": ["a", "b"]},
+        {"role": "assistant", "content": 3},
+        {"role": "assistant", "content": ""},
+        "not a message",
+    ]
+    normalized = normalize_messages(msgs)
+    assert [m["content"] for m in normalized] == ["hi"]
+    assert normalized[0]["tokens"] > 0
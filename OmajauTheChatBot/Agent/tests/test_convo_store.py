@@ -0,0 +1,220 @@
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+import convo_store
+from convo_store import ConvoStore, MessageWriteBehind, _bucket_push, _page_bounds, _page_cursor
+
+
+def msg(role, content):
+    return {"role": role, "content": content}
+
+
+@pytest.fixture
+def db():
+    return mongomock.MongoClient()["test"]
+
+
+@pytest.fixture
+def store(db, monkeypatch):
+    monkeypatch.setattr(convo_store, "BUCKET_SIZE", 4)
+    return ConvoStore(db)
+
+
+def turn(store, n, reply=True):
+    t = store.append_user_message("s1", "c1", msg("user", f"u{n}"))
+    if reply:
+        store.append_reply(t, msg("assistant", f"a{n}"))
+    return t
+
+
+def contents(page):
+    return [m["content"] for m in page["messages"]]
+
+
+def test_reserves_user_and_reply_slots(store, db):
+    t = turn(store, 0, reply=False)
+    assert t.reply_index == 1
+    assert not t.replied
+    assert db["convos"].find_one({"_id": "s1"})["count"] == 2
+    store.append_reply(t, msg("assistant", "a0"))
+    assert t.replied
+    assert [m["i"] for m in db["convo_buckets"].find_one({"seq": 0})["messages"]] == [0, 1]
+
+
+def test_turns_span_buckets(store, db):
+    for n in range(3):
+        turn(store, n)
+    assert sorted(b["seq"] for b in db["convo_buckets"].find()) == [0, 1]
+    t = turn(store, 3, reply=False)
+    assert [m["content"] for m in t.recent] == ["u0", "a0", "u1", "a1", "u2", "a2", "u3"]
+    assert t.reply_index == 7
+
+
+def test_page_bounds():
+    assert _page_bounds(10, 4, None) == (6, 10)
+    assert _page_bounds(10, 4, 3) == (0, 3)
+    assert _page_bounds(10, 4, None, since=8) == (8, 10)
+    assert _page_bounds(10, 4, None, since=12) == (10, 10)
+
+
+def test_backward_pages(store):
+    for n in range(3):
+        turn(store, n)
+    page = store.get_session_page("s1", 4)
+    assert contents(page) == ["u1", "a1", "u2", "a2"]
+    page = store.get_session_page("s1", 4, before=page["next_before"])
+    assert contents(page) == ["u0", "a0"]
+    assert page["next_before"] is None
+
+
+def test_since_waits_for_pending_reply(store):
+    turn(store, 0)
+    t = turn(store, 1, reply=False)
+    page = store.get_session_page("s1", 10, since=0)
+    assert contents(page) == ["u0", "a0", "u1"]
+    assert page["next_since"] == 3
+    store.append_reply(t, msg("assistant", "a1"))
+    page = store.get_session_page("s1", 10, since=3)
+    assert contents(page) == ["a1"]
+    assert page["next_since"] == 4
+
+
+def test_since_skips_older_unfilled_slot(store):
+    turn(store, 0, reply=False)
+    turn(store, 1)
+    page = store.get_session_page("s1", 10, since=0)
+    assert contents(page) == ["u0", "u1", "a1"]
+    assert page["next_since"] == 4
+
+
+def test_page_cursor_holds_back_past_pending_slot():
+    msgs = [{"i": 0}, {"i": 2}, {"i": 4}]
+    # Hole at 1 is old and skipped; 3 is the latest turn's user message
+    assert _page_cursor(0, 5, 0, msgs, 5) == {"next_since": 3}
+    assert _page_cursor(0, 5, None, msgs, 5) == {"next_before": None}
+
+
+def test_responses_leave_out_internal_fields(store):
+    turn(store, 0)
+    for page in (store.get_session("s1"), store.get_session_page("s1", 10), store.get_session_page("s1", 10, since=0)):
+        assert [sorted(m) for m in page["messages"]] == [["content", "role"], ["content", "role"]]
+
+
+class FlushAfterRead:
+    """Buckets whose find() reads, then lets the write-behind flush before returning."""
+
+    def __init__(self, buckets, write_behind):
+        self.buckets = buckets
+        self.write_behind = write_behind
+
+    def find(self, *args, **kwargs):
+        docs = list(self.buckets.find(*args, **kwargs))
+        self.flush()
+        return Sorted(docs)
+
+    def flush(self):
+        # What MessageWriteBehind.flush does, with one update per entry
+        # instead of a bulk_write
+        entries = self.write_behind._take()
+        for session_id, size, msgs in entries:
+            self.buckets.update_one({"session_id": session_id, "seq": msgs[0]["i"] // size}, _bucket_push(msgs), upsert=True)
+        self.write_behind._finish(entries, [])
+
+    def __getattr__(self, name):
+        return getattr(self.buckets, name)
+
+
+class Sorted(list):
+    def sort(self, key, direction):
+        return sorted(self, key=lambda d: d[key], reverse=direction < 0)
+
+
+@pytest.fixture
+def racing_store(db, monkeypatch):
+    monkeypatch.setattr(convo_store, "BUCKET_SIZE", 4)
+    store = ConvoStore(db, write_behind=MessageWriteBehind(interval=60))
+    store.buckets = FlushAfterRead(store.buckets, store.write_behind)
+    return store
+
+
+def test_reads_keep_messages_flushed_mid_read(racing_store):
+    t = turn(racing_store, 0)
+    assert [m["content"] for m in t.recent] == ["u0"]
+    t = turn(racing_store, 1, reply=False)
+    assert contents(racing_store.get_session("s1")) == ["u0", "a0", "u1"]
+    racing_store.append_reply(t, msg("assistant", "a1"))
+    assert contents(racing_store.get_session_page("s1", 10)) == ["u0", "a0", "u1", "a1"]
+
+
+@pytest.mark.parametrize("legacy", [True, False])
+def test_late_migration_keeps_messages_pushed_after_another_one(store, db, legacy):
+    history = [dict(msg("user", "old u"), timestamp=1), dict(msg("assistant", "old a"), timestamp=2)]
+    if legacy:
+        db["conversations"].insert_one({"session_id": "s1", "messages": history})
+        stale = db["conversations"].find_one({"session_id": "s1"})
+    else:
+        db["convos"].insert_one({"_id": "s1", "chat_id": "c1", "messages": history})
+        stale = db["convos"].find_one({"_id": "s1"})
+    # The first request converts the session and answers a new turn
+    t = store.append_user_message("s1", None, msg("user", "u0"))
+    store.append_reply(t, msg("assistant", "a0"))
+    assert contents(store.get_session("s1")) == ["old u", "old a", "u0", "a0"]
+    # A second request that read the old document before that finishes its conversion now
+    store._convert(stale, from_legacy=legacy)
+    assert contents(store.get_session("s1")) == ["old u", "old a", "u0", "a0"]
+    assert db["convos"].find_one({"_id": "s1"})["count"] == 4
+
+
+class FailAfterWrite:
+    """Buckets whose next bulk_write applies, then fails like a dropped connection."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.fail = True
+
+    def bulk_write(self, ops, **kwargs):
+        result = self.buckets.bulk_write(ops, **kwargs)
+        if self.fail:
+            self.fail = False
+            raise ConnectionError("connection reset")
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self.buckets, name)
+
+
+def stored_indexes(db):
+    return [m["i"] for b in db["convo_buckets"].find().sort("seq", 1) for m in b["messages"]]
+
+
+def test_requeued_flush_does_not_duplicate_messages(db, monkeypatch):
+    monkeypatch.setattr(convo_store, "BUCKET_SIZE", 4)
+    store = ConvoStore(db, write_behind=MessageWriteBehind(interval=60))
+    store.ensure_bucket_index()
+    buckets = FailAfterWrite(db["convo_buckets"])
+    turn(store, 0)
+    with pytest.raises(ConnectionError):
+        store.write_behind.flush(buckets)
+    # The whole batch was requeued; a new turn is merged into the same bucket
+    turn(store, 1)
+    store.write_behind.flush(buckets)
+    assert stored_indexes(db) == [0, 1, 2, 3]
+    assert store.write_behind.queued("s1") == []
+    assert contents(store.get_session("s1")) == ["u0", "a0", "u1", "a1"]
+
+
+def test_wait_due_wakes_once_a_batch_is_full():
+    import asyncio
+
+    async def main():
+        write_behind = MessageWriteBehind(max_batch=2, interval=30)
+        waiter = asyncio.ensure_future(write_behind.wait_due())
+        await asyncio.sleep(0)
+        write_behind.add("s1", [{"i": 0}], 4)
+        await asyncio.sleep(0.01)
+        assert not waiter.done()
+        write_behind.add("s1", [{"i": 1}], 4)
+        await asyncio.wait_for(waiter, 1)
+
+    asyncio.run(main())
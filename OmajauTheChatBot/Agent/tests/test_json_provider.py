@@ -0,0 +1,33 @@
+import json
+from datetime import date, datetime, timedelta, timezone
+
+import pytest
+
+pytest.importorskip("bson")
+
+import json_provider
+from json_provider import dumps_bytes, std_dumps
+
+NAIVE = datetime(2024, 5, 1, 12, 0, 0, 123000)
+CET = timezone(timedelta(hours=1))
+
+
+@pytest.fixture(params=["orjson", "stdlib"])
+def encoder(request, monkeypatch):
+    if request.param == "orjson":
+        pytest.importorskip("orjson")
+    else:
+        monkeypatch.setattr(json_provider, "orjson", None)
+
+
+def test_naive_datetimes_are_utc(encoder):
+    doc = {"naive": NAIVE, "aware": NAIVE.replace(tzinfo=CET), "day": date(2024, 5, 1)}
+    assert json.loads(dumps_bytes(doc)) == {
+        "naive": "2024-05-01T12:00:00.123000+00:00",
+        "aware": "2024-05-01T12:00:00.123000+01:00",
+        "day": "2024-05-01",
+    }
+
+
+def test_stdlib_encoder_matches():
+    assert json.loads(std_dumps({"t": NAIVE})) == json.loads(dumps_bytes({"t": NAIVE}))
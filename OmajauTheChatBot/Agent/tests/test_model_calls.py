@@ -0,0 +1,78 @@
+import threading
+
+import pytest
+
+from llm_scheduler import ModelScheduler, SchedulerBusy
+from model_calls import DeadlineExceeded, ModelCallPolicy
+
+
+class SlowModel:
+    """invoke blocks until released."""
+
+    def __init__(self):
+        self.release = threading.Event()
+
+    def invoke(self, prompt, config=None):
+        self.release.wait(5)
+        return "late"
+
+
+def test_abandoned_attempt_holds_a_slot_until_it_finishes():
+    scheduler = ModelScheduler(max_in_flight=1, max_wait=0.05)
+    policy = ModelCallPolicy(budget=0.05, max_attempts=1, hold=scheduler.hold)
+    model = SlowModel()
+    with scheduler.acquire("u1"):
+        with pytest.raises(DeadlineExceeded):
+            policy.invoke(model, "hi")
+    assert scheduler.stats()["in_flight"] == 1
+    assert scheduler.stats()["held"] == 1
+    # The abandoned attempt still counts against the cap
+    with pytest.raises(SchedulerBusy):
+        scheduler.acquire("u2")
+
+    model.release.set()
+    policy._executor().shutdown(wait=True)
+    assert scheduler.stats()["in_flight"] == 0
+    assert scheduler.stats()["held"] == 0
+    with scheduler.acquire("u2"):
+        pass
+
+
+def test_hold_defers_handoff_to_waiters_until_below_cap():
+    scheduler = ModelScheduler(max_in_flight=1, max_wait=2)
+    slot = scheduler.acquire("u1")
+    held = scheduler.hold()
+    got = []
+    waiter = threading.Thread(target=lambda: got.append(scheduler.acquire("u2")))
+    waiter.start()
+    while scheduler.stats()["queued"] == 0:
+        pass
+    slot.release()
+    # Still at the cap because of the held slot
+    assert scheduler.stats()["queued"] == 1
+    held.release()
+    waiter.join(2)
+    assert got and scheduler.stats()["in_flight"] == 1
+    got[0].release()
+    assert scheduler.stats()["in_flight"] == 0
+
+
+class RetryingModel:
+    """Stands in for a pydantic chat model with client-side retries."""
+
+    def __init__(self, max_retries):
+        self.max_retries = max_retries
+
+    def model_copy(self, update):
+        return RetryingModel(**update)
+
+    def invoke(self, prompt, config=None):
+        return self.max_retries
+
+
+def test_calls_turn_client_retries_off():
+    policy = ModelCallPolicy(budget=5)
+    model = RetryingModel(6)
+    assert policy.invoke(model, "hi") == 0
+    assert model.max_retries == 6
+    assert policy._single_attempts(model) is policy._single_attempts(model)
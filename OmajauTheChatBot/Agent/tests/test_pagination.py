@@ -0,0 +1,32 @@
+import base64
+import json
+from datetime import datetime
+
+import pytest
+
+pytest.importorskip("bson")
+
+from bson import ObjectId
+
+from pagination import PageError, decode_cursor, encode_cursor
+
+
+def raw_cursor(value):
+    return base64.urlsafe_b64encode(json.dumps(value).encode("utf-8")).decode("ascii")
+
+
+def test_cursor_round_trip():
+    ts, oid = datetime(2024, 5, 1, 12, 30), ObjectId()
+    assert decode_cursor(encode_cursor(ts, oid)) == (ts, oid)
+
+
+@pytest.mark.parametrize("cursor", [
+    "not base64!",
+    raw_cursor([1]),
+    raw_cursor([{"$date": "yesterday"}, 1]),
+    raw_cursor([{"$date": "2024-05-01T12:30:00"}, {"$oid": "not-an-object-id"}]),
+    raw_cursor([{"$date": "2024-05-01T12:30:00"}, {"$oid": "0" * 23}]),
+])
+def test_malformed_cursor_is_a_page_error(cursor):
+    with pytest.raises(PageError):
+        decode_cursor(cursor)
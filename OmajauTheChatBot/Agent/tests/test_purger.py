@@ -0,0 +1,118 @@
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+import convo_store
+from convo_store import ConvoStore
+from purger import Purger, tombstone
+
+
+def msg(role, content):
+    return {"role": role, "content": content}
+
+
+@pytest.fixture
+def db():
+    return mongomock.MongoClient()["test"]
+
+
+@pytest.fixture
+def store(db, monkeypatch):
+    monkeypatch.setattr(convo_store, "BUCKET_SIZE", 2)
+    return ConvoStore(db)
+
+
+def session(store, session_id, chat_id=None, turns=3):
+    for n in range(turns):
+        t = store.append_user_message(session_id, chat_id, msg("user", f"u{n}"))
+        store.append_reply(t, msg("assistant", f"a{n}"))
+
+
+class AfterDelete:
+    """Buckets that run `action` right after their first delete_many, between two purge batches."""
+
+    def __init__(self, buckets, action):
+        self.buckets = buckets
+        self.action = action
+
+    def delete_many(self, *args, **kwargs):
+        result = self.buckets.delete_many(*args, **kwargs)
+        if self.action is not None:
+            action, self.action = self.action, None
+            action()
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self.buckets, name)
+
+
+def test_purges_a_deleted_session_in_batches(store, db):
+    session(store, "s1")
+    session(store, "s2")
+    store.delete_session("s1")
+    purger = Purger(db, batch=1, pause=0)
+    assert purger.drain() == 1
+    assert db["convos"].find_one({"_id": "s1"}) is None
+    assert db["convo_buckets"].count_documents({"session_id": "s1"}) == 0
+    assert db["convo_buckets"].count_documents({"session_id": "s2"}) == 3
+    assert purger.stats()["deleted"] == {"convos": 1, "convo_buckets": 3}
+
+
+def test_purges_a_deleted_chat_with_its_sessions(store, db):
+    db["chats"].insert_one({"_id": "c1", "uid": "u1"})
+    session(store, "s1", "c1")
+    session(store, "s2", "c1")
+    db["chats"].update_one({"_id": "c1"}, tombstone())
+    assert Purger(db, batch=2, sessions=1, pause=0).drain() == 1
+    assert db["chats"].count_documents({}) == 0
+    assert db["convos"].count_documents({}) == 0
+    assert db["convo_buckets"].count_documents({}) == 0
+
+
+def test_stops_when_the_lease_is_taken_over(store, db):
+    session(store, "s1")
+    store.delete_session("s1")
+    purger = Purger(db, batch=1, pause=0)
+
+    def take_over():
+        db["convos"].update_one({"_id": "s1"}, {"$set": {"purge_owner": "elsewhere"}})
+
+    purger.buckets = AfterDelete(purger.buckets, take_over)
+    assert purger.run_once()
+    assert purger.lost == 1
+    # One batch went before the renewal failed; the rest is left to the new owner
+    assert db["convo_buckets"].count_documents({"session_id": "s1"}) == 2
+    assert db["convos"].find_one({"_id": "s1"})["purge_owner"] == "elsewhere"
+
+
+def test_expired_lease_is_picked_up_again(store, db):
+    session(store, "s1")
+    store.delete_session("s1")
+    first = Purger(db, batch=1, pause=0, lease=-1)
+
+    def crash():
+        raise ConnectionError("worker died")
+
+    first.buckets = AfterDelete(first.buckets, crash)
+    with pytest.raises(ConnectionError):
+        first.run_once()
+    assert Purger(db, batch=1, pause=0).drain() == 1
+    assert db["convos"].count_documents({}) == 0
+    assert db["convo_buckets"].count_documents({}) == 0
+
+
+def test_reused_session_id_is_left_alone(store, db):
+    session(store, "s1")
+    store.delete_session("s1")
+    purger = Purger(db, batch=1, pause=0)
+
+    def reuse():
+        store.create_session("s1", None, [msg("user", "again"), msg("assistant", "hello")])
+
+    purger.buckets = AfterDelete(purger.buckets, reuse)
+    assert purger.run_once()
+    assert purger.lost == 1
+    page = store.get_session("s1")
+    assert [m["content"] for m in page["messages"]] == ["again", "hello"]
+    assert "deleted_at" not in db["convos"].find_one({"_id": "s1"})
+    assert purger.drain() == 0
@@ -0,0 +1,26 @@
+from response_cache import MemoryResponseCache, cache_key
+
+
+def msgs(*contents):
+    return [{"role": "user" if k % 2 == 0 else "assistant", "content": c} for k, c in enumerate(contents)]
+
+
+def test_key_ignores_case_and_edge_punctuation():
+    assert cache_key("Sys", msgs("Who made you?"), 2) == cache_key("sys", msgs("who made  you"), 2)
+
+
+def test_no_key_when_history_is_longer_than_the_tail():
+    # The model would see "my name is Ana"; another user must not get that reply
+    long = msgs("my name is Ana", "hi Ana", "what is my name?", "Ana", "what is my name?")
+    assert cache_key("sys", long, 2) is None
+    assert cache_key("sys", long[-3:], 2) is not None
+    assert cache_key("sys", long, -1) is not None
+
+
+def test_memory_cache_expires_and_evicts():
+    cache = MemoryResponseCache(ttl=60, max_entries=1)
+    cache.put("a", "1")
+    cache.put("b", "2")
+    assert cache.get("a") is None
+    assert cache.get("b") == "2"
+    assert cache.stats()["evictions"] == 1
@@ -0,0 +1,245 @@
+"""On-disk cache of synthesized speech, shared by every client on the machine.
+
+The assistant says the same things a lot (its greeting, apologies, common
+answers), and each sentence is synthesized separately, so many utterances
+repeat exactly. ``TTSCache`` stores the audio of each one under a SHA-256 of
+what determines the sound:
+
+    engine, language, voice, rate, text (whitespace collapsed)
+
+Entries are plain files, ``<dir>/<2 hex>/<64 hex>.<ext>``:
+
+- writes go to a temp file in the same directory and are moved into place
+  with ``os.replace``, so a reader never sees half a file and concurrent
+  clients writing the same entry simply leave one of the two
+- a hit touches the file's mtime, which makes mtime the LRU order for
+  every process sharing the directory
+- once the directory grows past ``max_bytes``, the least recently used
+  files are removed down to ``TTS_CACHE_LOW_WATER`` of it
+
+    python tts_cache.py stats      # size and entries of the cache directory
+    python tts_cache.py clear
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+# Off with TTS_CACHE=false
+TTS_CACHE = (os.getenv("TTS_CACHE", "true").lower() == "true")
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "omaju", "tts"))
+TTS_CACHE_MB = float(os.getenv("TTS_CACHE_MB", "200"))
+# Eviction removes files until the cache is below this share of TTS_CACHE_MB
+TTS_CACHE_LOW_WATER = float(os.getenv("TTS_CACHE_LOW_WATER", "0.8"))
+
+_SPACE = re.compile(r"\s+")
+
+
+def cache_key(text: str, engine: str, lang: str = "", voice: Any = "", rate: Any = "") -> str:
+    """Key of one utterance; anything that changes the audio is part of it."""
+    fields = [engine, lang, str(voice or ""), str(rate or ""), _SPACE.sub(" ", text).strip()]
+    return hashlib.sha256(json.dumps(fields, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class TTSCache:
+    """Size-bounded LRU cache of audio files in ``directory``."""
+
+    def __init__(self, directory: str = TTS_CACHE_DIR, max_bytes: int = int(TTS_CACHE_MB * 1024 * 1024),
+                 low_water: float = TTS_CACHE_LOW_WATER):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        # Size estimate; other processes add to the directory too, so eviction rescans it
+        self._bytes = sum(size for _, size, _ in self._scan())
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self.errors = 0
+
+    def path(self, key: str, ext: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.{ext}")
+
+    def get(self, key: str, ext: str) -> Optional[bytes]:
+        path = self.path(key, ext)
+        try:
+            with open(path, "rb") as f:
+                audio = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            # Never written, or evicted (possibly by another process)
+            with self._lock:
+                self.misses += 1
+            return None
+        except OSError:
+            with self._lock:
+                self.errors += 1
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return audio
+
+    def get_path(self, key: str, ext: str) -> Optional[str]:
+        """Like get, for players that read files: the entry's path if it exists."""
+        path = self.path(key, ext)
+        try:
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return path
+
+    def put(self, key: str, ext: str, audio: bytes) -> Optional[str]:
+        """Store audio atomically; returns its path (None if it could not be written)."""
+        if not audio or len(audio) > self.max_bytes:
+            return None
+        path = self.path(key, ext)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, temp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(audio)
+                os.replace(temp, path)
+            except BaseException:
+                os.unlink(temp)
+                raise
+        except OSError:
+            with self._lock:
+                self.errors += 1
+            return None
+        self._added(len(audio))
+        return path
+
+    def adopt(self, key: str, ext: str, temp: str) -> Optional[str]:
+        """Move a file written elsewhere in this directory (e.g. by an engine) into the cache."""
+        path = self.path(key, ext)
+        try:
+            size = os.path.getsize(temp)
+            if not size:
+                os.unlink(temp)
+                return None
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(temp, path)
+        except OSError:
+            with self._lock:
+                self.errors += 1
+            return None
+        self._added(size)
+        return path
+
+    def temp_path(self, ext: str) -> str:
+        """A fresh path inside the cache directory, for engines that can only write to a file."""
+        fd, temp = tempfile.mkstemp(dir=self.directory, suffix=f".{ext}.tmp")
+        os.close(fd)
+        return temp
+
+    def _added(self, size: int):
+        with self._lock:
+            self.writes += 1
+            self._bytes += size
+            over = self._bytes > self.max_bytes
+        if over:
+            self.evict()
+
+    def _scan(self) -> List[Tuple[float, int, str]]:
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith(".tmp"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def evict(self):
+        """Remove least recently used files until the cache is below the low-water mark."""
+        entries = sorted(self._scan())
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * self.low_water
+        removed = 0
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.unlink(path)
+                removed += 1
+            except FileNotFoundError:
+                # Removed by another process meanwhile
+                pass
+            except OSError:
+                # Open elsewhere (Windows); try again on the next eviction
+                continue
+            total -= size
+        with self._lock:
+            self._bytes = total
+            self.evictions += removed
+
+    def clear(self):
+        for _, _, path in self._scan():
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        with self._lock:
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "dir": self.directory,
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "writes": self.writes,
+                "evictions": self.evictions,
+                "errors": self.errors,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+def create_tts_cache() -> Optional[TTSCache]:
+    """The configured cache, or None when it is off or its directory is unusable."""
+    if not TTS_CACHE:
+        return None
+    try:
+        return TTSCache()
+    except OSError as e:
+        print(f"Warning: TTS cache disabled ({e})")
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or clear the on-disk TTS cache")
+    parser.add_argument("command", choices=["stats", "clear"])
+    parser.add_argument("--dir", default=TTS_CACHE_DIR, help=f"Cache directory (default: {TTS_CACHE_DIR})")
+    args = parser.parse_args()
+
+    cache = TTSCache(args.dir)
+    if args.command == "clear":
+        cache.clear()
+        print(f"Cleared {args.dir}")
+        return
+    entries = cache._scan()
+    total = sum(size for _, size, _ in entries)
+    print(f"{args.dir}: {len(entries)} entries, {total / 1024 / 1024:.1f} MB of {cache.max_bytes / 1024 / 1024:.0f} MB")
+
+
+if __name__ == "__main__":
+    main()